@@ -0,0 +1,296 @@
+import typing as tp
+from abc import ABC, abstractmethod
+
+from . import operations as ops
+from .key_codec import encode_key
+from .schema import Schema, key_getter, unpacker
+from .sketches import HyperLogLog
+
+
+class Aggregator(ABC):
+    """
+    Base class for aggregate functions computed incrementally over rows of a group.
+    State is created by initial, updated by every row and turned into value by result;
+    states of different parts of a group can be combined by merge.
+    """
+
+    @abstractmethod
+    def initial(self) -> tp.Any:
+        """State of an empty group"""
+        pass
+
+    @abstractmethod
+    def update(self, state: tp.Any, row: ops.TRow) -> tp.Any:
+        """
+        :param state: current state
+        :param row: next row of the group
+        """
+        pass
+
+    @abstractmethod
+    def merge(self, state_a: tp.Any, state_b: tp.Any) -> tp.Any:
+        """
+        :param state_a: state of the first part of a group
+        :param state_b: state of the second part of a group
+        """
+        pass
+
+    def result(self, state: tp.Any) -> tp.Any:
+        """
+        :param state: final state
+        """
+        return state
+
+
+class Sum(Aggregator):
+    """Sum of column values"""
+
+    def __init__(self, column: str) -> None:
+        """
+        :param column: column to sum
+        """
+        self.column = column
+
+    def initial(self) -> tp.Any:
+        return 0
+
+    def update(self, state: tp.Any, row: ops.TRow) -> tp.Any:
+        return state + row[self.column]
+
+    def merge(self, state_a: tp.Any, state_b: tp.Any) -> tp.Any:
+        return state_a + state_b
+
+
+class Count(Aggregator):
+    """Number of rows"""
+
+    def initial(self) -> tp.Any:
+        return 0
+
+    def update(self, state: tp.Any, row: ops.TRow) -> tp.Any:
+        return state + 1
+
+    def merge(self, state_a: tp.Any, state_b: tp.Any) -> tp.Any:
+        return state_a + state_b
+
+
+class Min(Aggregator):
+    """Minimal column value"""
+
+    def __init__(self, column: str) -> None:
+        """
+        :param column: column to get minimum of
+        """
+        self.column = column
+
+    def initial(self) -> tp.Any:
+        return None
+
+    def update(self, state: tp.Any, row: ops.TRow) -> tp.Any:
+        value = row[self.column]
+        return value if state is None or value < state else state
+
+    def merge(self, state_a: tp.Any, state_b: tp.Any) -> tp.Any:
+        if state_a is None or state_b is None:
+            return state_b if state_a is None else state_a
+        return min(state_a, state_b)
+
+
+class Max(Aggregator):
+    """Maximal column value"""
+
+    def __init__(self, column: str) -> None:
+        """
+        :param column: column to get maximum of
+        """
+        self.column = column
+
+    def initial(self) -> tp.Any:
+        return None
+
+    def update(self, state: tp.Any, row: ops.TRow) -> tp.Any:
+        value = row[self.column]
+        return value if state is None or value > state else state
+
+    def merge(self, state_a: tp.Any, state_b: tp.Any) -> tp.Any:
+        if state_a is None or state_b is None:
+            return state_b if state_a is None else state_a
+        return max(state_a, state_b)
+
+
+class Mean(Aggregator):
+    """Arithmetic mean of column values"""
+
+    def __init__(self, column: str) -> None:
+        """
+        :param column: column to average
+        """
+        self.column = column
+
+    def initial(self) -> tp.Any:
+        return 0, 0
+
+    def update(self, state: tp.Any, row: ops.TRow) -> tp.Any:
+        return state[0] + row[self.column], state[1] + 1
+
+    def merge(self, state_a: tp.Any, state_b: tp.Any) -> tp.Any:
+        return state_a[0] + state_b[0], state_a[1] + state_b[1]
+
+    def result(self, state: tp.Any) -> tp.Any:
+        return state[0] / state[1] if state[1] else None
+
+
+class First(Aggregator):
+    """Column value of the first row"""
+
+    _EMPTY = ()
+
+    def __init__(self, column: str) -> None:
+        """
+        :param column: column to take
+        """
+        self.column = column
+
+    def initial(self) -> tp.Any:
+        return self._EMPTY
+
+    def update(self, state: tp.Any, row: ops.TRow) -> tp.Any:
+        return (row[self.column],) if state is self._EMPTY else state
+
+    def merge(self, state_a: tp.Any, state_b: tp.Any) -> tp.Any:
+        return state_b if state_a is self._EMPTY else state_a
+
+    def result(self, state: tp.Any) -> tp.Any:
+        return None if state is self._EMPTY else state[0]
+
+
+class Ratio(Aggregator):
+    """Ratio of sums of two columns, e.g. average speed as total distance over total duration;
+    None if the denominator sums to zero (e.g. only zero-duration trips)"""
+
+    def __init__(self, numerator: str, denominator: str) -> None:
+        """
+        :param numerator: column summed into numerator
+        :param denominator: column summed into denominator
+        """
+        self.numerator = numerator
+        self.denominator = denominator
+
+    def initial(self) -> tp.Any:
+        return 0, 0
+
+    def update(self, state: tp.Any, row: ops.TRow) -> tp.Any:
+        return state[0] + row[self.numerator], state[1] + row[self.denominator]
+
+    def merge(self, state_a: tp.Any, state_b: tp.Any) -> tp.Any:
+        return state_a[0] + state_b[0], state_a[1] + state_b[1]
+
+    def result(self, state: tp.Any) -> tp.Any:
+        return state[0] / state[1] if state[1] else None
+
+
+class ApproxDistinct(Aggregator):
+    """Approximate number of distinct column values, estimated by HyperLogLog sketch"""
+
+    def __init__(self, column: str, precision: int = 12) -> None:
+        """
+        :param column: column to count distinct values of
+        :param precision: sketch precision, state takes 2 ** precision bytes
+        """
+        self.column = column
+        self.precision = precision
+
+    def initial(self) -> tp.Any:
+        return HyperLogLog(self.precision)
+
+    def update(self, state: tp.Any, row: ops.TRow) -> tp.Any:
+        state.add(row[self.column])
+        return state
+
+    def merge(self, state_a: tp.Any, state_b: tp.Any) -> tp.Any:
+        return state_a.merge(state_b)
+
+    def result(self, state: tp.Any) -> tp.Any:
+        return round(state.count())
+
+
+class Aggregate(ops.Reducer):
+    """
+    Compute several named aggregates over a group in a single pass
+    Example for group_key=('a',) and aggregates={'total': Sum('b'), 'rows': Count()}
+        {'a': 1, 'b': 2}
+        {'a': 1, 'b': 3}
+        =>
+        {'a': 1, 'total': 5, 'rows': 2}
+    """
+
+    def __init__(self, aggregates: tp.Mapping[str, Aggregator]) -> None:
+        """
+        :param aggregates: result column names mapped to aggregate functions
+        """
+        self.aggregates = dict(aggregates)
+
+    def __call__(
+        self, group_key: tuple[str, ...], rows: ops.TRowsIterable
+    ) -> ops.TRowsGenerator:
+        aggregates = list(self.aggregates.values())
+        states = [aggregate.initial() for aggregate in aggregates]
+        result: ops.TRow | None = None
+        for row in rows:
+            if result is None:
+                result = {key: row[key] for key in group_key}
+            states = [aggregate.update(state, row) for aggregate, state in zip(aggregates, states)]
+        if result is None:
+            return
+
+        for name, aggregate, state in zip(self.aggregates, aggregates, states):
+            result[name] = aggregate.result(state)
+        yield result
+
+
+class HashAggregate(ops.StatefulOperation):
+    """
+    Compute named aggregates per group in a hash table instead of sorting the input first.
+    Takes memory proportional to number of groups, groups are emitted in the same order as sort would give.
+    """
+
+    def __init__(
+        self,
+        aggregates: tp.Mapping[str, Aggregator],
+        keys: tp.Sequence[str],
+        schema: Schema | None = None,
+    ) -> None:
+        """
+        :param aggregates: result column names mapped to aggregate functions
+        :param keys: keys for grouping, the whole table is a single group if empty
+        :param schema: schema of compact input rows or None for dict rows
+        """
+        self.aggregates = dict(aggregates)
+        self.keys = tuple(keys)
+        self.schema = schema
+
+    def initial_state(self) -> tp.Any:
+        return {}
+
+    def update(self, state: tp.Any, rows: ops.TRowsIterable, *args: tp.Any) -> ops.TRowsGenerator:
+        aggregates = list(self.aggregates.values())
+        get_key = key_getter(self.keys, self.schema)
+        unpack = unpacker(self.schema)
+        groups: dict[tuple[tp.Any, ...], list[tp.Any]] = state
+        for row in rows:
+            key = get_key(row)
+            states = groups.get(key)
+            if states is None:
+                states = groups[key] = [aggregate.initial() for aggregate in aggregates]
+            row = unpack(row)
+            for i, aggregate in enumerate(aggregates):
+                states[i] = aggregate.update(states[i], row)
+        yield from ()
+
+    def emit(self, state: tp.Any) -> ops.TRowsGenerator:
+        aggregates = list(self.aggregates.values())
+        for key in sorted(state, key=encode_key):
+            result = dict(zip(self.keys, key))
+            for name, aggregate, value in zip(self.aggregates, aggregates, state[key]):
+                result[name] = aggregate.result(value)
+            yield result
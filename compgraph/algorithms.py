@@ -1,4 +1,6 @@
-from . import Graph, operations
+from . import Graph, aggregates, operations
+from .distributed import Coordinator, Task
+import functools
 import typing as tp
 import math
 
@@ -8,28 +10,115 @@ def word_count_graph(
     text_column: str = "text",
     count_column: str = "count",
     parser: tp.Callable[[str], operations.TRow] | None = None,
+    encode_words: bool = False,
 ) -> Graph:
-    """Constructs graph which counts words in text_column of all rows passed"""
+    """Constructs graph which counts words in text_column of all rows passed,
+    words are sorted and counted as integer ids if encode_words is set"""
     if parser is None:
+        read_graph = Graph.graph_from_iter(input_stream_name)
+    else:
+        read_graph = Graph.graph_from_file(input_stream_name, parser)
+
+    words_graph = (
+        read_graph.map(operations.FilterPunctuation(text_column))
+        .map(operations.LowerCase(text_column))
+        .map(operations.Split(text_column))
+    )
+    if not encode_words:
         return (
-            Graph.graph_from_iter(input_stream_name)
-            .map(operations.FilterPunctuation(text_column))
-            .map(operations.LowerCase(text_column))
-            .map(operations.Split(text_column))
-            .sort([text_column])
+            words_graph.sort([text_column])
             .reduce(operations.Count(count_column), [text_column])
             .sort([count_column, text_column])
         )
+    words = operations.Dictionary()
+    return (
+        words_graph.encode([text_column], words)
+        .sort([text_column])
+        .reduce(operations.Count(count_column), [text_column])
+        .decode([text_column], words)
+        .sort([count_column, text_column])
+    )
+
+
+def word_count_partial_graph(
+    input_stream_name: str,
+    text_column: str = "text",
+    count_column: str = "count",
+    parser: tp.Callable[[str], operations.TRow] | None = None,
+) -> Graph:
+    """Constructs graph which counts words in text_column of a part of input, counts of parts are summed
+    by word_count_merge_graph"""
+    if parser is None:
+        read_graph = Graph.graph_from_iter(input_stream_name)
     else:
-        return (
-            Graph.graph_from_file(input_stream_name, parser)
-            .map(operations.FilterPunctuation(text_column))
-            .map(operations.LowerCase(text_column))
-            .map(operations.Split(text_column))
-            .sort([text_column])
-            .reduce(operations.Count(count_column), [text_column])
-            .sort([count_column, text_column])
+        read_graph = Graph.graph_from_file(input_stream_name, parser)
+
+    return (
+        read_graph.map(operations.FilterPunctuation(text_column))
+        .map(operations.LowerCase(text_column))
+        .map(operations.Split(text_column))
+        .sort([text_column])
+        .reduce(operations.Count(count_column), [text_column])
+    )
+
+
+def word_count_merge_graph(
+    input_stream_name: str, text_column: str = "text", count_column: str = "count"
+) -> Graph:
+    """Constructs graph which sums word counts of parts of input given by word_count_partial_graph"""
+    return (
+        Graph.graph_from_iter(input_stream_name)
+        .sort([text_column])
+        .reduce(operations.Sum(count_column), [text_column])
+    )
+
+
+def distributed_word_count(
+    coordinator: Coordinator,
+    filenames: tp.Sequence[str],
+    text_column: str = "text",
+    count_column: str = "count",
+    parser: tp.Callable[[str], operations.TRow] = operations.json_parser,
+    shuffle_directory: str | None = None,
+) -> operations.TRowsGenerator:
+    """Counts words in text_column of files read by workers (every file is counted by one task,
+    word counts are partitioned over workers to be summed, through shuffle_directory if passed),
+    result is the same as of word_count_graph"""
+    map_tasks = [
+        Task(
+            word_count_partial_graph,
+            {"input_stream_name": filename, "text_column": text_column, "count_column": count_column, "parser": parser},
         )
+        for filename in filenames
+    ]
+    merge = functools.partial(word_count_merge_graph, "counts", text_column, count_column)
+    graph = Graph.graph_from_map_reduce(
+        coordinator, map_tasks, [text_column], merge, "counts", shuffle_directory=shuffle_directory
+    ).sort([count_column, text_column])
+    yield from graph.run()
+
+
+def approximate_word_count_graph(
+    input_stream_name: str,
+    text_column: str = "text",
+    count_column: str = "count",
+    top: int = 1000,
+    capacity: int | None = None,
+    parser: tp.Callable[[str], operations.TRow] | None = None,
+) -> Graph:
+    """Constructs graph which approximately counts top most frequent words in text_column of all rows passed
+    in fixed memory, the most frequent first; count_column + '_error' bounds overestimation of every count"""
+    if parser is None:
+        read_graph = Graph.graph_from_iter(input_stream_name)
+    else:
+        read_graph = Graph.graph_from_file(input_stream_name, parser)
+
+    return (
+        read_graph.map(operations.FilterPunctuation(text_column))
+        .map(operations.LowerCase(text_column))
+        .map(operations.Split(text_column))
+        .heavy_hitters([text_column], top, capacity, count_column, count_column + "_error")
+    )
 
 
 def inverted_index_graph(
@@ -38,8 +127,12 @@ def inverted_index_graph(
     text_column: str = "text",
     result_column: str = "tf_idf",
     parser: tp.Callable[[str], operations.TRow] | None = None,
+    sort_workers: int | None = None,
+    encode_words: bool = False,
 ) -> Graph:
-    """Constructs graph which calculates td-idf for every word/document pair"""
+    """Constructs graph which calculates td-idf for every word/document pair,
+    sorts run in sort_workers processes if passed; if encode_words is set, words are sorted and joined
+    as integer ids and results of a word come together, but not in order of words"""
     count = "count"
     doc_count = "doc_count"
     idf = "idf"
@@ -54,33 +147,39 @@ def inverted_index_graph(
         operations.LowerCase(text_column)
     )
     split_words_graph = preprocess_graph.map(operations.Split(text_column))
+    words: operations.Dictionary | None = None
+    if encode_words:
+        words = operations.Dictionary()
+        split_words_graph = split_words_graph.encode([text_column], words)
     count_docs_graph = (
-        read_graph.sort([doc_column])
+        read_graph.sort([doc_column], sort_workers)
         .reduce(operations.FirstReducer(), [doc_column])
         .reduce(operations.Count(count), [])
     )
     count_idf_graph = (
-        split_words_graph.sort([doc_column, text_column])
+        split_words_graph.sort([doc_column, text_column], sort_workers)
         .reduce(operations.FirstReducer(), keys=[doc_column, text_column])
-        .sort([text_column])
+        .sort([text_column], sort_workers)
         .reduce(operations.Count(doc_count), keys=[text_column])
-        .join(operations.InnerJoiner(), count_docs_graph, keys=[])
+        .with_scalar(count_docs_graph)
         .map(
             operations.BinaryOperation(
                 lambda row: math.log(row[count] / row[doc_count]), idf
             )
         )
     )
-    tf_graph = split_words_graph.sort([doc_column]).reduce(
+    tf_graph = split_words_graph.sort([doc_column], sort_workers).reduce(
         operations.TermFrequency(text_column), [doc_column]
     )
     tf_idf_graph = (
-        tf_graph.sort([text_column])
+        tf_graph.sort([text_column], sort_workers)
         .join(operations.InnerJoiner(), count_idf_graph, keys=[text_column])
         .map(operations.Product([idf, tf], result_column))
         .map(operations.Project([doc_column, text_column, result_column]))
         .reduce(operations.TopN(result_column, 3), [text_column])
     )
+    if words is not None:
+        tf_idf_graph = tf_idf_graph.decode([text_column], words)
     return tf_idf_graph
 
 
@@ -111,7 +210,10 @@ def pmi_graph(
         .map(operations.Filter(lambda row: row[doc_tf] > 1))
     )
     filtered_graph = split_graph.sort([doc_column, text_column]).join(
-        operations.InnerJoiner(), freq_graph, [doc_column, text_column]
+        operations.InnerJoiner(),
+        freq_graph,
+        [doc_column, text_column],
+        bloom_filter_fpr=0.01,
     )
     doc_tf_graph = filtered_graph.reduce(
         operations.TermFrequency(text_column, doc_tf), [doc_column]
@@ -130,8 +232,7 @@ def pmi_graph(
             )
         )
         .map(operations.Project([doc_column, text_column, result_column]))
-        .sort([doc_column])
-        .reduce(operations.TopN(result_column, 10), [doc_column])
+        .top_k(result_column, 10, group_by=[doc_column])
     )
 
     return calc_pmi_graph
@@ -149,8 +250,10 @@ def yandex_maps_graph(
     hour_result_column: str = "hour",
     speed_result_column: str = "speed",
     parser: tp.Callable[[str], operations.TRow] | None = None,
+    sort_workers: int | None = None,
 ) -> Graph:
-    """Constructs graph which measures average speed in km/h depending on the weekday and hour"""
+    """Constructs graph which measures average speed in km/h depending on the weekday and hour,
+    sorts run in sort_workers processes if passed"""
     distance_col = "distance"
     duration_column = "duration"
 
@@ -167,8 +270,8 @@ def yandex_maps_graph(
                 edge_id_column, start_coord_column, end_coord_column, distance_col
             )
         )
-        .map(operations.Project([edge_id_column, distance_col]))
-        .sort([edge_id_column])
+        .with_schema([edge_id_column, distance_col])
+        .sort([edge_id_column], sort_workers)
     )
     graph_duration = (
         graph_travel_times.map(
@@ -181,50 +284,106 @@ def yandex_maps_graph(
                 duration_column,
             )
         )
-        .map(
-            operations.Project(
-                [
-                    edge_id_column,
-                    weekday_result_column,
-                    hour_result_column,
-                    duration_column,
-                ]
-            )
+        .with_schema(
+            [
+                edge_id_column,
+                weekday_result_column,
+                hour_result_column,
+                duration_column,
+            ]
         )
-        .sort([edge_id_column])
+        .sort([edge_id_column], sort_workers)
     )
 
-    joint_graph = graph_duration.join(
-        operations.InnerJoiner(), graph_distance, [edge_id_column]
-    ).sort([weekday_result_column, hour_result_column])
+    speed_graph = (
+        graph_duration.join(operations.InnerJoiner(), graph_distance, [edge_id_column])
+        .with_schema(
+            [
+                weekday_result_column,
+                hour_result_column,
+                duration_column,
+                distance_col,
+            ]
+        )
+        .sort([weekday_result_column, hour_result_column], sort_workers)
+        .reduce(
+            aggregates.Aggregate(
+                {speed_result_column: aggregates.Ratio(distance_col, duration_column)}
+            ),
+            [weekday_result_column, hour_result_column],
+        )
+    )
 
-    duration_graph = joint_graph.reduce(
-        operations.Sum(duration_column),
-        [edge_id_column, weekday_result_column, hour_result_column],
-    ).sort([edge_id_column, weekday_result_column, hour_result_column])
+    return speed_graph
 
-    distance_graph = joint_graph.reduce(
-        operations.Sum(distance_col),
-        [edge_id_column, weekday_result_column, hour_result_column],
-    ).sort([edge_id_column, weekday_result_column, hour_result_column])
 
-    speed_graph = (
-        duration_graph.join(
-            operations.InnerJoiner(),
-            distance_graph,
-            [edge_id_column, weekday_result_column, hour_result_column],
-        )
-        .map(
+def edge_speed_windows_graph(
+    input_stream_name_time: str,
+    input_stream_name_length: str,
+    enter_time_column: str = "enter_time",
+    leave_time_column: str = "leave_time",
+    edge_id_column: str = "edge_id",
+    start_coord_column: str = "start",
+    end_coord_column: str = "end",
+    speed_result_column: str = "speed",
+    window: float = 3600,
+    slide: float | None = None,
+    allowed_lateness: float = 0.0,
+    parser: tp.Callable[[str], operations.TRow] | None = None,
+) -> Graph:
+    """Constructs graph which measures average speed in km/h of every edge in event-time windows of enter time
+    (hourly tumbling windows by default, sliding if slide is passed). Travel times are a stream in order of time
+    (up to allowed_lateness), only the road graph is kept in memory, nothing is sorted; results have columns
+    window_start and window_end"""
+    distance_col = "distance"
+    duration_column = "duration"
+
+    if parser is None:
+        graph_travel_times = Graph.graph_from_iter(input_stream_name_time)
+        graph_road_graph = Graph.graph_from_iter(input_stream_name_length)
+    else:
+        graph_travel_times = Graph.graph_from_file(input_stream_name_time, parser)
+        graph_road_graph = Graph.graph_from_file(input_stream_name_length, parser)
+
+    graph_distance = graph_road_graph.map(
+        operations.RoadGraphProcessor(edge_id_column, start_coord_column, end_coord_column, distance_col)
+    ).with_schema([edge_id_column, distance_col])
+    graph_duration = (
+        graph_travel_times.map(
             operations.BinaryOperation(
-                lambda row: row[distance_col] / row[duration_column],
-                speed_result_column,
-            )
-        )
-        .map(
-            operations.Project(
-                [weekday_result_column, hour_result_column, speed_result_column]
+                lambda row: (
+                    operations.parse_time(row[leave_time_column]) - operations.parse_time(row[enter_time_column])
+                ).total_seconds() / 3600,
+                duration_column,
             )
         )
+        .with_schema([edge_id_column, enter_time_column, duration_column])
     )
 
-    return speed_graph
+    return graph_duration.join(
+        operations.InnerJoiner(), graph_distance, [edge_id_column], hash_join=True
+    ).window(
+        {speed_result_column: aggregates.Ratio(distance_col, duration_column)},
+        enter_time_column,
+        window,
+        slide,
+        [edge_id_column],
+        allowed_lateness,
+    )
+
+
+def streaming_word_count_graph(
+    input_stream_name: str, text_column: str = "text", count_column: str = "count", top: int | None = None
+) -> Graph:
+    """Constructs graph which counts words in text_column for run_stream: every output has counts of all words
+    (or of top most frequent ones, the most frequent first) in rows seen so far, nothing is sorted"""
+    graph = (
+        Graph.graph_from_iter(input_stream_name)
+        .map(operations.FilterPunctuation(text_column))
+        .map(operations.LowerCase(text_column))
+        .map(operations.Split(text_column))
+        .aggregate({count_column: aggregates.Count()}, [text_column])
+    )
+    if top is not None:
+        graph = graph.top_k(count_column, top)
+    return graph
@@ -0,0 +1,100 @@
+import hashlib
+import math
+import typing as tp
+
+from . import operations as ops
+from .external_sort import ExternalSort
+from .key_codec import key_encoder
+from .schema import Schema
+from .spill import SpillBuffer
+
+
+class BloomFilter:
+    """Bloom filter over encoded keys (see key_codec), may give false positives but never false negatives"""
+
+    def __init__(self, capacity: int, false_positive_rate: float = 0.01) -> None:
+        """
+        :param capacity: expected number of added keys
+        :param false_positive_rate: desired probability of false positive for capacity keys
+        """
+        if not 0 < false_positive_rate < 1:
+            raise ValueError("false_positive_rate must be in (0, 1)")
+        capacity = max(capacity, 1)
+        self.size = max(8, math.ceil(-capacity * math.log(false_positive_rate) / math.log(2) ** 2))
+        self.hash_count = max(1, round(self.size / capacity * math.log(2)))
+        self.bits = bytearray((self.size + 7) // 8)
+
+    def _positions(self, key: bytes) -> tp.Iterator[int]:
+        digest = hashlib.blake2b(key, digest_size=16).digest()
+        first = int.from_bytes(digest[:8], "little")
+        second = int.from_bytes(digest[8:], "little") | 1
+        for i in range(self.hash_count):
+            yield (first + i * second) % self.size
+
+    def add(self, key: bytes) -> None:
+        """
+        :param key: encoded key
+        """
+        for position in self._positions(key):
+            self.bits[position >> 3] |= 1 << (position & 7)
+
+    def __contains__(self, key: bytes) -> bool:
+        return all(self.bits[position >> 3] & (1 << (position & 7)) for position in self._positions(key))
+
+
+class BloomSemiJoin(ops.Operation):
+    """
+    Join which first reads the (smaller) right table, builds Bloom filter over its keys and pushes it upstream
+    as a filter on the left table before its sort, so sort sees only rows that can have a pair.
+    Right table is buffered (spilling to disk if it is large) to be joined afterwards.
+    Applicable only to joins declaring that they drop left rows without a pair (keep_a = False: inner, right).
+    """
+
+    def __init__(
+        self,
+        joiner: ops.Joiner,
+        keys: tp.Sequence[str],
+        false_positive_rate: float,
+        sort: ExternalSort | None = None,
+        schema_a: Schema | None = None,
+        schema_b: Schema | None = None,
+    ) -> None:
+        """
+        :param joiner: join strategy to use
+        :param keys: join keys
+        :param false_positive_rate: false positive rate of Bloom filter
+        :param sort: sort of left table to push filter under, left table is already sorted if not passed
+        :param schema_a: schema of compact left rows or None for dict rows
+        :param schema_b: schema of compact right rows or None for dict rows
+        """
+        # only joiners declaring that they drop left rows without a pair (MergeJoiner.keep_a) can be pruned,
+        # other joiners may emit them
+        if getattr(joiner, "keep_a", True):
+            raise ValueError(f"{type(joiner).__name__} may keep left rows without a pair, they can't be filtered out")
+        self.joiner = joiner
+        self.keys = keys
+        self.false_positive_rate = false_positive_rate
+        self.sort = sort
+        self.schema_a = schema_a
+        self.schema_b = schema_b
+
+    def __call__(self, rows: ops.TRowsIterable, *args: tp.Any, **kwargs: tp.Any) -> ops.TRowsGenerator:
+        rows_b = SpillBuffer()
+        rows_a: ops.TRowsIterable = ()
+        try:
+            for row in args[0]:
+                rows_b.append(row)
+
+            bloom_filter = BloomFilter(len(rows_b), self.false_positive_rate)
+            encode_b = key_encoder(self.keys, self.schema_b)
+            for row in rows_b:
+                bloom_filter.add(encode_b(row))
+
+            encode_a = key_encoder(self.keys, self.schema_a)
+            rows_a = (row for row in rows if encode_a(row) in bloom_filter)
+            if self.sort is not None:
+                rows_a = self.sort(rows_a)
+            yield from self.joiner.join(self.keys, rows_a, rows_b, self.schema_a, self.schema_b)
+        finally:
+            ops.close_rows(rows_a)
+            rows_b.close()
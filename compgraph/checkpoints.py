@@ -0,0 +1,251 @@
+"""
+Stage-level checkpoints of long runs.
+
+Outputs of blocking stages (sorts, reduces, joins, aggregations, top-k) are written to a directory while
+they are consumed; once a stage has produced all of its rows, its file is made durable and recorded in
+the manifest of the directory. A later run of the same graph over the same inputs with the same directory
+reads finished stages from their files instead of computing them and everything upstream of them, so after
+a crash only unfinished stages are computed again:
+
+    rows = graph.run_checkpointed("/var/tmp/maps-job", travel_times=..., road_graph=...)
+
+Stages are identified by fingerprints of the operations with all their parameters (including code of
+functions with their closures, defaults and globals they use) and of their inputs; files read by the graph
+are identified by size and modification time, other sources by versions passed to the run. A stage with
+a parameter without stable description (e.g. a lock or an open file) is neither stored nor reused, nor are
+stages after it. A changed plan or input changes fingerprints of the stages depending
+on it, which are computed again, and files of stages not in the graph anymore are removed.
+Values of dictionaries encoding columns (see ops.Dictionary) are stored with every finished stage,
+so a later run decodes ids read from stored stages; they are kept in JSON, so they are strings or numbers.
+"""
+import json
+import os
+import pickle
+import tempfile
+import time
+import typing as tp
+
+from . import aggregates as agg
+from . import bloom
+from . import external_sort as sort
+from . import fusion
+from . import operations as ops
+from . import planner
+from . import sketches
+from .spill import SPILL_BATCH_SIZE, load_batches, sync_directory
+
+TGraph = tp.Any  # graph.Graph, not imported by name to avoid circular import
+
+MANIFEST = "manifest.json"
+
+# operations which read all (or a whole group) of their input before producing rows, their outputs are stored
+STAGES = (
+    sort.ExternalSort,
+    sort.PartialSort,
+    ops.Reduce,
+    ops.Join,
+    ops.HashJoin,
+    bloom.BloomSemiJoin,
+    agg.HashAggregate,
+    ops.TopK,
+    sketches.HeavyHitters,
+)
+
+
+def _source_version(operation: ops.Operation | None, versions: tp.Mapping[str, str]) -> str:
+    if isinstance(operation, ops.Read):
+        status = os.stat(operation.filename)
+        return f"{status.st_size}:{status.st_mtime_ns}"
+    if isinstance(operation, ops.ReadIterFactory):
+        return versions.get(operation.name, "")
+    return ""
+
+
+def fingerprints(graph: TGraph, versions: tp.Mapping[str, str] | None = None) -> dict[int, str | None]:
+    """Fingerprints of all nodes of graph by node id including versions of their sources (see planner.fingerprints);
+    outputs of nodes without fingerprint are neither stored nor reused
+    :param graph: graph
+    :param versions: versions of data sources by name
+    """
+    return planner.fingerprints(graph, lambda operation: _source_version(operation, versions or {}))
+
+
+def _dictionaries(graph: TGraph) -> list[ops.Dictionary]:
+    """Dictionaries of all mappers of graph in the order of nodes"""
+    result: dict[int, ops.Dictionary] = {}
+    for node in planner._nodes(graph):
+        op = node.operation
+        mappers = [op.mapper] if isinstance(op, ops.Map) else op.mappers if isinstance(op, fusion.FusedMap) else []
+        for mapper in mappers:
+            if isinstance(mapper, ops.Recode):
+                result.setdefault(id(mapper.dictionary), mapper.dictionary)
+    return list(result.values())
+
+
+def _write_durably(path: str, content: bytes) -> None:
+    """Write content to file next to path, flush it to disk and move it to path"""
+    directory = os.path.dirname(path)
+    descriptor, temporary = tempfile.mkstemp(dir=directory, suffix=".tmp")
+    try:
+        with os.fdopen(descriptor, "wb") as file:
+            file.write(content)
+            file.flush()
+            os.fsync(file.fileno())
+        os.replace(temporary, path)
+    except BaseException:
+        os.unlink(temporary)
+        raise
+    sync_directory(directory)
+
+
+class Manifest:
+    """Finished stages of a checkpoint directory: fingerprint -> {'operation', 'rows'},
+    and values of dictionaries of the graph when the last of them was finished"""
+
+    def __init__(self, directory: str) -> None:
+        """
+        :param directory: checkpoint directory, created if it doesn't exist
+        """
+        os.makedirs(directory, exist_ok=True)
+        self.directory = directory
+        self.opened = time.time()
+        self.stages: dict[str, dict[str, tp.Any]] = {}
+        self.dictionaries: list[list[tp.Any]] = []
+        path = os.path.join(directory, MANIFEST)
+        if os.path.exists(path):
+            with open(path) as file:
+                content = json.load(file)
+            self.stages, self.dictionaries = content["stages"], content.get("dictionaries", [])
+
+    def path(self, fingerprint: str) -> str:
+        """File with output of stage"""
+        return os.path.join(self.directory, f"{fingerprint}.rows")
+
+    def finished(self, fingerprint: str) -> bool:
+        """Whether stage is recorded and its file exists"""
+        return fingerprint in self.stages and os.path.exists(self.path(fingerprint))
+
+    def record(
+        self, fingerprint: str, operation: str, rows: int, dictionaries: tp.Sequence[ops.Dictionary] = ()
+    ) -> None:
+        """Record finished stage, its file must be durable already
+        :param dictionaries: dictionaries encoding values of stored rows
+        """
+        self.stages[fingerprint] = {"operation": operation, "rows": rows}
+        self.dictionaries = [list(dictionary.values) for dictionary in dictionaries]
+        self._save()
+
+    def prune(self, fingerprints: tp.Collection[str]) -> None:
+        """Remove stages not in fingerprints and their files together with files of stages left unfinished
+        before this manifest was opened; temporary files written since then may belong to a concurrent run"""
+        self.stages = {key: value for key, value in self.stages.items() if key in fingerprints}
+        if not self.stages:
+            self.dictionaries = []
+        self._save()
+        for name in os.listdir(self.directory):
+            stem, extension = os.path.splitext(name)
+            path = os.path.join(self.directory, name)
+            try:
+                if (extension == ".rows" and stem not in self.stages) or (
+                    extension == ".tmp" and os.stat(path).st_mtime < self.opened
+                ):
+                    os.unlink(path)
+            except FileNotFoundError:  # removed by a concurrent run
+                pass
+
+    def _save(self) -> None:
+        content = json.dumps({"stages": self.stages, "dictionaries": self.dictionaries}, sort_keys=True).encode()
+        _write_durably(os.path.join(self.directory, MANIFEST), content)
+
+
+def _store(
+    rows: tp.Iterator[tp.Any],
+    manifest: Manifest,
+    fingerprint: str,
+    operation: str,
+    dictionaries: tp.Sequence[ops.Dictionary],
+) -> ops.TRowsGenerator:
+    """Pass rows through writing them to the file of stage, which is recorded once all rows are passed;
+    nothing is recorded if rows are not read to the end"""
+    descriptor, temporary = tempfile.mkstemp(dir=manifest.directory, suffix=".tmp")
+    completed = False
+    try:
+        with os.fdopen(descriptor, "wb") as file:
+            count = 0
+            for batch in ops.batches(rows, SPILL_BATCH_SIZE):
+                pickle.dump(batch, file, pickle.HIGHEST_PROTOCOL)
+                count += len(batch)
+                yield from batch
+            file.flush()
+            os.fsync(file.fileno())
+        # equal stages of one run (a node read by several consumers) may finish in any order, all files are equal
+        os.replace(temporary, manifest.path(fingerprint))
+        sync_directory(manifest.directory)
+        completed = True
+        manifest.record(fingerprint, operation, count, dictionaries)
+    finally:
+        if not completed:
+            os.unlink(temporary)
+
+
+def _load(manifest: Manifest, fingerprint: str) -> ops.TRowsGenerator:
+    with open(manifest.path(fingerprint), "rb") as file:
+        yield from load_batches(file)
+
+
+def run(
+    graph: TGraph, directory: str, versions: tp.Mapping[str, str] | None = None, **kwargs: tp.Any
+) -> ops.TRowsGenerator:
+    """Run graph as Graph.run does, storing outputs of finished stages in directory and reading outputs
+    stored by previous runs instead of computing them (see module docstring)
+    :param graph: graph to run
+    :param directory: checkpoint directory
+    :param versions: versions of data sources passed as kwargs by name, e.g. dates of logs; a stage depending
+        on a source is computed again once its version changes
+    :param kwargs: data sources
+    """
+    manifest = Manifest(directory)
+    node_fingerprints = fingerprints(graph, versions)
+    dictionaries = _dictionaries(graph)
+    stored = manifest.dictionaries
+    if len(stored) != len(dictionaries) or any(
+        values[:len(dictionary)] != dictionary.values[:len(values)] for dictionary, values in zip(dictionaries, stored)
+    ):
+        # ids of stored rows mean other values in this run
+        manifest.prune(())
+    else:
+        manifest.prune({fingerprint for fingerprint in node_fingerprints.values() if fingerprint is not None})
+        for dictionary, values in zip(dictionaries, manifest.dictionaries):
+            if len(values) > len(dictionary):
+                dictionary.extend(values)
+
+    def execute(node: TGraph) -> ops.TRowsGenerator:
+        op = node.operation
+        if op is None:
+            raise TypeError
+        # fingerprint of a stage whose output is stored
+        stage = node_fingerprints[id(node)] if isinstance(op, STAGES) else None
+        if stage is not None and manifest.finished(stage):
+            yield from _load(manifest, stage)
+            return
+        if not node.graphs:
+            yield from op(**kwargs)
+            return
+        inputs = [execute(child) for child in node.graphs]
+        try:
+            if stage is not None:
+                yield from _store(op(*inputs), manifest, stage, planner.describe(op), dictionaries)
+            else:
+                yield from op(*inputs)
+        finally:
+            for rows in inputs:
+                ops.close_rows(rows)
+
+    rows = execute(graph)
+    try:
+        if graph.schema is None:
+            yield from rows
+        else:
+            yield from map(graph.schema.unpack, rows)
+    finally:
+        rows.close()
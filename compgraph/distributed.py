@@ -0,0 +1,402 @@
+"""
+Coordinator/worker execution of graphs over TCP (multiprocessing.connection).
+
+Graphs are not shipped themselves (mappers are often lambdas), instead a task refers to a graph factory:
+a module-level function building the graph, which is pickled by reference and imported by the worker.
+Data moves in pickled batches of rows: task inputs from coordinator to worker, task outputs back,
+optionally hash-partitioned by keys on the worker. Output of map tasks is shuffled on disk (see shuffle):
+by default the coordinator writes partitioned batches of map tasks into a shuffle in a temporary directory
+and streams every partition to its reduce task, so it keeps only a few batches in memory. With a shuffle
+directory on a filesystem shared by workers, map tasks write partitions there themselves and reduce tasks
+read them there, so shuffled rows don't pass through the coordinator at all.
+
+    with LocalCluster(4) as cluster:
+        rows = cluster.coordinator().map_reduce(map_tasks, ['text'], merge_counts)
+
+Graph.graph_from_map_reduce makes map-reduce a source of a graph running locally on its output.
+"""
+import io
+import multiprocessing
+import os
+import queue
+import tempfile
+import threading
+import traceback
+import typing as tp
+
+from multiprocessing.connection import Client, Connection, Listener
+
+from . import operations as ops
+from .schema import key_getter
+from .shuffle import Shuffle, ShufflePartition, ShuffleWriter
+from .sketches import hash64
+from .spill import SPILL_BATCH_SIZE, SpillBuffer
+
+TAddress = tuple[str, int]
+TGraphFactory = tp.Callable[..., tp.Any]  # returning graph.Graph, not imported by name to avoid circular import
+
+
+class TaskError(RuntimeError):
+    """Graph of a task failed on a worker, message contains remote traceback"""
+
+
+class Task:
+    """Run of a graph built by factory(**kwargs) on a worker"""
+
+    def __init__(
+        self,
+        factory: TGraphFactory,
+        kwargs: tp.Mapping[str, tp.Any] | None = None,
+        inputs: tp.Mapping[str, tp.Iterable[ops.TRow]] | None = None,
+    ) -> None:
+        """
+        :param factory: module-level function building the graph
+        :param kwargs: arguments of factory, e.g. name of file to read on the worker
+        :param inputs: rows of graph sources (graph_from_iter names) sent from coordinator,
+            must be iterable again if the task is retried on another worker; shuffle partitions are
+            read by the worker itself
+        """
+        self.factory = factory
+        self.kwargs = dict(kwargs or {})
+        self.inputs = dict(inputs or {})
+
+
+def _send_batches(connection: Connection, tag: tp.Any, rows: tp.Iterable[tp.Any]) -> None:
+    batch: list[tp.Any] = []
+    for row in rows:
+        batch.append(row)
+        if len(batch) >= SPILL_BATCH_SIZE:
+            connection.send(("rows", tag, batch))
+            batch = []
+    if batch:
+        connection.send(("rows", tag, batch))
+
+
+def _run_task(connection: Connection, message: tp.Any) -> None:
+    _, factory, kwargs, keys, partitions, shuffle, map_id = message
+    buffers: dict[str, SpillBuffer] = {}
+    sources: dict[str, tp.Iterable[ops.TRow]] = {}
+    try:
+        while True:
+            message = connection.recv()
+            if message[0] == "run":
+                break
+            if message[0] == "partition":
+                sources[message[1]] = message[2]
+            else:
+                if message[1] not in buffers:
+                    sources[message[1]] = buffers[message[1]] = SpillBuffer()
+                buffers[message[1]].extend(message[2])
+
+        graph = factory(**kwargs)
+        rows = graph.run(**{name: (lambda source=source: iter(source)) for name, source in sources.items()})
+        if shuffle is not None:
+            with shuffle.writer(map_id) as writer:
+                writer.write_all(rows)
+        elif partitions <= 1:
+            _send_batches(connection, 0, rows)
+        else:
+            get_key = key_getter(keys)
+            batches: list[list[ops.TRow]] = [[] for _ in range(partitions)]
+            for row in rows:
+                partition = hash64(get_key(row)) % partitions
+                batch = batches[partition]
+                batch.append(row)
+                if len(batch) >= SPILL_BATCH_SIZE:
+                    connection.send(("rows", partition, batch))
+                    batches[partition] = []
+            for partition, batch in enumerate(batches):
+                if batch:
+                    connection.send(("rows", partition, batch))
+        connection.send(("done",))
+    except Exception:
+        connection.send(("error", traceback.format_exc()))
+    finally:
+        for buffer in buffers.values():
+            buffer.close()
+
+
+def serve(listener: Listener) -> None:
+    """Execute tasks sent by coordinators, connections are served one after another
+    :param listener: listener accepting coordinator connections
+    """
+    while True:
+        with listener.accept() as connection:
+            try:
+                while True:
+                    _run_task(connection, connection.recv())
+            except (EOFError, OSError):
+                pass
+
+
+def serve_forever(address: TAddress, authkey: bytes) -> None:
+    """Run worker listening on address
+    :param address: (host, port) to listen on
+    :param authkey: secret shared with coordinator
+    """
+    with Listener(address, authkey=authkey) as listener:
+        serve(listener)
+
+
+class Coordinator:
+    """
+    Runs tasks on workers in parallel, one task per worker at a time. A task is retried on another worker
+    if its worker is lost (connection breaks); errors raised by the graph itself are not retried.
+    """
+
+    def __init__(self, addresses: tp.Sequence[TAddress], authkey: bytes) -> None:
+        """
+        :param addresses: (host, port) of workers
+        :param authkey: secret shared with workers
+        """
+        self.addresses = list(addresses)
+        self.authkey = authkey
+
+    def _attempt(
+        self,
+        connection: Connection,
+        task: Task,
+        keys: tp.Sequence[str],
+        partitions: int,
+        shuffle: Shuffle | None,
+        shared: bool,
+        map_id: int,
+    ) -> list[SpillBuffer]:
+        outputs = [SpillBuffer() for _ in range(partitions if shuffle is None else 0)]
+        writer: ShuffleWriter | None = None
+        try:
+            if shuffle is not None and not shared:
+                # worker partitions rows by the same hash as the writer, batches are appended to the files as they are
+                writer = shuffle.writer(map_id, io.DEFAULT_BUFFER_SIZE)
+                connection.send(("task", task.factory, task.kwargs, shuffle.keys, shuffle.partitions, None, map_id))
+            else:
+                connection.send(("task", task.factory, task.kwargs, tuple(keys), partitions, shuffle, map_id))
+            for name, rows in task.inputs.items():
+                if isinstance(rows, ShufflePartition):
+                    connection.send(("partition", name, rows))
+                else:
+                    _send_batches(connection, name, rows)
+            connection.send(("run",))
+            while True:
+                message = connection.recv()
+                if message[0] == "done":
+                    if writer is not None:
+                        writer.commit()
+                    return outputs
+                if message[0] == "error":
+                    raise TaskError(message[1])
+                if writer is not None:
+                    writer.write_partition(message[1], message[2])
+                else:
+                    outputs[message[1]].extend(message[2])
+        except BaseException:
+            if writer is not None:
+                writer.abort()
+            for output in outputs:
+                output.close()
+            raise
+
+    def run_tasks(
+        self,
+        tasks: tp.Sequence[Task],
+        keys: tp.Sequence[str] = (),
+        partitions: int = 1,
+        shuffle: Shuffle | None = None,
+        shared: bool = True,
+    ) -> list[list[SpillBuffer]]:
+        """Run tasks and collect their outputs
+        :param tasks: tasks to run
+        :param keys: keys to hash-partition output rows by
+        :param partitions: number of output partitions of every task
+        :param shuffle: if passed, output of task i is written to shuffle as output of map task i instead
+        :param shared: whether shuffle is on a filesystem shared with workers, so they write to it themselves,
+            otherwise workers send partitioned rows and the coordinator writes them
+        :return: output partitions of every task (none if shuffle is passed), buffers must be closed by caller
+        """
+        pending: "queue.Queue[int]" = queue.Queue()
+        for index in range(len(tasks)):
+            pending.put(index)
+        results: list[list[SpillBuffer] | None] = [None] * len(tasks)
+        errors: list[BaseException] = []
+        alive = list(self.addresses)
+
+        def work(address: TAddress) -> None:
+            try:
+                connection = Client(address, authkey=self.authkey)
+            except OSError:
+                alive.remove(address)
+                return
+            with connection:
+                while not errors:
+                    try:
+                        index = pending.get_nowait()
+                    except queue.Empty:
+                        return
+                    try:
+                        results[index] = self._attempt(
+                            connection, tasks[index], keys, partitions, shuffle, shared, index
+                        )
+                    except (EOFError, OSError):
+                        pending.put(index)
+                        alive.remove(address)
+                        return
+                    except BaseException as error:
+                        errors.append(error)
+                        return
+
+        try:
+            while not pending.empty() and alive and not errors:
+                threads = [threading.Thread(target=work, args=(address,), daemon=True) for address in alive]
+                for thread in threads:
+                    thread.start()
+                for thread in threads:
+                    thread.join()
+            if errors:
+                raise errors[0]
+            if not pending.empty():
+                raise ConnectionError("All workers are lost")
+        except BaseException:
+            for outputs in results:
+                for output in outputs or []:
+                    output.close()
+            raise
+        return [outputs for outputs in results if outputs is not None]
+
+    def run(self, tasks: tp.Sequence[Task]) -> ops.TRowsGenerator:
+        """Run tasks in parallel and yield their output rows in order of tasks
+        :param tasks: tasks to run
+        """
+        results = self.run_tasks(tasks)
+        try:
+            for outputs in results:
+                for output in outputs:
+                    yield from output
+        finally:
+            for outputs in results:
+                for output in outputs:
+                    output.close()
+
+    def map_reduce(
+        self,
+        map_tasks: tp.Sequence[Task],
+        keys: tp.Sequence[str],
+        reduce_factory: TGraphFactory,
+        reduce_source: str = "input",
+        partitions: int | None = None,
+        shuffle_directory: str | None = None,
+    ) -> ops.TRowsGenerator:
+        """Run map tasks, shuffle their output by hash of keys and run graph built by reduce_factory on every
+        partition, so all rows with the same key are reduced by the same task. Rows of partitions are yielded
+        one partition after another, order of partitions doesn't follow order of keys
+        :param map_tasks: tasks producing rows to reduce
+        :param keys: keys to partition rows by
+        :param reduce_factory: module-level function building reduce graph reading rows from reduce_source
+        :param reduce_source: name of reduce graph source
+        :param partitions: number of reduce tasks, the number of workers by default
+        :param shuffle_directory: directory on filesystem shared by workers to shuffle rows through, rows are
+            shuffled through a temporary directory of the coordinator if not passed; removed afterwards
+        """
+        partitions = partitions or len(self.addresses)
+        shared = shuffle_directory is not None
+        shuffle = Shuffle(shuffle_directory or tempfile.mkdtemp(prefix="compgraph-shuffle-"), keys, partitions)
+        try:
+            self.run_tasks(map_tasks, shuffle=shuffle, shared=shared)
+            reduce_inputs: list[tp.Iterable[ops.TRow]] = []
+            for partition in range(partitions):
+                rows = shuffle.partition(partition, len(map_tasks))
+                reduce_inputs.append(rows if shared else _Sent(rows))
+            yield from self.run([Task(reduce_factory, inputs={reduce_source: rows}) for rows in reduce_inputs])
+        finally:
+            shuffle.cleanup()
+
+
+class _Sent:
+    """Re-iterable rows of a shuffle partition on the coordinator's disk, sent to worker instead of being read by it"""
+
+    def __init__(self, rows: ShufflePartition) -> None:
+        self.rows = rows
+
+    def __iter__(self) -> tp.Iterator[ops.TRow]:
+        return iter(self.rows)
+
+
+class MapReduce(ops.Operation):
+    """Rows of Coordinator.map_reduce, computed on workers while the graph runs"""
+
+    def __init__(
+        self,
+        coordinator: Coordinator,
+        map_tasks: tp.Sequence[Task],
+        keys: tp.Sequence[str],
+        reduce_factory: TGraphFactory,
+        reduce_source: str = "input",
+        partitions: int | None = None,
+        shuffle_directory: str | None = None,
+    ) -> None:
+        """
+        :param coordinator: coordinator running tasks
+        :param map_tasks: tasks producing rows to reduce
+        :param keys: keys to partition rows by
+        :param reduce_factory: module-level function building reduce graph reading rows from reduce_source
+        :param reduce_source: name of reduce graph source
+        :param partitions: number of reduce tasks, the number of workers by default
+        :param shuffle_directory: directory on filesystem shared by workers to shuffle rows through
+        """
+        self.coordinator = coordinator
+        self.map_tasks = map_tasks
+        self.keys = keys
+        self.reduce_factory = reduce_factory
+        self.reduce_source = reduce_source
+        self.partitions = partitions
+        self.shuffle_directory = shuffle_directory
+
+    def __call__(self, *args: tp.Any, **kwargs: tp.Any) -> ops.TRowsGenerator:
+        yield from self.coordinator.map_reduce(
+            self.map_tasks, self.keys, self.reduce_factory, self.reduce_source, self.partitions, self.shuffle_directory
+        )
+
+
+def _serve_local(endpoint: Connection, authkey: bytes) -> None:
+    with Listener(("127.0.0.1", 0), authkey=authkey) as listener:
+        endpoint.send(listener.address)
+        endpoint.close()
+        serve(listener)
+
+
+class LocalCluster:
+    """Workers listening on localhost in separate processes, for tests and single-machine runs"""
+
+    def __init__(self, workers: int, authkey: bytes | None = None) -> None:
+        """
+        :param workers: number of worker processes
+        :param authkey: secret shared with workers, random by default
+        """
+        self.authkey = authkey if authkey is not None else os.urandom(16)
+        self.processes: list[multiprocessing.Process] = []
+        self.addresses: list[TAddress] = []
+        for _ in range(workers):
+            local_endpoint, remote_endpoint = multiprocessing.Pipe()
+            # not a daemon: workers start sort processes of their own
+            process = multiprocessing.Process(target=_serve_local, args=(remote_endpoint, self.authkey))
+            process.start()
+            remote_endpoint.close()
+            self.addresses.append(local_endpoint.recv())
+            local_endpoint.close()
+            self.processes.append(process)
+
+    def coordinator(self) -> Coordinator:
+        """Coordinator running tasks on workers of the cluster"""
+        return Coordinator(self.addresses, self.authkey)
+
+    def close(self) -> None:
+        """Stop all workers"""
+        for process in self.processes:
+            process.terminate()
+        for process in self.processes:
+            process.join()
+
+    def __enter__(self) -> "LocalCluster":
+        return self
+
+    def __exit__(self, *exc_info: tp.Any) -> None:
+        self.close()
@@ -1,49 +1,335 @@
+import heapq
+import tempfile
 import typing as tp
 
-from multiprocessing import Pipe, Process, connection
+from bisect import bisect_right
+from itertools import chain, islice
+from multiprocessing import connection
 from operator import itemgetter
 
 from . import operations as ops
+from . import runtime
+from .key_codec import TKeyEncoder, items_encoder, key_encoder
+from .schema import Schema
+from .spill import SPILL_BATCH_SIZE, dump_batches, load_batches
+from .stats import split_points
 
 
-def do_sort(endpoint: connection.Connection, keys: tuple[str, ...]) -> None:
-    rows = []
+DEFAULT_RUN_SIZE = 1 << 20
+DEFAULT_SAMPLE_SIZE = 1 << 16
+MAX_PARTIAL_SORT_ROWS = DEFAULT_RUN_SIZE
+
+TKeyedRow = tuple[bytes, tp.Any]
+
+_first = itemgetter(0)
+
+
+def spill_run(run: list[TKeyedRow]) -> tp.IO[bytes]:
+    """Write sorted run of (encoded key, row) pairs to temporary file
+    :param run: sorted run
+    """
+    file = tempfile.TemporaryFile()
+    dump_batches(run, file)
+    file.seek(0)
+    return file
+
+
+def read_run(file: tp.IO[bytes]) -> tp.Generator[TKeyedRow, None, None]:
+    """Read run written by spill_run, file is closed afterwards
+    :param file: file with spilled run
+    """
+    with file:
+        yield from load_batches(file)
+
+
+def sort_rows(
+    rows: tp.Iterable[tp.Any], keys: tp.Sequence[tp.Any], run_size: int = DEFAULT_RUN_SIZE
+) -> tp.Iterator[tp.Any]:
+    """Stable sort by order-preserving encoded keys. Key of every row is encoded once; runs of run_size rows
+    are sorted and spilled to disk together with their keys and then merged without re-deriving keys
+    :param rows: rows to sort
+    :param keys: column names for dict rows or positions for compact rows
+    :param run_size: maximum number of rows kept in memory
+    """
+    encode = items_encoder(keys)
+    return sort_keyed_rows(((encode(row), row) for row in rows), run_size)
+
+
+def sort_keyed_rows(keyed_rows: tp.Iterable[TKeyedRow], run_size: int = DEFAULT_RUN_SIZE) -> tp.Iterator[tp.Any]:
+    """Stable sort of (encoded key, row) pairs by key, yields rows only
+    :param keyed_rows: pairs to sort
+    :param run_size: maximum number of rows kept in memory
+    """
+    runs: list[tp.IO[bytes]] = []
+    run: list[TKeyedRow] = []
+    for keyed_row in keyed_rows:
+        run.append(keyed_row)
+        if len(run) >= run_size:
+            run.sort(key=_first)
+            runs.append(spill_run(run))
+            run = []
+    run.sort(key=_first)
+    if not runs:
+        return map(itemgetter(1), run)
+    return map(itemgetter(1), heapq.merge(*map(read_run, runs), run, key=_first))
+
+
+def _receive_batches(endpoint: connection.Connection) -> tp.Generator[tp.Any, None, None]:
     while True:
-        row = endpoint.recv()
-        if row is None:
-            break
-        rows.append(row)
-    rows.sort(key=itemgetter(*keys))
+        batch = endpoint.recv()
+        if batch is None:
+            return
+        yield from batch
+
+
+def _send_batches(endpoint: connection.Connection, rows: tp.Iterable[tp.Any]) -> None:
+    """Send rows in batches followed by None"""
+    batch: list[tp.Any] = []
     for row in rows:
-        endpoint.send(row)
+        batch.append(row)
+        if len(batch) >= SPILL_BATCH_SIZE:
+            endpoint.send(batch)
+            batch = []
+    if batch:
+        endpoint.send(batch)
     endpoint.send(None)
 
 
+def do_sort(
+    endpoint: connection.Connection, keys: tp.Sequence[tp.Any], run_size: int = DEFAULT_RUN_SIZE
+) -> None:
+    """Sort batches of rows received from endpoint and send sorted rows back in batches"""
+    _send_batches(endpoint, sort_rows(_receive_batches(endpoint), keys, run_size))
+
+
 class ExternalSort(ops.Operation):
     """
     In order to not account materialization during sorting in main process memory consumption, we delegate
     sorting to a separate process.
     This class illustrates cross-process streaming.
+    Rows are ordered by order-preserving binary encoding of keys (see key_codec), sorted runs are spilled to disk.
+    """
+
+    def __init__(
+        self, keys: tp.Sequence[str], schema: Schema | None = None, run_size: int = DEFAULT_RUN_SIZE
+    ):
+        """
+        :param keys: sorting keys
+        :param schema: schema of compact rows (sorted by positions of keys) or None for dict rows
+        :param run_size: maximum number of rows sorted in memory before spilling to disk
+        """
+        self.keys = keys
+        self.schema = schema
+        self.run_size = run_size
+
+    def __call__(self, rows: ops.TRowsIterable, *args: tp.Any, **kwargs: tp.Any) -> ops.TRowsGenerator:
+        keys = self.keys if self.schema is None else [self.schema.position(key) for key in self.keys]
+        worker = runtime.start_task(do_sort, keys, self.run_size)
+        local_endpoint = worker.connection
+        completed = False
+        try:
+            # rows are passed in batches: a pipe round trip per row costs more than sorting it
+            row_count_before = 0
+            for batch in ops.batches(rows, SPILL_BATCH_SIZE):
+                local_endpoint.send(batch)
+                row_count_before += len(batch)
+            local_endpoint.send(None)
+            row_count_after = 0
+            for local_endpoint_row in _receive_batches(local_endpoint):
+                yield local_endpoint_row
+                row_count_after += 1
+            assert row_count_before == row_count_after
+            completed = True
+        finally:
+            # consumer stopped early (see Limit) or something failed: the worker in the middle of the sort
+            # must not wait for us forever, it is terminated
+            worker.release(completed)
+
+
+class PartialSort(ops.Operation):
+    """
+    First n rows in the order ExternalSort gives (sort followed by limit) without sorting the whole input:
+    a bounded heap of n smallest encoded keys is kept in memory, O(m log n) time for m input rows.
     """
 
-    def __init__(self, keys: tp.Sequence[str]):
+    def __init__(self, keys: tp.Sequence[str], n: int, schema: Schema | None = None) -> None:
+        """
+        :param keys: sorting keys
+        :param n: number of rows to keep
+        :param schema: schema of compact rows or None for dict rows
+        """
         self.keys = keys
+        self.n = n
+        self.schema = schema
 
     def __call__(self, rows: ops.TRowsIterable, *args: tp.Any, **kwargs: tp.Any) -> ops.TRowsGenerator:
-        local_endpoint, remote_endpoint = Pipe()
-        process = Process(target=do_sort, args=(remote_endpoint, self.keys))
-        process.start()
-        row_count_before = 0
-        for row in rows:
-            local_endpoint.send(row)
-            row_count_before += 1
-        local_endpoint.send(None)
-        row_count_after = 0
-        while True:
-            local_endpoint_row = local_endpoint.recv()
-            if local_endpoint_row is None:
-                break
-            yield local_endpoint_row
-            row_count_after += 1
-        assert row_count_before == row_count_after
-        process.join()
+        encode = key_encoder(self.keys, self.schema)
+        # nsmallest is stable, so rows with equal keys keep their input order as in ExternalSort
+        yield from map(itemgetter(1), heapq.nsmallest(self.n, ((encode(row), row) for row in rows), key=_first))
+
+
+_MAX_KEY = b"\xff"  # greater than any type tag of key_codec, so greater than any encoded key
+
+
+class RangeRouter:
+    """
+    Routing of rows of a range-partitioned sort by encoded keys: range i holds keys k with
+    points[i - 1] <= k < points[i] and is sorted by worker owners[i], a worker may sort several ranges.
+    Points chosen from the first rows are wrong if the input drifts away from them (e.g. it is already sorted),
+    then a worker gets much more than its share of rows. Its range is split again at the largest (smallest) key
+    routed to it so far if keys keep growing (falling) in it, so the rows already routed stay in the old range,
+    and the new range is given to the least loaded worker.
+    """
+
+    def __init__(self, points: list[bytes], min_rows: int = 0) -> None:
+        """
+        :param points: sorted split points of initial ranges, each of them has its own worker
+        :param min_rows: number of routed keys before which ranges are not split
+        """
+        self.points = points
+        self.owners = list(range(len(points) + 1))
+        self.sizes = [0] * len(self.owners)
+        self.workers = len(self.owners)
+        self.min_rows = min_rows
+        self._lows = [_MAX_KEY] * len(self.owners)
+        self._highs = [b""] * len(self.owners)
+
+    def route(self, key: bytes) -> int:
+        """Index of range of key
+        :param key: encoded key
+        """
+        index = bisect_right(self.points, key)
+        self.sizes[index] += 1
+        if key > self._highs[index]:
+            self._highs[index] = key
+        if key < self._lows[index]:
+            self._lows[index] = key
+        return index
+
+    def split(self, index: int, key: bytes) -> bool:
+        """Split range if its worker got more than twice its share of keys and keys keep growing or falling in it
+        :param index: index of range
+        :param key: the last key routed to range
+        :return: whether range was split, ranges from index on are shifted then
+        """
+        loads = [0] * self.workers
+        for size, owner in zip(self.sizes, self.owners):
+            loads[owner] += size
+        routed = sum(loads)
+        owner = self.owners[index]
+        target = min(range(self.workers), key=loads.__getitem__)
+        if routed < self.min_rows or loads[owner] * self.workers <= 2 * routed or target == owner:
+            return False
+        if key == self._highs[index]:
+            # the smallest key greater than all of the routed ones, the rest of range goes to the new one
+            point, new_index = key + b"\x00", index + 1
+            if index < len(self.points) and point >= self.points[index]:
+                return False
+        elif key == self._lows[index]:
+            point, new_index = key, index
+            if index > 0 and point <= self.points[index - 1]:
+                return False
+        else:
+            return False
+        self.points.insert(index, point)
+        self.owners.insert(new_index, target)
+        self.sizes.insert(new_index, 0)
+        self._lows.insert(new_index, _MAX_KEY)
+        self._highs.insert(new_index, b"")
+        return True
+
+
+def routing_prefix(
+    sample: tp.Sequence[tp.Any], keys: tp.Sequence[tp.Any], parts: int
+) -> tuple[TKeyEncoder, list[bytes]]:
+    """Choose the shortest prefix of keys whose values split sample into parts ranges (or the one giving
+    the most ranges), encoding the prefix costs less than encoding the whole key
+    :param sample: rows to choose split points from
+    :param keys: column names for dict rows or positions for compact rows
+    :param parts: desired number of ranges
+    :return: encoder of the prefix and split points of ranges (see stats.split_points)
+    """
+    encode = items_encoder(keys[:0])
+    points: list[bytes] = []
+    for length in range(1, len(keys) + 1):
+        prefix_encode = items_encoder(keys[:length])
+        prefix_points = split_points(sorted(map(prefix_encode, sample)), parts)
+        if length == 1 or len(prefix_points) > len(points):
+            encode, points = prefix_encode, prefix_points
+        if len(points) == parts - 1:
+            break
+    return encode, points
+
+
+class ParallelSort(ExternalSort):
+    """
+    Sort by the same order as ExternalSort using several worker processes.
+    Split points of key ranges are chosen from the first sample_size rows (kept in memory), then rows are streamed
+    to workers as they are read: the input is neither buffered nor read twice. Ranges are built on the shortest
+    prefix of sort keys which splits the sample well, so this process encodes only the prefix and workers encode
+    whole keys. A range is split again while rows are routed if its worker gets too many of them (see RangeRouter).
+    Each worker sorts its rows (spilling runs to disk), which gives its ranges one after another, and ranges
+    are concatenated in order without a final merge. Rows with equal keys go to the same worker, so the sort
+    stays stable.
+    """
+
+    def __init__(
+        self,
+        keys: tp.Sequence[str],
+        workers: int,
+        schema: Schema | None = None,
+        run_size: int = DEFAULT_RUN_SIZE,
+        sample_size: int = DEFAULT_SAMPLE_SIZE,
+    ):
+        """
+        :param keys: sorting keys
+        :param workers: number of worker processes
+        :param schema: schema of compact rows or None for dict rows
+        :param run_size: maximum number of rows sorted in memory by a worker before spilling to disk
+        :param sample_size: number of first rows to choose key ranges from
+        """
+        super().__init__(keys, schema, run_size)
+        self.workers = workers
+        self.sample_size = sample_size
+
+    def __call__(self, rows: ops.TRowsIterable, *args: tp.Any, **kwargs: tp.Any) -> ops.TRowsGenerator:
+        keys = self.keys if self.schema is None else [self.schema.position(key) for key in self.keys]
+        iterator = iter(rows)
+        sample = list(islice(iterator, max(self.sample_size, 1)))
+        if not sample:
+            return
+        encode, points = routing_prefix(sample, keys, self.workers)
+        router = RangeRouter(points, self.sample_size)
+        workers: list[runtime.Worker] = []
+        completed = False
+        try:
+            for _ in range(router.workers):
+                workers.append(runtime.start_task(do_sort, keys, self.run_size))
+            batches: list[list[tp.Any]] = [[] for _ in workers]
+            owners = router.owners
+            for row in chain(sample, iterator):
+                key = encode(row)
+                index = router.route(key)
+                owner = owners[index]
+                batch = batches[owner]
+                batch.append(row)
+                if len(batch) >= SPILL_BATCH_SIZE:
+                    workers[owner].connection.send(batch)
+                    batches[owner] = []
+                    router.split(index, key)
+            for worker, batch in zip(workers, batches):
+                if batch:
+                    worker.connection.send(batch)
+                worker.connection.send(None)
+
+            # a worker gives its ranges in key order, so the next rows of its stream belong to its next range
+            streams = [_receive_batches(worker.connection) for worker in workers]
+            for owner, size in zip(router.owners, router.sizes):
+                yield from islice(streams[owner], size)
+            for stream in streams:
+                for _ in stream:
+                    raise AssertionError("Worker sorted more rows than were routed to it")
+            completed = True
+        finally:
+            for worker in workers:
+                worker.release(completed)
@@ -0,0 +1,219 @@
+"""
+Fusion of linear chains of mappers into a single generated function.
+
+Instead of a generator per Map operation and a generator per mapper call, a chain of mappers is compiled
+into one loop over input rows. Built-in single-row mappers are inlined as statements, Filter becomes
+`if not condition(row): continue`, other mappers (Split, user mappers) are called directly and
+open a nested loop over rows they yield (user mappers implementing map_batch are not fused):
+
+    for row in rows:
+        row[c0] = row[c0].translate(table0)   # FilterPunctuation
+        row[c1] = row[c1].lower()             # LowerCase
+        for row in m2(row):                   # Split
+            if not condition3(row):           # Filter
+                continue
+            yield row
+
+Rows of a graph with schema stay compact tuples while mappers can work on them (see ops.compact_output_schema)
+and are unpacked to dicts once, before the first mapper which can't:
+
+    for row in rows:
+        row = row[:1] + (row[1].lower(),) + row[2:]   # LowerCase
+        head1, tail1 = row[:1], row[2:]               # Split
+        for piece1 in pieces1(row[1]):
+            row = head1 + (piece1,) + tail1
+            row = unpack(row)
+            for row in m2(row):                       # user mapper
+                yield row
+"""
+import string
+import typing as tp
+
+from functools import reduce
+from operator import mul
+
+from . import operations as ops
+from .schema import Schema
+
+
+_INLINED = (
+    ops.FilterPunctuation,
+    ops.LowerCase,
+    ops.Filter,
+    ops.BinaryOperation,
+    ops.Project,
+    ops.Product,
+    ops.Encode,
+    ops.Decode,
+)
+
+
+def _fusible(mapper: ops.Mapper) -> bool:
+    """User mappers with their own map_batch are kept in separate batched Map operations"""
+    return type(mapper) in _INLINED or not ops.overrides(mapper, ops.Mapper, "map_batch")
+
+
+def _stage(index: int, mapper: ops.Mapper, namespace: dict[str, tp.Any]) -> tuple[list[str], bool]:
+    """Code of a stage of fused loop and whether it opens a nested loop"""
+    kind = type(mapper)
+    if kind is ops.FilterPunctuation:
+        assert isinstance(mapper, ops.FilterPunctuation)
+        namespace[f"c{index}"] = mapper.column
+        namespace[f"table{index}"] = str.maketrans("", "", string.punctuation)
+        return [f"row[c{index}] = row[c{index}].translate(table{index})"], False
+    if kind is ops.LowerCase:
+        assert isinstance(mapper, ops.LowerCase)
+        namespace[f"c{index}"] = mapper.column
+        return [f"row[c{index}] = row[c{index}].lower()"], False
+    if kind is ops.Filter:
+        assert isinstance(mapper, ops.Filter)
+        namespace[f"condition{index}"] = mapper.condition
+        return [f"if not condition{index}(row):", "    continue"], False
+    if kind is ops.BinaryOperation:
+        assert isinstance(mapper, ops.BinaryOperation)
+        namespace[f"c{index}"] = mapper.column
+        namespace[f"operation{index}"] = mapper.operation
+        return [f"row[c{index}] = operation{index}(row)"], False
+    if kind is ops.Project:
+        assert isinstance(mapper, ops.Project)
+        namespace[f"columns{index}"] = tuple(mapper.columns)
+        return [f"row = {{column: row[column] for column in columns{index} if column in row}}"], False
+    if kind is ops.Product:
+        assert isinstance(mapper, ops.Product)
+        namespace[f"c{index}"] = mapper.result_column
+        namespace[f"columns{index}"] = tuple(mapper.columns)
+        return [f"row = {{**row, c{index}: reduce(mul, [row[column] for column in columns{index}], 1)}}"], False
+    if kind is ops.Encode:
+        assert isinstance(mapper, ops.Encode)
+        # known values (almost all of them) cost a dict lookup without a call
+        namespace[f"ids{index}"] = mapper.dictionary.ids
+        namespace[f"encode{index}"] = mapper.dictionary.encode
+        lines = []
+        for column in mapper.columns:
+            lines += [
+                f"value = row[{column!r}]",
+                "if value:",
+                f"    id_ = ids{index}.get(value)",
+                f"    row[{column!r}] = id_ if id_ is not None else encode{index}(value)",
+            ]
+        return lines, False
+    if kind is ops.Decode:
+        assert isinstance(mapper, ops.Decode)
+        namespace[f"translate{index}"] = mapper.translator()
+        return [f"row[{column!r}] = translate{index}(row[{column!r}])" for column in mapper.columns], False
+    namespace[f"m{index}"] = mapper
+    return [f"for row in m{index}(row):"], True
+
+
+def _compact_stage(
+    index: int, mapper: ops.Mapper, schema: Schema, namespace: dict[str, tp.Any]
+) -> tuple[list[str], bool]:
+    """Code of a stage of fused loop over compact rows and whether it opens a nested loop,
+    mapper is one of those ops.compact_output_schema accepts for schema"""
+    if isinstance(mapper, ops.Project):
+        namespace[f"getter{index}"] = schema.getter(schema.project(mapper.columns).columns)
+        return [f"row = getter{index}(row)"], False
+    if isinstance(mapper, ops.Filter):
+        namespace[f"condition{index}"] = mapper.condition
+        namespace[f"unpack{index}"] = schema.unpack
+        return [f"if not condition{index}(unpack{index}(row)):", "    continue"], False
+    if isinstance(mapper, ops.Recode):
+        namespace[f"translate{index}"] = mapper.translator()
+        lines = ["values = list(row)"]
+        for column in mapper.columns:
+            position = schema.position(column)
+            lines.append(f"values[{position}] = translate{index}(values[{position}])")
+        return lines + ["row = tuple(values)"], False
+    if isinstance(mapper, ops.Split):
+        namespace[f"pieces{index}"] = mapper.pieces
+        position = schema.position(mapper.column)
+        return [
+            f"head{index}, tail{index} = row[:{position}], row[{position + 1}:]",
+            f"for piece{index} in pieces{index}(row[{position}]):",
+            f"    row = head{index} + (piece{index},) + tail{index}",
+        ], True
+    assert isinstance(mapper, (ops.FilterPunctuation, ops.LowerCase))
+    namespace[f"transform{index}"] = mapper.transform()
+    position = schema.position(mapper.column)
+    return [f"row = row[:{position}] + (transform{index}(row[{position}]),) + row[{position + 1}:]"], False
+
+
+def compact_schemas(mappers: tp.Sequence[ops.Mapper], schema: Schema | None) -> list[Schema]:
+    """Schemas of rows after each mapper of the longest prefix of chain working on compact rows
+    :param mappers: chain of mappers
+    :param schema: schema of compact input rows or None for dict rows
+    """
+    schemas: list[Schema] = []
+    for mapper in mappers:
+        schema = ops.compact_output_schema(mapper, schema)
+        if schema is None:
+            break
+        schemas.append(schema)
+    if len(schemas) < len(mappers):
+        # rows are unpacked after the prefix anyway, Filters just before that would unpack them twice
+        while schemas and isinstance(mappers[len(schemas) - 1], ops.Filter):
+            schemas.pop()
+    return schemas
+
+
+def compile_mappers(
+    mappers: tp.Sequence[ops.Mapper], schema: Schema | None = None
+) -> tp.Callable[[ops.TRowsIterable], ops.TRowsGenerator]:
+    """Generate function applying mappers one after another to every row
+    :param mappers: chain of mappers
+    :param schema: schema of compact input rows or None for dict rows
+    """
+    namespace: dict[str, tp.Any] = {"reduce": reduce, "mul": mul}
+    lines = ["def fused(rows):", "    for row in rows:"]
+    indent = "        "
+    schemas = compact_schemas(mappers, schema)
+    # schemas of rows before each mapper of compact prefix and after it
+    input_schemas = [tp.cast(Schema, schema)] + schemas
+    for index, mapper in enumerate(mappers[:len(schemas)]):
+        code, nested = _compact_stage(index, mapper, input_schemas[index], namespace)
+        lines.extend(indent + line for line in code)
+        if nested:
+            indent += "    "
+    if schema is not None and len(schemas) < len(mappers):
+        namespace["unpack"] = input_schemas[len(schemas)].unpack
+        lines.append(indent + "row = unpack(row)")
+    for index, mapper in enumerate(mappers[len(schemas):], len(schemas)):
+        code, nested = _stage(index, mapper, namespace)
+        lines.extend(indent + line for line in code)
+        if nested:
+            indent += "    "
+    lines.append(indent + "yield row")
+    exec(compile("\n".join(lines), "<fused mappers>", "exec"), namespace)
+    return namespace["fused"]
+
+
+class FusedMap(ops.Operation):
+    """Map operation applying a chain of mappers in a single generated loop (see compile_mappers)"""
+
+    def __init__(self, mappers: tp.Sequence[ops.Mapper], schema: Schema | None = None) -> None:
+        """
+        :param mappers: chain of mappers
+        :param schema: schema of compact input rows or None for dict rows
+        """
+        self.mappers = list(mappers)
+        self.schema = schema
+        schemas = compact_schemas(self.mappers, schema)
+        self.output_schema = schemas[-1] if len(schemas) == len(self.mappers) else None
+        self._fused = compile_mappers(self.mappers, schema)
+
+    def __call__(self, rows: ops.TRowsIterable, *args: tp.Any, **kwargs: tp.Any) -> ops.TRowsGenerator:
+        yield from self._fused(rows)
+
+
+def fuse(operation: ops.Operation | None, mapper: ops.Mapper) -> FusedMap | None:
+    """Map operation equivalent to operation followed by map with mapper or None if they can't be fused
+    :param operation: preceding operation
+    :param mapper: mapper to apply after it
+    """
+    if not _fusible(mapper):
+        return None
+    if isinstance(operation, FusedMap):
+        return FusedMap(operation.mappers + [mapper], operation.schema)
+    if isinstance(operation, ops.Map) and _fusible(operation.mapper):
+        return FusedMap([operation.mapper, mapper], operation.schema)
+    return None
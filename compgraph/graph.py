@@ -1,7 +1,20 @@
+import contextlib
 import typing as tp
 
 from . import operations as ops
+from . import aggregates as agg
+from . import bloom
+from . import checkpoints
+from . import distributed
 from . import external_sort as sort
+from . import fusion
+from . import pipeline
+from . import planner
+from . import sketches
+from . import streaming
+from . import windows
+from .schema import Schema
+from .stats import Statistics
 
 
 class Graph:
@@ -10,74 +23,405 @@ class Graph:
     def __init__(self, *args: tp.Any):
         self.operation: ops.Operation | None = None
         self.graphs: tp.Any = args
+        self.schema: Schema | None = None
 
     @staticmethod
-    def graph_from_iter(name: str) -> "Graph":
+    def graph_from_iter(name: str, schema: tp.Sequence[str] | None = None) -> "Graph":
         """Construct new graph which reads data from row iterator (in form of sequence of Rows
         from 'kwargs' passed to 'run' method) into graph data-flow
         Use ops.ReadIterFactory
         :param name: name of kwarg to use as data source
+        :param schema: columns of rows, if passed rows are stored compactly inside of graph
         """
         new_graph = Graph()
-        new_graph.operation = ops.ReadIterFactory(name)
+        new_graph.schema = Schema(schema) if schema is not None else None
+        new_graph.operation = ops.ReadIterFactory(name, new_graph.schema)
         return new_graph
 
     @staticmethod
-    def graph_from_file(filename: str, parser: tp.Callable[[str], ops.TRow]) -> "Graph":
+    def graph_from_file(
+        filename: str,
+        parser: tp.Callable[[str], ops.TRow],
+        schema: tp.Sequence[str] | None = None,
+    ) -> "Graph":
         """Construct new graph extended with operation for reading rows from file
         Use ops.Read
         :param filename: filename to read from
         :param parser: parser from string to Row
+        :param schema: columns of rows, if passed rows are stored compactly inside of graph
         """
         new_graph = Graph()
-        new_graph.operation = ops.Read(filename, parser)
+        new_graph.schema = Schema(schema) if schema is not None else None
+        new_graph.operation = ops.Read(filename, parser, new_graph.schema)
+        return new_graph
+
+    @staticmethod
+    def graph_from_map_reduce(
+        coordinator: distributed.Coordinator,
+        map_tasks: tp.Sequence[distributed.Task],
+        keys: tp.Sequence[str],
+        reduce_factory: distributed.TGraphFactory,
+        reduce_source: str = "input",
+        partitions: int | None = None,
+        shuffle_directory: str | None = None,
+    ) -> "Graph":
+        """Construct new graph which reads rows reduced on workers: map tasks run on workers of coordinator,
+        their output is shuffled by hash of keys and reduced on workers by graphs built by reduce_factory
+        (see distributed.Coordinator.map_reduce); the rest of the graph runs locally on reduced rows
+        Use distributed.MapReduce
+        :param coordinator: coordinator running tasks
+        :param map_tasks: tasks producing rows to reduce
+        :param keys: keys to partition rows by
+        :param reduce_factory: module-level function building reduce graph reading rows from reduce_source
+        :param reduce_source: name of reduce graph source
+        :param partitions: number of reduce tasks, the number of workers by default
+        :param shuffle_directory: directory on filesystem shared by workers to shuffle rows through,
+            rows are shuffled through a temporary directory of the coordinator if not passed
+        """
+        new_graph = Graph()
+        new_graph.operation = distributed.MapReduce(
+            coordinator, map_tasks, keys, reduce_factory, reduce_source, partitions, shuffle_directory
+        )
+        return new_graph
+
+    def with_schema(self, columns: tp.Sequence[str]) -> "Graph":
+        """Construct new graph which stores rows compactly as tuples of mentioned columns,
+        other columns are dropped. Rows are converted back to dicts only for user mappers,
+        reducers and joiners and on graph output
+        :param columns: names of columns
+        """
+        new_graph = Graph(self)
+        new_graph.schema = Schema(columns)
+        new_graph.operation = ops.Pack(new_graph.schema, self.schema)
         return new_graph
 
     def map(self, mapper: ops.Mapper) -> "Graph":
         """Construct new graph extended with map operation with particular mapper
         :param mapper: mapper to use
         """
+        fused = fusion.fuse(self.operation, mapper)
+        if fused is not None:
+            # chains of maps run as a single generated loop, see fusion
+            new_graph = Graph(*self.graphs)
+            new_graph.schema = fused.output_schema
+            new_graph.operation = fused
+            return new_graph
+
         new_graph = Graph(self)
-        new_graph.operation = ops.Map(mapper)
+        operation = ops.Map(mapper, self.schema)
+        new_graph.schema = operation.output_schema
+        new_graph.operation = operation
         return new_graph
 
+    def encode(self, columns: tp.Sequence[str], dictionary: ops.Dictionary) -> "Graph":
+        """Construct new graph which replaces values of columns (e.g. words) with integer ids, so rows are
+        smaller and cheaper to sort and join; ids group like values but are ordered by first appearance,
+        so columns are decoded before a sort whose order is visible (see ops.Dictionary)
+        :param columns: names of columns
+        :param dictionary: dictionary of ids, the same for all graphs encoding and decoding the same values
+        """
+        return self.map(ops.Encode(columns, dictionary))
+
+    def decode(self, columns: tp.Sequence[str], dictionary: ops.Dictionary) -> "Graph":
+        """Construct new graph which replaces ids given by encode with values
+        :param columns: names of columns
+        :param dictionary: dictionary used by encode
+        """
+        return self.map(ops.Decode(columns, dictionary))
+
     def reduce(self, reducer: ops.Reducer, keys: tp.Sequence[str]) -> "Graph":
         """Construct new graph extended with reduce operation with particular reducer
         :param reducer: reducer to use
         :param keys: keys for grouping
         """
         new_graph = Graph(self)
-        new_graph.operation = ops.Reduce(reducer, keys)
+        new_graph.operation = ops.Reduce(reducer, keys, self.schema)
+        return new_graph
+
+    def aggregate(self, aggregates: tp.Mapping[str, agg.Aggregator], keys: tp.Sequence[str]) -> "Graph":
+        """Construct new graph extended with hash aggregation, which doesn't need sorted input
+        :param aggregates: result column names mapped to aggregate functions
+        :param keys: keys for grouping, the whole table is a single group if empty
+        """
+        new_graph = Graph(self)
+        new_graph.operation = agg.HashAggregate(aggregates, keys, self.schema)
         return new_graph
 
-    def sort(self, keys: tp.Sequence[str]) -> "Graph":
+    def window(
+        self,
+        aggregates: tp.Mapping[str, agg.Aggregator],
+        time_column: str,
+        size: float,
+        slide: float | None = None,
+        keys: tp.Sequence[str] = (),
+        allowed_lateness: float = 0.0,
+    ) -> "Graph":
+        """Construct new graph extended with aggregation per keys and event-time window, which needs no sorted input:
+        windows are aggregated incrementally and emitted as soon as they are closed by the watermark
+        (see windows.WindowAggregate); results have columns window_start and window_end
+        :param aggregates: result column names mapped to aggregate functions
+        :param time_column: column with event time, seconds or formatted time (e.g. 20171020T112238.723000)
+        :param size: window length in seconds
+        :param slide: distance between window starts for sliding windows, tumbling windows if not passed
+        :param keys: keys for grouping inside of a window
+        :param allowed_lateness: how long (in event time) rows older than the latest one are waited for,
+            later rows are dropped
+        """
+        new_graph = Graph(self)
+        new_graph.operation = windows.WindowAggregate(
+            aggregates, time_column, size, slide, keys, allowed_lateness, schema=self.schema
+        )
+        return new_graph
+
+    def sort(self, keys: tp.Sequence[str], workers: int | None = None) -> "Graph":
         """Construct new graph extended with sort operation
         :param keys: sorting keys (typical is tuple of strings)
+        :param workers: if passed, key ranges are sorted by so many worker processes in parallel
+            (with the same result)
+        """
+        new_graph = Graph(self)
+        new_graph.schema = self.schema
+        if workers is not None and workers > 1:
+            new_graph.operation = sort.ParallelSort(keys, workers, self.schema)
+        else:
+            new_graph.operation = sort.ExternalSort(keys, self.schema)
+        return new_graph
+
+    def top_k(self, by: str, k: int, group_by: tp.Sequence[str] | None = None) -> "Graph":
+        """Construct new graph extended with top-k operation, which doesn't need sorted input
+        :param by: column name to get top by
+        :param k: number of rows to keep
+        :param group_by: keys for grouping, whole table is a single group if not passed
+        """
+        new_graph = Graph(self)
+        new_graph.schema = self.schema
+        new_graph.operation = ops.TopK(by, k, group_by, self.schema)
+        return new_graph
+
+    def heavy_hitters(
+        self,
+        keys: tp.Sequence[str],
+        k: int,
+        capacity: int | None = None,
+        count_column: str = "count",
+        error_column: str = "count_error",
+    ) -> "Graph":
+        """Construct new graph extended with approximate count of the k most frequent keys,
+        computed in one pass with fixed memory and without sorting
+        :param keys: columns forming counted key
+        :param k: number of keys to keep
+        :param capacity: number of counters (10 * k by default), counts are overestimated by at most rows / capacity
+        :param count_column: column for estimated count
+        :param error_column: column for maximum overestimation of count
+        """
+        new_graph = Graph(self)
+        new_graph.operation = sketches.HeavyHitters(keys, k, capacity, count_column, error_column, self.schema)
+        return new_graph
+
+    def sample(self, n: int, seed: int | None = None) -> "Graph":
+        """Construct new graph keeping uniform sample of n rows (reservoir sampling) in their input order
+        :param n: sample size
+        :param seed: seed for reproducible samples
         """
         new_graph = Graph(self)
-        new_graph.operation = sort.ExternalSort(keys)
+        new_graph.schema = self.schema
+        new_graph.operation = ops.Sample(n, seed)
+        return new_graph
+
+    def sample_fraction(self, fraction: float, seed: int | None = None) -> "Graph":
+        """Construct new graph keeping every row independently with probability fraction
+        :param fraction: probability to keep a row
+        :param seed: seed for reproducible samples
+        """
+        new_graph = Graph(self)
+        new_graph.schema = self.schema
+        new_graph.operation = ops.SampleFraction(fraction, seed)
+        return new_graph
+
+    def limit(self, n: int) -> "Graph":
+        """Construct new graph keeping first n rows; upstream operations stop as soon as n rows are taken.
+        Sort followed by limit keeps n first rows in a heap instead of sorting the whole input
+        :param n: number of rows to keep
+        """
+        op = self.operation
+        if isinstance(op, sort.ExternalSort) and n <= sort.MAX_PARTIAL_SORT_ROWS:
+            new_graph = Graph(*self.graphs)
+            new_graph.operation = sort.PartialSort(op.keys, n, self.schema)
+        elif isinstance(op, sort.PartialSort):
+            new_graph = Graph(*self.graphs)
+            new_graph.operation = sort.PartialSort(op.keys, min(op.n, n), self.schema)
+        elif isinstance(op, ops.Limit):
+            new_graph = Graph(*self.graphs)
+            new_graph.operation = ops.Limit(min(op.n, n))
+        else:
+            new_graph = Graph(self)
+            new_graph.operation = ops.Limit(n)
+        new_graph.schema = self.schema
         return new_graph
 
     def join(
-        self, joiner: ops.Joiner, join_graph: "Graph", keys: tp.Sequence[str]
+        self,
+        joiner: ops.Joiner,
+        join_graph: "Graph",
+        keys: tp.Sequence[str],
+        bloom_filter_fpr: float | None = None,
+        hash_join: bool = False,
     ) -> "Graph":
         """Construct new graph extended with join operation with another graph
         :param joiner: join strategy to use
         :param join_graph: other graph to join with
         :param keys: keys for grouping
+        :param bloom_filter_fpr: if passed, join_graph (expected to be the smaller one) is read first and
+            Bloom filter with such false positive rate over its keys prunes rows of this graph
+            before its last sort; only for joins dropping rows of this graph without a pair
+        :param hash_join: keep join_graph in memory in a hash table (ops.HashJoin), so neither graph has to be
+            sorted and rows are joined in order of this graph (e.g. a stream); only for joins dropping rows
+            of join_graph without a pair
+        """
+        if hash_join:
+            if not isinstance(joiner, ops.MergeJoiner):
+                raise TypeError("Hash join needs a MergeJoiner")
+            new_graph = Graph(self, join_graph)
+            new_graph.operation = ops.HashJoin(joiner, keys, "b", self.schema, join_graph.schema)
+        elif bloom_filter_fpr is None:
+            new_graph = Graph(self, join_graph)
+            new_graph.operation = ops.Join(joiner, keys, self.schema, join_graph.schema)
+        elif isinstance(self.operation, sort.ExternalSort):
+            new_graph = Graph(self.graphs[0], join_graph)
+            new_graph.operation = bloom.BloomSemiJoin(
+                joiner, keys, bloom_filter_fpr, self.operation, self.schema, join_graph.schema
+            )
+        else:
+            new_graph = Graph(self, join_graph)
+            new_graph.operation = bloom.BloomSemiJoin(
+                joiner, keys, bloom_filter_fpr, None, self.schema, join_graph.schema
+            )
+        return new_graph
+
+    def with_scalar(self, scalar_graph: "Graph") -> "Graph":
+        """Construct new graph which attaches columns of the only row of scalar_graph
+        (e.g. global aggregate) to every row; unlike join with empty keys it needs no sorting and no buffering
+        :param scalar_graph: graph producing exactly one row
+        """
+        new_graph = Graph(self, scalar_graph)
+        new_graph.operation = ops.WithScalar(self.schema, scalar_graph.schema)
+        return new_graph
+
+    def threaded(self, batch_size: int = 1024, queue_size: int = 8) -> "Graph":
+        """Construct new graph which runs the current graph in a separate thread
+        Rows are handed over in batches through a bounded queue, so I/O-bound upstream stages
+        overlap with the downstream ones
+        :param batch_size: number of rows passed between threads at once
+        :param queue_size: maximum number of batches buffered between threads
         """
-        new_graph = Graph(self, join_graph)
-        new_graph.operation = ops.Join(joiner, keys)
+        new_graph = Graph(self)
+        new_graph.schema = self.schema
+        new_graph.operation = pipeline.ThreadedStage(batch_size, queue_size)
         return new_graph
 
-    def run(self, **kwargs: tp.Any) -> ops.TRowsIterable:
-        """Single method to start execution; data sources passed as kwargs"""
+    def run(self, **kwargs: tp.Any) -> ops.TRowsGenerator:
+        """Single method to start execution; data sources passed as kwargs.
+        Closing the generator (or an error) stops all operations and terminates their processes,
+        see running for a context manager doing it"""
+        rows = self._run(**kwargs)
+        try:
+            if self.schema is None:
+                yield from rows
+            else:
+                yield from map(self.schema.unpack, rows)
+        finally:
+            rows.close()
+
+    @contextlib.contextmanager
+    def running(self, **kwargs: tp.Any) -> tp.Iterator[ops.TRowsGenerator]:
+        """Context manager giving rows of run; on exit execution is stopped even if rows are not read to the end,
+        and all processes it started are terminated and reaped:
+
+            with graph.running(input=source) as rows:
+                first = next(rows)
+        """
+        rows = self.run(**kwargs)
+        try:
+            yield rows
+        finally:
+            rows.close()
+
+    def run_checkpointed(
+        self, directory: str, versions: tp.Mapping[str, str] | None = None, **kwargs: tp.Any
+    ) -> ops.TRowsGenerator:
+        """Run as run does, storing outputs of finished blocking stages (sorts, reduces, joins, aggregations)
+        durably in directory; a run of the same graph over the same inputs with the same directory (e.g. after
+        a crash) reads finished stages instead of computing them and everything upstream (see checkpoints)
+        :param directory: checkpoint directory
+        :param versions: versions of data sources passed as kwargs by name (files are checked by themselves),
+            stages depending on a source with another version are computed again
+        """
+        return checkpoints.run(self, directory, versions, **kwargs)
+
+    def run_stream(
+        self,
+        stream: str,
+        trigger_rows: int | None = None,
+        trigger_seconds: float | None = None,
+        checkpoint: str | None = None,
+        **kwargs: tp.Any,
+    ) -> tp.Generator[list[ops.TRow], None, None]:
+        """Run graph continuously over an unbounded source cut into micro-batches, yielding output of the graph
+        for every micro-batch; aggregates, top-k, hash joins against static tables and windows keep their state
+        between micro-batches, so e.g. aggregate gives counts of all rows seen so far (see streaming)
+        :param stream: name of the stream source, other sources passed as kwargs are static
+        :param trigger_rows: maximum number of rows in a micro-batch
+        :param trigger_seconds: maximum time between outputs
+        :param checkpoint: file to store state in after every output, the run continues from it if it exists
+        """
+        return streaming.run(self, stream, trigger_rows, trigger_seconds, checkpoint, **kwargs)
+
+    def analyze(self, statistics: Statistics | None = None, **kwargs: tp.Any) -> Statistics:
+        """Run graph collecting statistics of rows produced by every node (row counts, row sizes,
+        numbers of distinct keys) for plan; data sources passed as kwargs
+        :param statistics: statistics to update, e.g. loaded by Statistics.load, new ones if not passed
+        """
+        return planner.analyze(self, statistics, **kwargs)
+
+    def plan(
+        self,
+        statistics: Statistics | None = None,
+        memory_limit: int = planner.DEFAULT_MEMORY_LIMIT,
+        max_workers: int | None = None,
+    ) -> "Graph":
+        """Construct equivalent graph with join, aggregation and sort strategies chosen by costs estimated
+        from statistics collected by analyze (hash join against a small table, sort-based aggregation of too many
+        groups, parallel sort of large tables); the graph itself is not changed
+        :param statistics: statistics of previous runs
+        :param memory_limit: memory in bytes a hash table may take
+        :param max_workers: maximum number of processes of a sort, number of CPUs by default
+        """
+        return planner.Planner(statistics, memory_limit, max_workers).plan(self)
+
+    def explain(
+        self,
+        statistics: Statistics | None = None,
+        memory_limit: int = planner.DEFAULT_MEMORY_LIMIT,
+        max_workers: int | None = None,
+        **kwargs: tp.Any,
+    ) -> str:
+        """Describe plan (see plan) as a tree of operations with chosen strategies and estimated row counts;
+        if data sources are passed as kwargs, the plan is run and actual row counts are shown too
+        """
+        return planner.Planner(statistics, memory_limit, max_workers).explain(self, **kwargs)
+
+    def _run(self, **kwargs: tp.Any) -> ops.TRowsGenerator:
+        """Execute graph yielding rows in internal representation (compact if graph has schema);
+        inputs are closed when this node finishes, fails or is closed, so nothing upstream is left running"""
         op = self.operation
         if op is None:
             raise TypeError
         if len(self.graphs) == 0:
             yield from op(**kwargs)
-        elif len(self.graphs) == 1:
-            yield from op(self.graphs[0].run(**kwargs))
-        else:
-            yield from op(self.graphs[0].run(**kwargs), self.graphs[1].run(**kwargs))
+            return
+        inputs = [graph._run(**kwargs) for graph in self.graphs]
+        try:
+            yield from op(*inputs)
+        finally:
+            for rows in inputs:
+                ops.close_rows(rows)
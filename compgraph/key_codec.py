@@ -0,0 +1,148 @@
+"""
+Order-preserving binary encoding of composite keys.
+
+Key tuple is encoded into bytes once per row, so that comparing two encoded keys with plain
+bytes comparison (memcmp) gives the same result as comparing original tuples:
+numbers (bool, int and float, mixed freely) are ordered by value, strings by code points,
+tuples and lists element-wise. Values of different types are ordered by type instead of raising.
+Equal keys (including 1 == 1.0 == True) have equal encodings, so encoded keys are usable for
+grouping and hashing as well.
+"""
+import struct
+import typing as tp
+from operator import itemgetter
+
+from .schema import Schema
+
+
+TKeyEncoder = tp.Callable[[tp.Any], bytes]
+
+_NONE = b"\x01"
+_NUMBER = b"\x02"
+_STRING = b"\x03"
+_BYTES = b"\x04"
+_LIST = b"\x05"
+_TUPLE = b"\x06"
+_END = b"\x00"
+
+_DOUBLE = struct.Struct(">d")
+_UINT64 = struct.Struct(">Q")
+_NUMBER_PAIR = struct.Struct(">QQ")
+_POSITIVE_NUMBER = struct.Struct(">cdQ")
+_SIGN = 1 << 63
+_MASK = (1 << 64) - 1
+_EXACT = 1 << 53
+
+
+def _float_bits(value: float) -> int:
+    """Map float to unsigned integer with the same order"""
+    bits: int = _UINT64.unpack(_DOUBLE.pack(value))[0]
+    return bits ^ _MASK if bits & _SIGN else bits | _SIGN
+
+
+def _encode_float(value: float) -> bytes:
+    if value == 0:
+        value = 0.0  # -0.0 == 0.0
+    return _NUMBER + _NUMBER_PAIR.pack(_float_bits(value), _SIGN)
+
+
+def _encode_int(value: int) -> bytes:
+    if 0 < value <= _EXACT:
+        # bits of -value are bits of value with the sign bit set, which is the ordered form of a positive number;
+        # the fast path for counts and dictionary ids
+        return _POSITIVE_NUMBER.pack(_NUMBER, -value, _SIGN)
+    if -_EXACT <= value <= _EXACT:
+        bits: int = _UINT64.unpack(_DOUBLE.pack(value))[0]
+        return _NUMBER + _NUMBER_PAIR.pack(bits ^ _MASK if bits & _SIGN else bits | _SIGN, _SIGN)
+    # Nearest float orders integers and floats together, exact remainder breaks ties
+    # between integers which are too large to be represented by float exactly
+    try:
+        approximation = float(value)
+    except OverflowError:
+        raise ValueError(f"Integer {value} is too large for key encoding") from None
+    remainder = value - int(approximation)
+    if not -_SIGN <= remainder < _SIGN:
+        raise ValueError(f"Integer {value} is too large for key encoding")
+    return _NUMBER + _NUMBER_PAIR.pack(_float_bits(approximation), remainder + _SIGN)
+
+
+# Terminator b"\x00\x00" sorts before escaped zero byte b"\x00\xff" and any other byte,
+# so a prefix is always ordered before longer values
+def _encode_str(value: str) -> bytes:
+    return _STRING + value.encode("utf-8", "surrogatepass").replace(b"\x00", b"\x00\xff") + b"\x00\x00"
+
+
+def _encode_bytes(value: bytes) -> bytes:
+    return _BYTES + value.replace(b"\x00", b"\x00\xff") + b"\x00\x00"
+
+
+def _encode_list(value: list[tp.Any]) -> bytes:
+    return _LIST + b"".join(map(encode_value, value)) + _END
+
+
+def _encode_tuple(value: tuple[tp.Any, ...]) -> bytes:
+    return _TUPLE + b"".join(map(encode_value, value)) + _END
+
+
+_ENCODERS: dict[type, tp.Callable[[tp.Any], bytes]] = {
+    type(None): lambda value: _NONE,
+    bool: _encode_int,
+    int: _encode_int,
+    float: _encode_float,
+    str: _encode_str,
+    bytes: _encode_bytes,
+    list: _encode_list,
+    tuple: _encode_tuple,
+}
+
+
+def encode_value(value: tp.Any) -> bytes:
+    """Encode single value of key
+    :param value: value to encode
+    """
+    try:
+        return _ENCODERS[value.__class__](value)
+    except KeyError:
+        pass
+    for base, base_encoder in _ENCODERS.items():
+        if isinstance(value, base):
+            return base_encoder(value)
+    raise TypeError(f"Unsupported key type {type(value).__name__}")
+
+
+def encode_key(values: tp.Iterable[tp.Any]) -> bytes:
+    """Encode composite key
+    :param values: key values
+    """
+    return b"".join(map(encode_value, values))
+
+
+def items_encoder(items: tp.Sequence[tp.Any]) -> TKeyEncoder:
+    """Build function encoding key of a row from its items
+    :param items: column names for dict rows or positions for compact rows
+    """
+    if len(items) == 0:
+        return lambda row: b""
+    if len(items) == 1:
+        item = items[0]
+        encoders = _ENCODERS
+
+        def encode_item(row: tp.Any) -> bytes:
+            # the exact type is looked up inline, encode_value is called only for subclasses and unsupported types
+            value = row[item]
+            encoder = encoders.get(value.__class__)
+            return encoder(value) if encoder is not None else encode_value(value)
+
+        return encode_item
+    get_key = itemgetter(*items)
+    return lambda row: b"".join([encode_value(value) for value in get_key(row)])
+
+
+def key_encoder(keys: tp.Sequence[str], schema: Schema | None = None) -> TKeyEncoder:
+    """Build function encoding key of a row
+    :param keys: key column names
+    :param schema: schema of compact rows or None for dict rows
+    """
+    if schema is None:
+        return items_encoder(keys)
+    return items_encoder([schema.position(key) for key in keys])
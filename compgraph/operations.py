@@ -3,20 +3,54 @@ from abc import abstractmethod, ABC
 import string
 import typing as tp
 from datetime import datetime
-from itertools import groupby
+from itertools import chain, groupby, islice
 from functools import reduce
 import operator
 import heapq
+import random
 from collections import Counter
-from typing import Any
 import re
 import json
+import threading
+
+from .key_codec import TKeyEncoder, key_encoder
+from .schema import Schema, TCompactRow, key_getter, unpacker
+from .spill import DEFAULT_MAX_ROWS, SpillBuffer
 
 
 TRow = dict[str, tp.Any]
 TRowsIterable = tp.Iterable[TRow]
 TRowsGenerator = tp.Generator[TRow, None, None]
 
+BATCH_SIZE = 1024
+
+
+def batches(rows: tp.Iterable[tp.Any], size: int = BATCH_SIZE) -> tp.Generator[list[tp.Any], None, None]:
+    """Split rows into lists of at most size rows
+    :param rows: rows to split
+    :param size: maximum number of rows in a list
+    """
+    iterator = iter(rows)
+    while batch := list(islice(iterator, size)):
+        yield batch
+
+
+def overrides(obj: tp.Any, base: type, method: str) -> bool:
+    """Whether class of obj overrides method of base class"""
+    return getattr(type(obj), method) is not getattr(base, method)
+
+
+def close_rows(rows: tp.Iterable[tp.Any]) -> None:
+    """Close rows if they are a generator, so operations upstream stop and release their files and processes
+    :param rows: rows iterable
+    """
+    if getattr(rows, "gi_running", False):
+        # rows are being read by a thread left behind (see pipeline.ThreadedStage), which closes them itself
+        return
+    close = getattr(rows, "close", None)
+    if close is not None:
+        close()
+
 
 def json_parser(line: str) -> TRow:
     print(line)
@@ -31,24 +65,102 @@ class Operation(ABC):
         pass
 
 
+class StatefulOperation(Operation):
+    """
+    Operation which can keep state between micro-batches of a stream (see streaming).
+    update folds rows of a micro-batch into state and may yield rows at once, emit yields rows left at the end
+    of input. A batch run is update of initial state by all rows followed by emit.
+    """
+
+    # emit gives the result for all rows seen so far and is called in a stream after every micro-batch
+    # (aggregates); otherwise rows are yielded by update as soon as they are known (joins, closed windows)
+    accumulating = True
+
+    @abstractmethod
+    def initial_state(self) -> tp.Any:
+        """New mutable state"""
+        pass
+
+    @abstractmethod
+    def update(self, state: tp.Any, rows: TRowsIterable, *args: tp.Any) -> TRowsGenerator:
+        """
+        :param state: state to update
+        :param rows: rows of micro-batch
+        :param args: other inputs
+        """
+        pass
+
+    def emit(self, state: tp.Any) -> TRowsGenerator:
+        """
+        :param state: current state
+        """
+        yield from ()
+
+    def checkpoint(self, state: tp.Any) -> tp.Any:
+        """Part of state to store in checkpoint, the rest is restored from inputs
+        :param state: current state
+        """
+        return state
+
+    def __call__(self, rows: TRowsIterable, *args: tp.Any, **kwargs: tp.Any) -> TRowsGenerator:
+        state = self.initial_state()
+        yield from self.update(state, rows, *args)
+        yield from self.emit(state)
+
+
 class Read(Operation):
-    def __init__(self, filename: str, parser: tp.Callable[[str], TRow]) -> None:
+    def __init__(
+        self,
+        filename: str,
+        parser: tp.Callable[[str], TRow],
+        schema: Schema | None = None,
+    ) -> None:
         self.filename = filename
         self.parser = parser
+        self.schema = schema
 
     def __call__(self, *args: tp.Any, **kwargs: tp.Any) -> TRowsGenerator:
         with open(self.filename) as f:
-            for line in f:
-                yield self.parser(line)
+            if self.schema is None:
+                for line in f:
+                    yield self.parser(line)
+            else:
+                pack = self.schema.pack
+                for line in f:
+                    yield pack(self.parser(line))
 
 
 class ReadIterFactory(Operation):
-    def __init__(self, name: str) -> None:
+    def __init__(self, name: str, schema: Schema | None = None) -> None:
         self.name = name
+        self.schema = schema
 
     def __call__(self, *args: tp.Any, **kwargs: tp.Any) -> TRowsGenerator:
-        for row in kwargs[self.name]():
-            yield row
+        if self.schema is None:
+            for row in kwargs[self.name]():
+                yield row
+        else:
+            yield from map(self.schema.pack, kwargs[self.name]())
+
+
+class Pack(Operation):
+    """Store rows compactly as tuples of schema columns, other columns are dropped"""
+
+    def __init__(self, schema: Schema, input_schema: Schema | None = None) -> None:
+        """
+        :param schema: schema of produced rows
+        :param input_schema: schema of consumed rows or None for dict rows
+        """
+        self.schema = schema
+        self.input_schema = input_schema
+
+    def __call__(
+        self, rows: TRowsIterable, *args: tp.Any, **kwargs: tp.Any
+    ) -> TRowsGenerator:
+        if self.input_schema is None:
+            yield from map(self.schema.pack, rows)
+        else:
+            yield from map(self.input_schema.getter(self.schema.columns), rows)
 
 
 # Operations
@@ -64,16 +176,89 @@ class Mapper(ABC):
         """
         pass
 
+    def map_batch(self, rows: list[TRow]) -> list[TRow]:
+        """Apply mapper to a block of rows, if overridden Map calls it instead of per-row __call__
+        :param rows: block of table rows
+        """
+        return [result for row in rows for result in self(row)]
+
+
+def compact_output_schema(mapper: Mapper, schema: Schema | None) -> Schema | None:
+    """Schema of rows given by built-in mapper working on compact rows directly (see Map)
+    or None if mapper needs dict rows
+    :param mapper: mapper to apply
+    :param schema: schema of compact input rows or None for dict rows
+    """
+    if schema is None:
+        return None
+    if isinstance(mapper, Project):
+        return schema.project(mapper.columns)
+    if isinstance(mapper, (Filter, Recode)):
+        return schema
+    # exact types only: a subclass may override __call__, and its rows have to go through it
+    if type(mapper) in (FilterPunctuation, LowerCase, Split) and tp.cast(Split, mapper).column in schema.positions:
+        return schema
+    return None
+
 
 class Map(Operation):
-    def __init__(self, mapper: Mapper) -> None:
+    def __init__(self, mapper: Mapper, schema: Schema | None = None) -> None:
+        """
+        :param mapper: mapper to use
+        :param schema: schema of compact input rows or None for dict rows
+        """
         self.mapper = mapper
+        self.schema = schema
+        self.output_schema = compact_output_schema(mapper, schema)
 
     def __call__(
         self, rows: TRowsIterable, *args: tp.Any, **kwargs: tp.Any
     ) -> TRowsGenerator:
-        for row in rows:
-            yield from self.mapper(row)
+        batched = overrides(self.mapper, Mapper, "map_batch")
+        if self.schema is None:
+            if batched:
+                for batch in batches(rows):
+                    yield from self.mapper.map_batch(batch)
+            else:
+                for row in rows:
+                    yield from self.mapper(row)
+        elif self.output_schema is None:
+            unpack = self.schema.unpack
+            if batched:
+                for batch in batches(rows):
+                    yield from self.mapper.map_batch(list(map(unpack, batch)))
+            else:
+                for row in rows:
+                    yield from self.mapper(unpack(row))
+        elif isinstance(self.mapper, Filter):
+            unpack, condition = self.schema.unpack, self.mapper.condition
+            for row in rows:
+                if condition(unpack(row)):
+                    yield row
+        elif isinstance(self.mapper, Recode):
+            translate = self.mapper.translator()
+            positions = [self.schema.position(column) for column in self.mapper.columns]
+
+            def recode(row: tp.Any) -> tp.Any:
+                values = list(row)
+                for position in positions:
+                    values[position] = translate(values[position])
+                return tuple(values)
+
+            yield from map(recode, rows)
+        elif isinstance(self.mapper, Split):
+            position, pieces = self.schema.position(self.mapper.column), self.mapper.pieces
+            for row in tp.cast(tp.Iterable[TCompactRow], rows):
+                head, tail = row[:position], row[position + 1:]
+                for piece in pieces(row[position]):
+                    yield head + (piece,) + tail
+        elif isinstance(self.mapper, (FilterPunctuation, LowerCase)):
+            position = self.schema.position(self.mapper.column)
+            transform = self.mapper.transform()
+            for row in tp.cast(tp.Iterable[TCompactRow], rows):
+                yield row[:position] + (transform(row[position]),) + row[position + 1:]
+        else:
+            yield from map(self.schema.getter(self.output_schema.columns), rows)
 
 
 class Reducer(ABC):
@@ -88,17 +273,184 @@ class Reducer(ABC):
         """
         pass
 
+    def reduce_batch(self, group_key: tuple[str, ...], blocks: tp.Iterable[list[TRow]]) -> list[TRow]:
+        """Reduce a group given as blocks of rows, if overridden Reduce calls it instead of __call__
+        :param group_key: keys of grouping
+        :param blocks: blocks of rows of the group
+        """
+        return list(self(group_key, chain.from_iterable(blocks)))
+
 
 class Reduce(Operation):
-    def __init__(self, reducer: Reducer, keys: tp.Sequence[str]) -> None:
+    def __init__(
+        self, reducer: Reducer, keys: tp.Sequence[str], schema: Schema | None = None
+    ) -> None:
+        """
+        :param reducer: reducer to use
+        :param keys: keys for grouping
+        :param schema: schema of compact input rows or None for dict rows
+        """
         self.reducer = reducer
         self.keys = keys
+        self.schema = schema
 
     def __call__(
         self, rows: TRowsIterable, *args: tp.Any, **kwargs: tp.Any
     ) -> TRowsGenerator:
-        for _, group_rows in groupby(rows, key=lambda row: [row[k] for k in self.keys]):
-            yield from self.reducer(tuple(self.keys), group_rows)
+        group_key = tuple(self.keys)
+        batched = overrides(self.reducer, Reducer, "reduce_batch")
+        if self.schema is None:
+            for _, group_rows in groupby(rows, key=key_getter(self.keys)):
+                if batched:
+                    yield from self.reducer.reduce_batch(group_key, batches(group_rows))
+                else:
+                    yield from self.reducer(group_key, group_rows)
+        else:
+            unpack = self.schema.unpack
+            for _, group_rows in groupby(rows, key=self.schema.getter(self.keys)):
+                if batched:
+                    yield from self.reducer.reduce_batch(group_key, batches(map(unpack, group_rows)))
+                else:
+                    yield from self.reducer(group_key, map(unpack, group_rows))
+
+
+class TopK(StatefulOperation):
+    """
+    Select k rows with the largest values in column without sorting the input.
+    Every group keeps a bounded heap of size k, so it takes O(n log k) time and O(groups * k) memory.
+    Groups are hashed by encoded keys and emitted in ascending order of group key (the same order as sort gives),
+    rows inside of a group in descending order of column (equal values keep their input order).
+    """
+
+    def __init__(
+        self,
+        column: str,
+        k: int,
+        keys: tp.Sequence[str] | None = None,
+        schema: Schema | None = None,
+    ) -> None:
+        """
+        :param column: column name to get top by
+        :param k: number of rows to keep in each group
+        :param keys: keys for grouping, the whole table is a single group if not passed
+        :param schema: schema of compact input rows or None for dict rows
+        """
+        self.column = column
+        self.k = k
+        self.keys = tuple(keys) if keys is not None else ()
+        self.schema = schema
+
+    def initial_state(self) -> tp.Any:
+        return {"heaps": {}, "rows": 0}
+
+    def update(self, state: tp.Any, rows: TRowsIterable, *args: tp.Any) -> TRowsGenerator:
+        if self.k <= 0:
+            return
+
+        get_group = key_encoder(self.keys, self.schema)
+        column: tp.Any = self.column if self.schema is None else self.schema.position(self.column)
+        heaps: dict[bytes, list[tuple[tp.Any, int, TRow]]] = state["heaps"]
+        index = state["rows"] - 1
+        for index, row in enumerate(rows, state["rows"]):
+            group = get_group(row)
+            heap = heaps.get(group)
+            if heap is None:
+                heap = heaps[group] = []
+            item = (row[column], -index, row)
+            if len(heap) < self.k:
+                heapq.heappush(heap, item)
+            elif item > heap[0]:
+                heapq.heapreplace(heap, item)
+        state["rows"] = index + 1
+        yield from ()
+
+    def emit(self, state: tp.Any) -> TRowsGenerator:
+        heaps = state["heaps"]
+        for group in sorted(heaps):
+            for _, _, row in sorted(heaps[group], reverse=True):
+                yield row
+
+
+class Sample(Operation):
+    """
+    Uniform sample of n rows of the whole table in one pass (reservoir sampling), takes O(n) memory.
+    Sampled rows are emitted in their input order; all rows are emitted if there are at most n of them.
+    """
+
+    def __init__(self, n: int, seed: int | None = None) -> None:
+        """
+        :param n: sample size
+        :param seed: seed of random generator for reproducible samples
+        """
+        self.n = n
+        self.seed = seed
+
+    def __call__(
+        self, rows: TRowsIterable, *args: tp.Any, **kwargs: tp.Any
+    ) -> TRowsGenerator:
+        if self.n <= 0:
+            return
+
+        random_ = random.Random(self.seed).random
+        reservoir: list[tuple[int, TRow]] = []
+        for index, row in enumerate(rows):
+            if index < self.n:
+                reservoir.append((index, row))
+            else:
+                position = int(random_() * (index + 1))
+                if position < self.n:
+                    reservoir[position] = (index, row)
+
+        reservoir.sort(key=operator.itemgetter(0))
+        for _, row in reservoir:
+            yield row
+
+
+class SampleFraction(Operation):
+    """Keep every row independently with given probability, streaming and without buffering"""
+
+    def __init__(self, fraction: float, seed: int | None = None) -> None:
+        """
+        :param fraction: probability to keep a row
+        :param seed: seed of random generator for reproducible samples
+        """
+        if not 0 <= fraction <= 1:
+            raise ValueError("fraction must be in [0, 1]")
+        self.fraction = fraction
+        self.seed = seed
+
+    def __call__(
+        self, rows: TRowsIterable, *args: tp.Any, **kwargs: tp.Any
+    ) -> TRowsGenerator:
+        random_ = random.Random(self.seed).random
+        fraction = self.fraction
+        for row in rows:
+            if random_() < fraction:
+                yield row
+
+
+class Limit(Operation):
+    """
+    First n rows of the input. Input is closed as soon as n rows are taken, so upstream operations stop
+    at once: readers close their files, sorts terminate their processes (see Graph.limit).
+    """
+
+    def __init__(self, n: int) -> None:
+        """
+        :param n: number of rows to take
+        """
+        self.n = n
+
+    def __call__(self, rows: TRowsIterable, *args: tp.Any, **kwargs: tp.Any) -> TRowsGenerator:
+        iterator = iter(rows)
+        try:
+            if self.n > 0:
+                for index, row in enumerate(iterator, 1):
+                    yield row
+                    if index >= self.n:
+                        break
+        finally:
+            close_rows(iterator)
 
 
 class Joiner(ABC):
@@ -119,16 +471,80 @@ class Joiner(ABC):
         """
         pass
 
+    def join(
+        self,
+        keys: tp.Sequence[str],
+        rows_a: TRowsIterable,
+        rows_b: TRowsIterable,
+        schema_a: Schema | None = None,
+        schema_b: Schema | None = None,
+    ) -> TRowsGenerator:
+        """Join tables which rows may be stored compactly, rows are passed to __call__ as dicts
+        :param keys: join keys
+        :param rows_a: left table rows
+        :param rows_b: right table rows
+        :param schema_a: schema of compact left rows or None for dict rows
+        :param schema_b: schema of compact right rows or None for dict rows
+        """
+        yield from self(keys, map(unpacker(schema_a), rows_a), map(unpacker(schema_b), rows_b))
+
 
 class Join(Operation):
-    def __init__(self, joiner: Joiner, keys: tp.Sequence[str]):
+    def __init__(
+        self,
+        joiner: Joiner,
+        keys: tp.Sequence[str],
+        schema_a: Schema | None = None,
+        schema_b: Schema | None = None,
+    ):
+        """
+        :param joiner: join strategy to use
+        :param keys: join keys
+        :param schema_a: schema of compact left rows or None for dict rows
+        :param schema_b: schema of compact right rows or None for dict rows
+        """
         self.keys = keys
         self.joiner = joiner
+        self.schema_a = schema_a
+        self.schema_b = schema_b
+
+    def __call__(
+        self, rows: TRowsIterable, *args: tp.Any, **kwargs: tp.Any
+    ) -> TRowsGenerator:
+        yield from self.joiner.join(self.keys, rows, args[0], self.schema_a, self.schema_b)
+
+
+class WithScalar(Operation):
+    """
+    Attach columns of a single-row table (typically a global aggregate) to every row of streamed table.
+    The single row is read once, streamed rows are neither sorted nor buffered. Columns of the single row
+    override columns with the same name. Nothing is emitted if the single-row table is empty.
+    """
+
+    def __init__(
+        self, schema: Schema | None = None, scalar_schema: Schema | None = None
+    ) -> None:
+        """
+        :param schema: schema of compact streamed rows or None for dict rows
+        :param scalar_schema: schema of compact single row or None for dict row
+        """
+        self.schema = schema
+        self.scalar_schema = scalar_schema
 
     def __call__(
         self, rows: TRowsIterable, *args: tp.Any, **kwargs: tp.Any
     ) -> TRowsGenerator:
-        yield from self.joiner(self.keys, rows, *args)
+        scalar_rows = iter(args[0])
+        scalar = next(scalar_rows, None)
+        if scalar is None:
+            return
+        if next(scalar_rows, None) is not None:
+            raise ValueError("Scalar table must contain exactly one row")
+        scalar = unpacker(self.scalar_schema)(scalar)
+
+        unpack = unpacker(self.schema)
+        for row in rows:
+            yield {**unpack(row), **scalar}
 
 
 # Dummy operators
@@ -164,6 +580,10 @@ class FilterPunctuation(Mapper):
         """
         self.column = column
 
+    def transform(self) -> tp.Callable[[str], str]:
+        """Function filtering punctuation out of a single value"""
+        return operator.methodcaller("translate", str.maketrans("", "", string.punctuation))
+
     def __call__(self, row: TRow) -> TRowsGenerator:
         filtered = row[self.column].translate(str.maketrans("", "", string.punctuation))
         row[self.column] = filtered
@@ -183,10 +603,20 @@ class LowerCase(Mapper):
     def _lower_case(txt: str) -> str:
         return txt.lower()
 
+    def transform(self) -> tp.Callable[[str], str]:
+        """Function lowering case of a single value"""
+        return str.lower
+
     def __call__(self, row: TRow) -> TRowsGenerator:
         row[self.column] = row[self.column].lower()
         yield row
 
+    def map_batch(self, rows: list[TRow]) -> list[TRow]:
+        column = self.column
+        for row in rows:
+            row[column] = row[column].lower()
+        return rows
+
 
 class Split(Mapper):
     """Split row on multiple rows by separator"""
@@ -199,23 +629,26 @@ class Split(Mapper):
         self.column = column
         self.separator = separator if separator is not None else r"\s"
 
+    def pieces(self, text: str) -> tp.Generator[str, None, None]:
+        """Split single value into pieces
+        :param text: value to split
+        """
+        last_end = 0
+        for match in re.finditer(self.separator, text):
+            if match.start() != 0:
+                yield text[last_end: match.start()].strip()
+            last_end = match.end()
+
+        if last_end < len(text):
+            yield text[last_end:].strip()
+
     def __call__(self, row: TRow) -> TRowsGenerator:
         if self.column not in row:
             yield row
             return
 
-        pattern = re.compile(self.separator)
-        last_end = 0
-        for match in pattern.finditer(row[self.column]):
-            if match.start() != 0:
-                yield {
-                    **row,
-                    self.column: row[self.column][last_end: match.start()].strip(),
-                }
-            last_end = match.end()
-
-        if last_end < len(row[self.column]):
-            yield {**row, self.column: row[self.column][last_end:].strip()}
+        for piece in self.pieces(row[self.column]):
+            yield {**row, self.column: piece}
 
 
 class Product(Mapper):
@@ -235,6 +668,10 @@ class Product(Mapper):
         product = reduce(operator.mul, (row[col] for col in self.columns), 1)
         yield {**row, self.result_column: product}
 
+    def map_batch(self, rows: list[TRow]) -> list[TRow]:
+        columns, result_column = self.columns, self.result_column
+        return [{**row, result_column: reduce(operator.mul, [row[col] for col in columns], 1)} for row in rows]
+
 
 class Filter(Mapper):
     """Remove records that don't satisfy some condition"""
@@ -249,6 +686,9 @@ class Filter(Mapper):
         if self.condition(row):
             yield row
 
+    def map_batch(self, rows: list[TRow]) -> list[TRow]:
+        return list(filter(self.condition, rows))
+
 
 class Project(Mapper):
     """Leave only mentioned columns"""
@@ -262,6 +702,106 @@ class Project(Mapper):
     def __call__(self, row: TRow) -> TRowsGenerator:
         yield {col: row[col] for col in self.columns if col in row}
 
+    def map_batch(self, rows: list[TRow]) -> list[TRow]:
+        columns = self.columns
+        return [{col: row[col] for col in columns if col in row} for row in rows]
+
+
+class Dictionary:
+    """
+    Mapping of repeated values (e.g. words) to integer ids 1, 2, ... in order of first appearance.
+    Rows with ids instead of strings take less memory and are pickled to sort processes several times
+    faster. Equal values get equal ids, so sorts, reduces and joins by encoded columns group rows the same
+    way; ids are ordered by first appearance rather than by values, so columns are decoded before sorts
+    whose order is visible. A dictionary belongs to a process: ids are not known to other processes running
+    the graph.
+    """
+
+    def __init__(self, values: tp.Iterable[tp.Any] = ()) -> None:
+        """
+        :param values: known values, they get ids in this order
+        """
+        self.values: list[tp.Any] = []
+        self.ids: dict[tp.Any, int] = {}
+        self._lock = threading.Lock()
+        for value in values:
+            self.encode(value)
+
+    def __len__(self) -> int:
+        return len(self.values)
+
+    def encode(self, value: tp.Any) -> int:
+        """Id of value, a new one if value is not known yet
+        :param value: value to encode
+        """
+        id_ = self.ids.get(value)
+        if id_ is None:
+            # graphs with threaded stages may encode from several threads
+            with self._lock:
+                id_ = self.ids.get(value)
+                if id_ is None:
+                    self.values.append(value)
+                    id_ = self.ids[value] = len(self.values)
+        return id_
+
+    def decode(self, id_: int) -> tp.Any:
+        """Value with id
+        :param id_: id given by encode
+        """
+        return self.values[id_ - 1]
+
+    def extend(self, values: tp.Sequence[tp.Any]) -> None:
+        """Restore ids of dictionary of an earlier run, which started with the same values as this one
+        :param values: values of that dictionary in order of ids
+        """
+        if values[:len(self.values)] != self.values:
+            raise ValueError("Dictionary doesn't continue values of this one")
+        for value in values[len(self.values):]:
+            self.encode(value)
+
+
+class Recode(Mapper):
+    """Replace values of columns with function of them, other columns are kept; base of Encode and Decode"""
+
+    def __init__(self, columns: tp.Sequence[str], dictionary: Dictionary) -> None:
+        """
+        :param columns: names of columns
+        :param dictionary: dictionary shared by all mappers of the columns
+        """
+        self.columns = tuple(columns)
+        self.dictionary = dictionary
+
+    @abstractmethod
+    def translator(self) -> tp.Callable[[tp.Any], tp.Any]:
+        """Function replacing value"""
+        pass
+
+    def __call__(self, row: TRow) -> TRowsGenerator:
+        translate = self.translator()
+        for column in self.columns:
+            row[column] = translate(row[column])
+        yield row
+
+
+class Encode(Recode):
+    """
+    Replace values of columns with their ids in dictionary (see Dictionary).
+    Empty values (None, '') are kept as they are and ids are never 0, so reducers skipping empty keys
+    (e.g. Count) skip the same rows.
+    """
+
+    def translator(self) -> tp.Callable[[tp.Any], tp.Any]:
+        encode = self.dictionary.encode
+        return lambda value: encode(value) if value else value
+
+
+class Decode(Recode):
+    """Replace ids given by Encode with values"""
+
+    def translator(self) -> tp.Callable[[tp.Any], tp.Any]:
+        values = self.dictionary.values
+        return lambda id_: values[id_ - 1] if id_ else id_
+
 
 # Reducers
 
@@ -336,6 +876,16 @@ class Count(Reducer):
             if all(key):
                 yield {**dict(zip(group_key, key)), self.column: sum(1 for _ in group)}
 
+    def reduce_batch(self, group_key: tuple[str, ...], blocks: tp.Iterable[list[TRow]]) -> list[TRow]:
+        count, key = 0, None
+        for block in blocks:
+            if key is None:
+                key = [block[0].get(val) for val in group_key]
+            count += len(block)
+        if key is None or not all(key):
+            return []
+        return [{**dict(zip(group_key, key)), self.column: count}]
+
 
 class Sum(Reducer):
     """
@@ -368,201 +918,315 @@ class Sum(Reducer):
 # Joiners
 
 
-class InnerJoiner(Joiner):
-    """Join with inner strategy"""
+_END = object()
 
-    def __call__(
-        self, keys: tp.Sequence[str], rows_a: TRowsIterable, rows_b: TRowsIterable
-    ) -> TRowsGenerator:
-        iter_a = iter(rows_a)
-        iter_b = iter(rows_b)
 
-        try:
-            row_a = next(iter_a)
-            row_b = next(iter_b)
-        except StopIteration:
-            return
+def _merge_groups(
+    rows_a: TRowsIterable,
+    rows_b: TRowsIterable,
+    key_a: TKeyEncoder,
+    key_b: TKeyEncoder,
+    keep_b: bool,
+    max_group_rows: int = DEFAULT_MAX_ROWS,
+) -> tp.Generator[tuple[tp.Iterator[tp.Any] | None, SpillBuffer], None, None]:
+    """
+    Walk over two tables sorted by join keys group by group. Key of every row is encoded exactly once
+    with the same order-preserving encoding as sort uses, so keys are compared as bytes.
+    Yields pairs of (left group rows or None if there is no such key in left table, right group rows),
+    left group is streamed and only right group is buffered. Right groups larger than max_group_rows
+    (hot keys, empty join keys) are spilled to disk and replayed from there.
+    :param keep_b: whether to buffer right groups that have no match in left table
+    :param max_group_rows: maximum number of right group rows kept in memory
+    """
+    iter_b = iter(rows_b)
+    row_b = next(iter_b, _END)
+    value_b = key_b(row_b) if row_b is not _END else b""
+    group_b = SpillBuffer(max_group_rows)
+
+    def take_group_b(keep: bool) -> SpillBuffer:
+        nonlocal row_b, value_b
+        group_b.close()
+        group_value = value_b
+        while row_b is not _END and value_b == group_value:
+            if keep:
+                group_b.append(row_b)
+            row_b = next(iter_b, _END)
+            if row_b is not _END:
+                value_b = key_b(row_b)
+        return group_b
+
+    try:
+        for value_a, group_a in groupby(rows_a, key_a):
+            while row_b is not _END and value_b < value_a:
+                take_group_b(keep_b)
+                if keep_b:
+                    yield None, group_b
+            if row_b is not _END and value_b == value_a:
+                yield group_a, take_group_b(True)
+            else:
+                group_b.close()
+                yield group_a, group_b
 
-        overlapping_columns = set(row_a.keys()).intersection(set(row_b.keys()))
-        overlapping_columns.difference_update(set(keys))
-
-        matched_rows_b: list[dict[str, Any]] = []
-
-        while True:
-            key_a = tuple(row_a[k] for k in keys)
-            key_b = tuple(row_b[k] for k in keys)
-
-            if key_a < key_b:
-                if (
-                    len(matched_rows_b) > 0
-                    and tuple(matched_rows_b[0][k] for k in keys) == key_a
-                ):
-                    for row_b_matched in matched_rows_b:
-                        row_a_renamed = {
-                            f"{k}{self._a_suffix}" if k in overlapping_columns else k: v
-                            for k, v in row_a.items()
-                        }
-                        row_b_renamed = {
-                            f"{k}{self._b_suffix}" if k in overlapping_columns else k: v
-                            for k, v in row_b_matched.items()
-                        }
-                        yield {**row_a_renamed, **row_b_renamed}
-
-                try:
-                    row_a = next(iter_a)
-                except StopIteration:
-                    return
-            elif key_a >= key_b:
-                if (
-                    len(matched_rows_b) == 0
-                    or tuple(matched_rows_b[0][k] for k in keys) == key_b
-                ):
-                    matched_rows_b.append(row_b)
-                else:
-                    matched_rows_b = [row_b]
-
-                try:
-                    row_b = next(iter_b)
-                except StopIteration:
-                    break
-
-        while True:
-            key_a = tuple(row_a[k] for k in keys)
-
-            if (
-                len(matched_rows_b) > 0
-                and tuple(matched_rows_b[0][k] for k in keys) == key_a
-            ):
-                for row_b_matched in matched_rows_b:
-                    row_a_renamed = {
-                        f"{k}{self._a_suffix}" if k in overlapping_columns else k: v
-                        for k, v in row_a.items()
-                    }
-                    row_b_renamed = {
-                        f"{k}{self._b_suffix}" if k in overlapping_columns else k: v
-                        for k, v in row_b_matched.items()
-                    }
-                    yield {**row_a_renamed, **row_b_renamed}
-            try:
-                row_a = next(iter_a)
-            except StopIteration:
-                return
+        while keep_b and row_b is not _END:
+            yield None, take_group_b(True)
+    finally:
+        group_b.close()
 
 
-class OuterJoiner(Joiner):
-    """Join with outer strategy"""
+def _first_columns(rows: TRowsIterable, schema: Schema | None) -> tuple[tp.Collection[str], TRowsIterable]:
+    """
+    Columns of a table: columns of schema or of its first row, which is put back in front of the rows
+    :param rows: table rows
+    :param schema: schema of compact rows or None for dict rows
+    :return: columns and rows of the table
+    """
+    if schema is not None:
+        return schema.columns, rows
+    iterator = iter(rows)
+    for first in iterator:
+        return first.keys(), chain((first,), iterator)
+    return (), iterator
 
-    def __call__(
-        self, keys: tp.Sequence[str], rows_a: TRowsIterable, rows_b: TRowsIterable
-    ) -> TRowsGenerator:
-        dict_a = {tuple(row[k] for k in keys): row for row in rows_a}
-        dict_b = {tuple(row[k] for k in keys): row for row in rows_b}
 
-        all_keys = set(dict_a.keys()) | set(dict_b.keys())
+class _Replay:
+    """Iterable over spilled rows converted to dicts, every iteration reads them from disk again"""
 
-        for key in all_keys:
-            row_a = dict_a.get(key, {})
-            row_b = dict_b.get(key, {})
+    def __init__(self, rows: SpillBuffer, unpack: tp.Callable[[tp.Any], TRow]) -> None:
+        self.rows = rows
+        self.unpack = unpack
 
-            merged_row = {
-                k: row_a.get(k, row_b.get(k))
-                for k in set(row_a.keys()) | set(row_b.keys())
-            }
-            yield merged_row
+    def __iter__(self) -> tp.Iterator[TRow]:
+        return map(self.unpack, self.rows)
 
 
-class LeftJoiner(Joiner):
-    """Join with left strategy"""
+class MergeJoiner(Joiner):
+    """
+    Base class for joiners of tables sorted by join keys.
+    Left table is streamed, only the current group of right table is kept in memory; rows are emitted in key order.
+    keep_a and keep_b tell whether rows without a pair from left and right tables are emitted,
+    rename tells whether overlapping non-key columns of joined rows get suffixes.
+    """
+
+    keep_a: bool = False
+    keep_b: bool = False
+    rename: bool = True
+
+    def __init__(
+        self, suffix_a: str = "_1", suffix_b: str = "_2", max_group_rows: int = DEFAULT_MAX_ROWS
+    ) -> None:
+        """
+        :param suffix_a: suffix for overlapping columns of left table
+        :param suffix_b: suffix for overlapping columns of right table
+        :param max_group_rows: right key groups larger than this are spilled to disk
+        """
+        super().__init__(suffix_a, suffix_b)
+        self.max_group_rows = max_group_rows
 
     def __call__(
         self, keys: tp.Sequence[str], rows_a: TRowsIterable, rows_b: TRowsIterable
     ) -> TRowsGenerator:
-        iter_a = iter(rows_a)
-        iter_b = iter(rows_b)
-
-        try:
-            row_a = next(iter_a)
-            row_b = next(iter_b)
-        except StopIteration:
-            return
-
-        overlapping_columns = set(row_a.keys()).intersection(set(row_b.keys()))
-        overlapping_columns.difference_update(set(keys))
+        yield from self.join(keys, rows_a, rows_b)
 
-        matched_rows_b: list[dict[str, Any]] = []
-
-        while True:
-            key_a = tuple(row_a[k] for k in keys)
-            key_b = tuple(row_b[k] for k in keys)
+    def join(
+        self,
+        keys: tp.Sequence[str],
+        rows_a: TRowsIterable,
+        rows_b: TRowsIterable,
+        schema_a: Schema | None = None,
+        schema_b: Schema | None = None,
+    ) -> TRowsGenerator:
+        # columns are taken from the first row of each table, so unpaired rows get the same suffixes as joined ones
+        columns_a, rows_a = _first_columns(rows_a, schema_a)
+        columns_b, rows_b = _first_columns(rows_b, schema_b)
+        overlapping_columns = set(columns_a).intersection(columns_b) if self.rename else set()
+        overlapping_columns.difference_update(keys)
+        # every row is renamed once, not once per joined pair
+        unpack_a = self._unpacker(schema_a, overlapping_columns, self._a_suffix)
+        unpack_b = self._unpacker(schema_b, overlapping_columns, self._b_suffix)
+
+        for group_a, group_b in _merge_groups(
+            rows_a,
+            rows_b,
+            key_encoder(keys, schema_a),
+            key_encoder(keys, schema_b),
+            self.keep_b,
+            self.max_group_rows,
+        ):
+            if group_a is None:
+                yield from map(unpack_b, group_b)
+                continue
+            if not group_b:
+                if self.keep_a:
+                    yield from map(unpack_a, group_a)
+                continue
+
+            rows_b_unpacked: tp.Iterable[TRow]
+            if group_b.spilled:
+                rows_b_unpacked = _Replay(group_b, unpack_b)
+            else:
+                rows_b_unpacked = [unpack_b(row_b) for row_b in group_b]
+                if len(rows_b_unpacked) == 1:
+                    # unique right keys (dimension tables) need no inner loop
+                    row_b = rows_b_unpacked[0]
+                    for row_a in map(unpack_a, group_a):
+                        yield {**row_a, **row_b}
+                    continue
+            for row_a in map(unpack_a, group_a):
+                for row_b in rows_b_unpacked:
+                    yield {**row_a, **row_b}
 
-            while key_a >= key_b:
-                if key_a == key_b:
-                    matched_rows_b.append(row_b)
+    @staticmethod
+    def _unpacker(schema: Schema | None, overlapping_columns: set[str], suffix: str) -> tp.Callable[[tp.Any], TRow]:
+        """Build converter of rows of one table to dict rows with suffix added to overlapping columns
+        :param schema: schema of compact rows or None for dict rows
+        :param overlapping_columns: columns to rename
+        :param suffix: suffix of this table
+        """
+        if not overlapping_columns:
+            return unpacker(schema)
+        if schema is not None:
+            columns = [f"{c}{suffix}" if c in overlapping_columns else c for c in schema.columns]
+            return lambda values: dict(zip(columns, values))
+        names = {c: f"{c}{suffix}" for c in overlapping_columns}
+        return lambda row: {names.get(k, k): v for k, v in row.items()}
+
+    def _merge_rows(self, row_a: TRow, row_b: TRow, overlapping_columns: set[str]) -> TRow:
+        if not overlapping_columns:
+            return {**row_a, **row_b}
+        row_a_renamed = {
+            f"{k}{self._a_suffix}" if k in overlapping_columns else k: v
+            for k, v in row_a.items()
+        }
+        row_b_renamed = {
+            f"{k}{self._b_suffix}" if k in overlapping_columns else k: v
+            for k, v in row_b.items()
+        }
+        return {**row_a_renamed, **row_b_renamed}
+
+
+class HashJoin(StatefulOperation):
+    """
+    Join keeping one (small) table in memory in a hash table by encoded join keys, so this table needs no sort.
+    If the other table is sorted by join keys as for merge join, the output is the same as of merge join
+    (with build='b' it doesn't have to be sorted at all, rows are joined in its order):
+    with build='b' right table is hashed (joiners not keeping unpaired right rows: inner, left),
+    with build='a' left table is hashed (joiners not keeping unpaired left rows: inner, right).
+    """
 
-                try:
-                    row_b = next(iter_b)
-                    key_b = tuple(row_b[k] for k in keys)
-                except StopIteration:
-                    break
+    accumulating = False
 
-            if matched_rows_b:
-                for row_b_matched in matched_rows_b:
-                    yield {**row_a, **row_b_matched}
-                matched_rows_b = []
-            else:
-                yield row_a
+    def __init__(
+        self,
+        joiner: MergeJoiner,
+        keys: tp.Sequence[str],
+        build: str = "b",
+        schema_a: Schema | None = None,
+        schema_b: Schema | None = None,
+    ) -> None:
+        """
+        :param joiner: join strategy to use
+        :param keys: join keys
+        :param build: table to keep in hash table, 'a' (left) or 'b' (right)
+        :param schema_a: schema of compact left rows or None for dict rows
+        :param schema_b: schema of compact right rows or None for dict rows
+        """
+        if build not in ("a", "b"):
+            raise ValueError("build must be 'a' or 'b'")
+        if joiner.keep_b if build == "b" else joiner.keep_a:
+            raise ValueError(f"{type(joiner).__name__} keeps unpaired rows of the table to hash")
+        self.joiner = joiner
+        self.keys = keys
+        self.build = build
+        self.schema_a = schema_a
+        self.schema_b = schema_b
 
+    @staticmethod
+    def _hash(rows: TRowsIterable, encode: TKeyEncoder, unpack: tp.Callable[[tp.Any], TRow]) -> dict[bytes, list[TRow]]:
+        table: dict[bytes, list[TRow]] = {}
+        for row in rows:
+            key = encode(row)
+            group = table.get(key)
+            if group is None:
+                group = table[key] = []
+            group.append(unpack(row))
+        return table
+
+    def initial_state(self) -> tp.Any:
+        return {}
+
+    def checkpoint(self, state: tp.Any) -> tp.Any:
+        return {}  # hash table is built from the static table again
+
+    def update(self, state: tp.Any, rows: TRowsIterable, *args: tp.Any) -> TRowsGenerator:
+        joiner, keys = self.joiner, self.keys
+        encode_a, encode_b = key_encoder(keys, self.schema_a), key_encoder(keys, self.schema_b)
+        unpack_a, unpack_b = unpacker(self.schema_a), unpacker(self.schema_b)
+        overlapping_columns: set[str] | None = None
+
+        def merge(row_a: TRow, row_b: TRow) -> TRow:
+            nonlocal overlapping_columns
+            if overlapping_columns is None:
+                overlapping_columns = set(row_a.keys()).intersection(row_b.keys())
+                overlapping_columns.difference_update(keys)
+                if not joiner.rename:
+                    overlapping_columns.clear()
+            return joiner._merge_rows(row_a, row_b, overlapping_columns)
+
+        if self.build == "b":
+            # in a stream the right table is static and hashed once
+            if "table" not in state:
+                state["table"] = self._hash(args[0], encode_b, unpack_b)
+            table = state["table"]
+            for row_a in rows:
+                group_b = table.get(encode_a(row_a))
+                if group_b is not None:
+                    row_a = unpack_a(row_a)
+                    for row_b in group_b:
+                        yield merge(row_a, row_b)
+                elif joiner.keep_a:
+                    yield unpack_a(row_a)
+        else:
+            table = self._hash(rows, encode_a, unpack_a)
+            buffer_b = SpillBuffer(joiner.max_group_rows)
             try:
-                row_a = next(iter_a)
-            except StopIteration:
-                break
-
-
-class RightJoiner(Joiner):
-    """Join with right strategy"""
+                for key, group in groupby(args[0], encode_b):
+                    group_a = table.get(key)
+                    if group_a is None:
+                        if joiner.keep_b:
+                            yield from map(unpack_b, group)
+                        continue
+                    buffer_b.close()
+                    buffer_b.extend(map(unpack_b, group))
+                    for row_a in group_a:
+                        for row_b in buffer_b:
+                            yield merge(row_a, row_b)
+            finally:
+                buffer_b.close()
+
+
+class InnerJoiner(MergeJoiner):
+    """Join with inner strategy"""
 
-    def __call__(
-        self, keys: tp.Sequence[str], rows_a: TRowsIterable, rows_b: TRowsIterable
-    ) -> TRowsGenerator:
-        iter_a = iter(rows_a)
-        iter_b = iter(rows_b)
 
-        try:
-            row_a = next(iter_a)
-            row_b = next(iter_b)
-        except StopIteration:
-            return
+class OuterJoiner(MergeJoiner):
+    """Join with outer strategy"""
 
-        overlapping_columns = set(row_a.keys()).intersection(set(row_b.keys()))
-        overlapping_columns.difference_update(set(keys))
+    keep_a = True
+    keep_b = True
 
-        matched_rows_a: list[dict[str, Any]] = []
-        key_a = tuple(row_a[k] for k in keys)
 
-        while True:
-            key_b = tuple(row_b[k] for k in keys)
+class LeftJoiner(MergeJoiner):
+    """Join with left strategy"""
 
-            while key_b >= key_a:
-                if key_a == key_b:
-                    matched_rows_a.append(row_a)
+    keep_a = True
+    rename = False
 
-                try:
-                    row_a = next(iter_a)
-                    key_a = tuple(row_a[k] for k in keys)
-                except StopIteration:
-                    break
 
-            if matched_rows_a:
-                for row_a_matched in matched_rows_a:
-                    yield {**row_a_matched, **row_b}
-                matched_rows_a = []
-            else:
-                yield row_b
+class RightJoiner(MergeJoiner):
+    """Join with right strategy"""
 
-            try:
-                row_b = next(iter_b)
-            except StopIteration:
-                break
+    keep_b = True
+    rename = False
 
 
 class BinaryOperation(Mapper):
@@ -580,6 +1244,12 @@ class BinaryOperation(Mapper):
         row[self.column] = self.operation(row)
         yield row
 
+    def map_batch(self, rows: list[TRow]) -> list[TRow]:
+        column, operation = self.column, self.operation
+        for row in rows:
+            row[column] = operation(row)
+        return rows
+
 
 class RoadGraphProcessor(Mapper):
     """Get the haversine distance for roads"""
@@ -606,6 +1276,16 @@ class RoadGraphProcessor(Mapper):
         yield row
 
 
+TIME_FORMAT = "%Y%m%dT%H%M%S.%f"
+
+
+def parse_time(value: str) -> datetime:
+    """Parse time in format of travel time logs, e.g. 20171020T112238.723000
+    :param value: time string
+    """
+    return datetime.strptime(value, TIME_FORMAT)
+
+
 class TravelTimeProcessor(Mapper):
     """Get the duration, weekday and hour from time"""
 
@@ -626,8 +1306,8 @@ class TravelTimeProcessor(Mapper):
         self.duration_col = duration_col
 
     def __call__(self, row: TRow) -> TRowsGenerator:
-        enter_time = datetime.strptime(row[self.enter_time_col], "%Y%m%dT%H%M%S.%f")
-        leave_time = datetime.strptime(row[self.leave_time_col], "%Y%m%dT%H%M%S.%f")
+        enter_time = parse_time(row[self.enter_time_col])
+        leave_time = parse_time(row[self.leave_time_col])
         duration = (leave_time - enter_time).total_seconds() / 3600
 
         row[self.weekday_col] = enter_time.strftime("%a")
@@ -0,0 +1,82 @@
+import queue
+import threading
+import typing as tp
+
+from . import operations as ops
+
+
+class _Failure:
+    """Wrapper for an exception raised inside of a producer thread"""
+
+    def __init__(self, error: BaseException) -> None:
+        self.error = error
+
+
+_DONE = object()
+_POLL_SECONDS = 0.1
+
+
+class ThreadedStage(ops.Operation):
+    """
+    Run everything upstream of this stage in a separate thread.
+    Rows are passed to the consumer in batches through a bounded queue, so I/O-bound stages
+    (reading, decompression) overlap with parsing and mapping and C-level code releasing the GIL
+    (json, re) runs concurrently with the rest of the graph.
+    """
+
+    def __init__(self, batch_size: int = 1024, queue_size: int = 8) -> None:
+        """
+        :param batch_size: number of rows passed through the queue at once
+        :param queue_size: maximum number of batches waiting in the queue
+        """
+        if batch_size <= 0 or queue_size <= 0:
+            raise ValueError("batch_size and queue_size must be positive")
+        self.batch_size = batch_size
+        self.queue_size = queue_size
+
+    @staticmethod
+    def _put(batches: "queue.Queue[tp.Any]", item: tp.Any, stop: threading.Event) -> bool:
+        while not stop.is_set():
+            try:
+                batches.put(item, timeout=_POLL_SECONDS)
+                return True
+            except queue.Full:
+                continue
+        return False
+
+    def _produce(self, rows: ops.TRowsIterable, batches: "queue.Queue[tp.Any]", stop: threading.Event) -> None:
+        iterator = iter(rows)
+        try:
+            batch: list[ops.TRow] = []
+            for row in iterator:
+                batch.append(row)
+                if len(batch) >= self.batch_size:
+                    if not self._put(batches, batch, stop):
+                        return
+                    batch = []
+            if batch and not self._put(batches, batch, stop):
+                return
+            self._put(batches, _DONE, stop)
+        except BaseException as error:
+            self._put(batches, _Failure(error), stop)
+        finally:
+            ops.close_rows(iterator)
+
+    def __call__(self, rows: ops.TRowsIterable, *args: tp.Any, **kwargs: tp.Any) -> ops.TRowsGenerator:
+        batches: "queue.Queue[tp.Any]" = queue.Queue(maxsize=self.queue_size)
+        stop = threading.Event()
+        producer = threading.Thread(target=self._produce, args=(rows, batches, stop), daemon=True)
+        producer.start()
+        try:
+            while True:
+                batch = batches.get()
+                if batch is _DONE:
+                    break
+                if isinstance(batch, _Failure):
+                    raise batch.error
+                yield from batch
+        finally:
+            stop.set()
+            # a producer putting a batch stops in a poll interval and closes its source, a producer waiting for
+            # the next row of an idle source is left behind (it is a daemon thread) and stops once it gets one
+            producer.join(2 * _POLL_SECONDS)
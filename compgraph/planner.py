@@ -0,0 +1,459 @@
+"""
+Cost-based choice of physical operations from statistics of previous runs.
+
+Graph.analyze runs a graph and records statistics of rows produced by every node (see stats.Statistics):
+row counts, average row size and number of distinct values of keys used by consumers of the node.
+Nodes are identified by fingerprints of their operations with all parameters and of their inputs (see fingerprints),
+so statistics apply to the same graph built again.
+Planner turns a graph into an equivalent one (with the same output) where
+  * a merge join of a sorted table with a small sorted table keeps the small one in a hash table and doesn't
+    sort it ('hash' keeps right table, 'broadcast' keeps left table and streams right table through it),
+  * hash aggregation with more groups than fit into memory becomes sort and single-pass reduce,
+  * large sorts are range-partitioned over several processes.
+Graph.explain shows the chosen plan with estimated and (if data sources are passed) actual row counts.
+"""
+import hashlib
+import math
+import os
+import types
+import typing as tp
+
+from . import aggregates as agg
+from . import bloom
+from . import external_sort as sort
+from . import fusion
+from . import graph as graph_module
+from . import operations as ops
+from . import sketches
+from .stats import NodeStatistics, Statistics, StatisticsCollector
+
+TGraph = tp.Any  # graph.Graph, not imported by name to avoid circular import
+
+DEFAULT_MEMORY_LIMIT = 256 << 20
+DEFAULT_ROW_BYTES = 100.0
+HASH_TABLE_OVERHEAD = 4.0
+PARALLEL_SORT_ROWS = 1 << 20
+
+
+def describe(operation: ops.Operation | None) -> str:
+    """Logical description of operation, the same for all physical variants of it"""
+    if isinstance(operation, ops.ReadIterFactory):
+        return f"Source({operation.name})"
+    if isinstance(operation, ops.Read):
+        return f"Read({operation.filename})"
+    if isinstance(operation, ops.Map):
+        return f"Map({type(operation.mapper).__name__})"
+    if isinstance(operation, fusion.FusedMap):
+        return f"Map({', '.join(type(mapper).__name__ for mapper in operation.mappers)})"
+    if isinstance(operation, ops.Reduce):
+        if isinstance(operation.reducer, agg.Aggregate):
+            return f"Aggregate({list(operation.reducer.aggregates)}, {list(operation.keys)})"
+        return f"Reduce({type(operation.reducer).__name__}, {list(operation.keys)})"
+    if isinstance(operation, agg.HashAggregate):
+        return f"Aggregate({list(operation.aggregates)}, {list(operation.keys)})"
+    if isinstance(operation, sort.ExternalSort):
+        return f"Sort({list(operation.keys)})"
+    if isinstance(operation, sort.PartialSort):
+        return f"Sort({list(operation.keys)}, {operation.n})"
+    if isinstance(operation, ops.Limit):
+        return f"Limit({operation.n})"
+    if isinstance(operation, (ops.Join, ops.HashJoin, bloom.BloomSemiJoin)):
+        return f"Join({type(operation.joiner).__name__}, {list(operation.keys)})"
+    if isinstance(operation, ops.TopK):
+        return f"TopK({operation.column}, {operation.k}, {list(operation.keys)})"
+    if isinstance(operation, sketches.HeavyHitters):
+        return f"HeavyHitters({list(operation.keys)}, {operation.k})"
+    return type(operation).__name__
+
+
+def _strategy(operation: ops.Operation | None) -> str:
+    """Physical variant of operation shown by explain"""
+    if isinstance(operation, sort.ParallelSort):
+        return f"parallel, {operation.workers} workers"
+    if isinstance(operation, sort.ExternalSort):
+        return "external"
+    if isinstance(operation, sort.PartialSort):
+        return "heap"
+    if isinstance(operation, ops.HashJoin):
+        return "hash" if operation.build == "b" else "broadcast"
+    if isinstance(operation, ops.Join):
+        return "merge"
+    if isinstance(operation, bloom.BloomSemiJoin):
+        return "merge, bloom filter"
+    if isinstance(operation, agg.HashAggregate):
+        return "hash"
+    if isinstance(operation, ops.Reduce) and isinstance(operation.reducer, agg.Aggregate):
+        return "sort"
+    return ""
+
+
+def _nodes(graph: TGraph) -> list[TGraph]:
+    """All nodes of graph, inputs before consumers"""
+    seen: set[int] = set()
+    order: list[TGraph] = []
+
+    def visit(node: TGraph) -> None:
+        if id(node) in seen:
+            return
+        seen.add(id(node))
+        for child in node.graphs:
+            visit(child)
+        order.append(node)
+
+    visit(graph)
+    return order
+
+
+def _keys_used(operation: ops.Operation | None) -> tuple[str, ...] | None:
+    """Keys operation groups or orders its (every) input by"""
+    if isinstance(operation, (sort.ExternalSort, sort.PartialSort, ops.Reduce, agg.HashAggregate)):
+        return tuple(operation.keys)
+    if isinstance(operation, (ops.Join, ops.HashJoin, bloom.BloomSemiJoin)):
+        return tuple(operation.keys)
+    if isinstance(operation, (ops.TopK, sketches.HeavyHitters)):
+        return tuple(operation.keys)
+    return None
+
+
+class _Undescribable(Exception):
+    """Value has no description which is the same in every process and changes with it"""
+
+
+class _Describer:
+    """Descriptions of values which are the same in every process and change with any parameter of them.
+    Dictionaries (see ops.Dictionary) are described by the order of their first appearance: their values
+    change while the graph runs, but graphs sharing a dictionary differ from graphs using separate ones"""
+
+    def __init__(self) -> None:
+        self.dictionaries: dict[int, int] = {}
+        self._functions: set[int] = set()  # functions being described, to stop at recursive ones
+
+    def __call__(self, value: tp.Any, depth: int = 0) -> str:
+        """Description of value, raises _Undescribable if there is no stable one"""
+        if value is None or isinstance(value, (bool, int, float, str, bytes)):
+            return repr(value)
+        if depth > 8:
+            raise _Undescribable(type(value).__qualname__)
+        if isinstance(value, (list, tuple, set, frozenset)):
+            items = [self(item, depth + 1) for item in value]
+            return f"[{', '.join(sorted(items) if isinstance(value, (set, frozenset)) else items)}]"
+        if isinstance(value, dict):
+            return "{" + ", ".join(f"{self(k, depth + 1)}: {self(v, depth + 1)}" for k, v in value.items()) + "}"
+        if isinstance(value, ops.Dictionary):
+            return f"Dictionary#{self.dictionaries.setdefault(id(value), len(self.dictionaries))}"
+        if isinstance(value, types.ModuleType):
+            return value.__name__
+        if isinstance(value, (type, types.BuiltinFunctionType)):
+            return f"{value.__module__}.{value.__qualname__}"
+        if isinstance(value, types.MethodType):
+            return f"{self(value.__self__, depth + 1)}.{self(value.__func__, depth)}"
+        if isinstance(value, types.FunctionType):
+            return self._function(value, depth)
+        if hasattr(value, "__dict__"):
+            attributes = ", ".join(
+                f"{name}={self(attribute, depth + 1)}" for name, attribute in sorted(vars(value).items())
+            )
+            return f"{type(value).__qualname__}({attributes})"
+        description = repr(value)
+        if " at 0x" in description:
+            raise _Undescribable(type(value).__qualname__)
+        return description
+
+    def _function(self, function: types.FunctionType, depth: int) -> str:
+        name = f"{function.__module__}.{function.__qualname__}"
+        if id(function) in self._functions:
+            return name
+        self._functions.add(id(function))
+        try:
+            content, names = self._code(function.__code__)
+            try:
+                cells = [cell.cell_contents for cell in function.__closure__ or ()]
+            except ValueError:  # closure variable is not assigned yet
+                raise _Undescribable(name)
+            used_globals = {key: function.__globals__[key] for key in sorted(names) if key in function.__globals__}
+            parameters = [cells, function.__defaults__, function.__kwdefaults__, used_globals]
+            content += self(parameters, depth + 1).encode()
+        finally:
+            self._functions.discard(id(function))
+        return f"{name}:{hashlib.blake2b(content, digest_size=8).hexdigest()}"
+
+    def _code(self, code: types.CodeType) -> tuple[bytes, set[str]]:
+        """Bytecode and constants of code with its nested code (lambdas, comprehensions) and names it refers to"""
+        content, names = [code.co_code], set(code.co_names)
+        consts = []
+        for const in code.co_consts:
+            if isinstance(const, types.CodeType):
+                nested, nested_names = self._code(const)
+                content.append(nested)
+                names |= nested_names
+            else:
+                consts.append(const)
+        content.append(self(consts, 1).encode())
+        return b"|".join(content), names
+
+
+def fingerprints(
+    graph: TGraph, version: tp.Callable[[ops.Operation | None], str] | None = None
+) -> dict[int, str | None]:
+    """Fingerprints of all nodes of graph by node id: digests of operations with all their parameters (including
+    code of functions with their closures, defaults and globals they use) and of fingerprints of their inputs.
+    A node with a parameter without stable description (e.g. a lock or an open file) and nodes depending on it
+    can't be identified across runs, their fingerprints are None
+    :param graph: graph
+    :param version: version of data read by a source operation, a part of its fingerprint
+    """
+    result: dict[int, str | None] = {}
+    describe_ = _Describer()
+    for node in _nodes(graph):
+        children = [result[id(child)] for child in node.graphs]
+        try:
+            parameters = describe_(node.operation)
+        except _Undescribable:
+            parameters = None
+        if parameters is None or None in children:
+            result[id(node)] = None
+            continue
+        source = version(node.operation) if version is not None and not node.graphs else ""
+        description = "|".join([parameters, source] + tp.cast(list[str], children))
+        result[id(node)] = hashlib.blake2b(description.encode(), digest_size=16).hexdigest()
+    return result
+
+
+def execute(
+    graph: TGraph, observe: tp.Callable[[TGraph, tp.Iterator[tp.Any]], tp.Iterator[tp.Any]], **kwargs: tp.Any
+) -> ops.TRowsGenerator:
+    """Run graph as Graph.run does, passing rows produced by every node through observe(node, rows)"""
+
+    def run(node: TGraph) -> tp.Generator[tp.Any, None, None]:
+        op = node.operation
+        if op is None:
+            raise TypeError
+        if not node.graphs:
+            yield from observe(node, op(**kwargs))
+            return
+        inputs = [run(child) for child in node.graphs]
+        try:
+            yield from observe(node, op(*inputs))
+        finally:
+            for rows in inputs:
+                ops.close_rows(rows)
+
+    rows = run(graph)
+    try:
+        if graph.schema is None:
+            yield from rows
+        else:
+            yield from map(graph.schema.unpack, rows)
+    finally:
+        rows.close()
+
+
+def analyze(graph: TGraph, statistics: Statistics | None = None, **kwargs: tp.Any) -> Statistics:
+    """Run graph and record statistics of every node
+    :param graph: graph to run
+    :param statistics: statistics to update, new ones are created if not passed
+    :param kwargs: data sources
+    """
+    statistics = statistics if statistics is not None else Statistics()
+    nodes = _nodes(graph)
+    keys: dict[int, set[tuple[str, ...]]] = {id(node): set() for node in nodes}
+    for node in nodes:
+        used = _keys_used(node.operation)
+        if used:
+            for child in node.graphs:
+                keys[id(child)].add(used)
+    node_fingerprints = fingerprints(graph)
+
+    def observe(node: TGraph, rows: tp.Iterator[tp.Any]) -> tp.Iterator[tp.Any]:
+        collector = StatisticsCollector(keys[id(node)], node.schema)
+        yield from collector.observe(rows)
+        fingerprint = node_fingerprints[id(node)]
+        if fingerprint is not None:
+            statistics.nodes[fingerprint] = collector.result()
+
+    for _ in execute(graph, observe, **kwargs):
+        pass
+    return statistics
+
+
+def _sort_cost(rows: float) -> float:
+    return rows * math.log2(rows + 2)
+
+
+class Planner:
+    """Chooses physical operations of a graph by estimated costs"""
+
+    def __init__(
+        self,
+        statistics: Statistics | None = None,
+        memory_limit: int = DEFAULT_MEMORY_LIMIT,
+        max_workers: int | None = None,
+    ) -> None:
+        """
+        :param statistics: statistics of previous runs, without them graph is kept as it is
+        :param memory_limit: memory in bytes a hash table may take
+        :param max_workers: maximum number of processes of a sort, number of CPUs by default
+        """
+        self.statistics = statistics if statistics is not None else Statistics()
+        self.memory_limit = memory_limit
+        self.max_workers = max_workers if max_workers is not None else (os.cpu_count() or 1)
+        self.fingerprints: dict[int, str | None] = {}
+        self.estimates: dict[int, float | None] = {}
+        self._planned: dict[int, TGraph] = {}
+
+    def _statistics(self, node: TGraph) -> NodeStatistics | None:
+        fingerprint = self.fingerprints[id(node)]
+        return self.statistics.get(fingerprint) if fingerprint is not None else None
+
+    def rows(self, node: TGraph) -> float | None:
+        """Estimated number of rows produced by logical node"""
+        if id(node) in self.estimates:
+            return self.estimates[id(node)]
+        statistics = self._statistics(node)
+        op = node.operation
+        estimate: float | None
+        if statistics is not None:
+            estimate = statistics.rows
+        elif not node.graphs:
+            estimate = None
+        elif isinstance(op, (ops.Reduce, agg.HashAggregate)):
+            estimate = self.distinct(node.graphs[0], op.keys)
+        elif isinstance(op, (ops.Sample, ops.Limit, sort.PartialSort)):
+            child = self.rows(node.graphs[0])
+            estimate = min(child, op.n) if child is not None else op.n
+        else:
+            estimate = self.rows(node.graphs[0])
+        self.estimates[id(node)] = estimate
+        return estimate
+
+    def distinct(self, node: TGraph, keys: tp.Sequence[str]) -> float | None:
+        """Estimated number of distinct keys in rows produced by logical node"""
+        statistics = self._statistics(node)
+        if statistics is not None and tuple(keys) in statistics.distinct:
+            return statistics.distinct[tuple(keys)]
+        if not keys:
+            return 1.0
+        return self.rows(node)
+
+    def _bytes(self, node: TGraph) -> float:
+        statistics = self._statistics(node)
+        return statistics.row_bytes if statistics is not None and statistics.row_bytes else DEFAULT_ROW_BYTES
+
+    def plan(self, graph: TGraph) -> TGraph:
+        """Physical graph with the same output as graph"""
+        self.fingerprints.update(fingerprints(graph))
+        return self._plan(graph)
+
+    def _node(self, operation: ops.Operation, schema: tp.Any, *children: TGraph) -> TGraph:
+        node = graph_module.Graph(*children)
+        node.operation = operation
+        node.schema = schema
+        return node
+
+    def _sorted(self, node: TGraph, keys: tp.Sequence[str]) -> TGraph:
+        """Physical sort of planned node"""
+        rows = self.rows(node)
+        operation: sort.ExternalSort
+        if rows is not None and rows >= PARALLEL_SORT_ROWS and self.max_workers > 1:
+            workers = min(self.max_workers, math.ceil(rows / PARALLEL_SORT_ROWS))
+            operation = sort.ParallelSort(keys, workers, node.schema)
+        else:
+            operation = sort.ExternalSort(keys, node.schema)
+        sorted_node = self._node(operation, node.schema, self._plan(node))
+        self.estimates[id(sorted_node)] = rows
+        return sorted_node
+
+    def _plan(self, node: TGraph) -> TGraph:
+        if id(node) in self._planned:
+            return self._planned[id(node)]
+        op = node.operation
+        planned: TGraph
+        if isinstance(op, ops.Join) and isinstance(op.joiner, ops.MergeJoiner):
+            planned = self._plan_join(node, op)
+        elif isinstance(op, agg.HashAggregate):
+            planned = self._plan_aggregate(node, op)
+        elif type(op) is sort.ExternalSort:
+            planned = self._sorted(node.graphs[0], op.keys)
+        else:
+            planned = self._node(op, node.schema, *(self._plan(child) for child in node.graphs))
+        self.fingerprints[id(planned)] = self.fingerprints[id(node)]
+        self.estimates[id(planned)] = self.rows(node)
+        self._planned[id(node)] = planned
+        return planned
+
+    def _plan_join(self, node: TGraph, op: ops.Join) -> TGraph:
+        joiner = op.joiner
+        assert isinstance(joiner, ops.MergeJoiner)
+        left, right = node.graphs
+        rows_a, rows_b = self.rows(left), self.rows(right)
+
+        def sorted_by_keys(child: TGraph) -> bool:
+            return isinstance(child.operation, sort.ExternalSort) and list(child.operation.keys) == list(op.keys)
+
+        costs: dict[str, float] = {}
+        if rows_a is not None and rows_b is not None:
+            costs["merge"] = _sort_cost(rows_a) + _sort_cost(rows_b) + rows_a + rows_b
+            fits_b = rows_b * self._bytes(right) * HASH_TABLE_OVERHEAD <= self.memory_limit
+            if not joiner.keep_b and sorted_by_keys(right) and fits_b:
+                costs["b"] = _sort_cost(rows_a) + rows_a + rows_b
+            fits_a = rows_a * self._bytes(left) * HASH_TABLE_OVERHEAD <= self.memory_limit
+            if not joiner.keep_a and sorted_by_keys(left) and fits_a:
+                costs["a"] = _sort_cost(rows_b) + rows_a + rows_b
+        choice = min(costs, key=costs.__getitem__) if costs else "merge"
+
+        if choice == "b":
+            build = right.graphs[0]
+            hash_join = ops.HashJoin(joiner, op.keys, "b", op.schema_a, build.schema)
+            return self._node(hash_join, None, self._plan(left), self._plan(build))
+        if choice == "a":
+            build = left.graphs[0]
+            hash_join = ops.HashJoin(joiner, op.keys, "a", build.schema, op.schema_b)
+            return self._node(hash_join, None, self._plan(build), self._plan(right))
+        return self._node(op, node.schema, self._plan(left), self._plan(right))
+
+    def _plan_aggregate(self, node: TGraph, op: agg.HashAggregate) -> TGraph:
+        child = node.graphs[0]
+        groups = self.distinct(child, op.keys)
+        group_bytes = 100.0
+        for aggregate in op.aggregates.values():
+            group_bytes += 2 ** aggregate.precision if isinstance(aggregate, agg.ApproxDistinct) else 50
+        if groups is None or groups * group_bytes <= self.memory_limit:
+            return self._node(op, node.schema, self._plan(child))
+        reducer = ops.Reduce(agg.Aggregate(op.aggregates), op.keys, op.schema)
+        return self._node(reducer, node.schema, self._sorted(child, op.keys))
+
+    def explain(self, graph: TGraph, **kwargs: tp.Any) -> str:
+        """Plan graph and describe the plan; if data sources are passed, planned graph is run to show actual row counts
+        :param graph: graph to plan
+        :param kwargs: data sources
+        """
+        planned = self.plan(graph)
+        actual: dict[int, int] = {}
+        if kwargs:
+            def observe(node: TGraph, rows: tp.Iterator[tp.Any]) -> tp.Iterator[tp.Any]:
+                count = 0
+                for row in rows:
+                    count += 1
+                    yield row
+                actual[id(node)] = count
+
+            for _ in execute(planned, observe, **kwargs):
+                pass
+
+        lines: list[str] = []
+
+        def render(node: TGraph, depth: int) -> None:
+            strategy = _strategy(node.operation)
+            estimate = self.estimates.get(id(node))
+            line = "  " * depth + describe(node.operation)
+            if strategy:
+                line += f" [{strategy}]"
+            line += f"  rows: estimated {'?' if estimate is None else round(estimate)}"
+            if id(node) in actual:
+                line += f", actual {actual[id(node)]}"
+            lines.append(line)
+            for child in node.graphs:
+                render(child, depth + 1)
+
+        render(planned, 0)
+        return "\n".join(lines)
@@ -0,0 +1,192 @@
+"""
+Worker processes for sorts and parallel stages and the runtime owning a pool of them.
+
+Without an active runtime every sort starts a new process and stops it afterwards. A runtime keeps a pool
+of warm worker processes which operations borrow for a task and give back when the task is completed,
+so repeated runs of graphs (and graphs with many sorts) don't pay for process start-up:
+
+    with Runtime(workers=4):
+        for source in sources:
+            rows = list(graph.run(input=source))
+
+A task is a module-level function taking connection to the operation as its first argument.
+A worker whose task was not completed (consumer stopped early, error) is terminated instead of being reused.
+"""
+import multiprocessing
+import os
+import threading
+import typing as tp
+
+from multiprocessing.connection import Connection
+
+TTask = tp.Callable[..., None]
+
+STOP_SECONDS = 1.0
+
+
+def _serve(connection: Connection) -> None:
+    """Run tasks received from connection until None is received or connection is closed"""
+    while True:
+        try:
+            task = connection.recv()
+        except (EOFError, OSError):
+            return
+        if task is None:
+            return
+        function, args = task
+        function(connection, *args)
+
+
+class Worker:
+    """Worker process and connection to it"""
+
+    def __init__(self, context: tp.Any, pool: "WorkerPool | None" = None) -> None:
+        """
+        :param context: multiprocessing context to start process with
+        :param pool: pool to give worker back to on release, worker is stopped on release if not passed
+        """
+        self.connection, remote_connection = context.Pipe()
+        self.process = context.Process(target=_serve, args=(remote_connection,), daemon=True)
+        self.process.start()
+        # only the worker holds the other end, so recv fails instead of waiting forever if the worker dies
+        remote_connection.close()
+        self.pool = pool
+
+    def start(self, function: TTask, *args: tp.Any) -> Connection:
+        """Start task in worker
+        :param function: module-level function called as function(connection, *args) in worker
+        :return: connection to the task
+        """
+        self.connection.send((function, args))
+        return self.connection
+
+    def release(self, completed: bool) -> None:
+        """Give worker back to its pool or stop it
+        :param completed: task protocol was completed, so worker is waiting for the next task
+        """
+        if completed and self.pool is not None and self.pool._give_back(self):
+            return
+        self.stop(terminate=not completed)
+
+    def stop(self, terminate: bool = True) -> None:
+        """Stop worker process
+        :param terminate: terminate process in the middle of task instead of letting it exit, a process not
+            exiting in STOP_SECONDS is terminated anyway
+        """
+        if not terminate:
+            # other processes forked meanwhile hold copies of the connection, so worker may never see it closed
+            try:
+                self.connection.send(None)
+            except OSError:
+                terminate = True
+        self.connection.close()
+        if not terminate:
+            # a worker stuck in a task never takes the next message, it is terminated after a while
+            self.process.join(STOP_SECONDS)
+        if self.process.is_alive():
+            self.process.terminate()
+            self.process.join(STOP_SECONDS)
+        if self.process.is_alive():
+            self.process.kill()
+        self.process.join()
+
+
+class WorkerPool:
+    """Warm worker processes borrowed by operations, more are started when all of them are busy"""
+
+    def __init__(self, size: int, start_method: str | None = None, prestart: bool = True) -> None:
+        """
+        :param size: number of idle workers kept
+        :param start_method: multiprocessing start method ('fork', 'forkserver', 'spawn'), platform default if None
+        :param prestart: start all workers at once instead of on first use
+        """
+        self.size = size
+        self.context = multiprocessing.get_context(start_method)
+        if start_method == "forkserver":
+            # workers forked by the server don't import operations on their first task
+            self.context.set_forkserver_preload([f"{__package__}.external_sort"])
+        self._idle: list[Worker] = []
+        self._lock = threading.Lock()
+        self._closed = False
+        if prestart:
+            self._idle.extend(Worker(self.context, self) for _ in range(size))
+
+    def acquire(self) -> Worker:
+        """Idle worker or a new one if there are none"""
+        with self._lock:
+            while self._idle:
+                worker = self._idle.pop()
+                if worker.process.is_alive():
+                    return worker
+                worker.stop()
+        return Worker(self.context, self)
+
+    def _give_back(self, worker: Worker) -> bool:
+        with self._lock:
+            if self._closed or len(self._idle) >= self.size:
+                return False
+            self._idle.append(worker)
+            return True
+
+    def close(self) -> None:
+        """Stop idle workers, busy ones are stopped when released"""
+        with self._lock:
+            self._closed = True
+            idle, self._idle = self._idle, []
+        for worker in idle:
+            worker.stop(terminate=False)
+
+
+class Runtime:
+    """
+    Resources shared by runs of graphs: pool of warm workers for sorts and parallel stages.
+    Operations use the runtime active in the process (see current), it is activated by with-statement
+    and closed on exit.
+    """
+
+    def __init__(self, workers: int | None = None, start_method: str | None = None) -> None:
+        """
+        :param workers: number of warm workers, number of CPUs by default
+        :param start_method: multiprocessing start method, 'forkserver' starts workers from a clean process
+            (no memory of the parent is shared, fork of a large parent is not paid), platform default if None
+        """
+        self.pool = WorkerPool(workers if workers is not None else (os.cpu_count() or 1), start_method)
+        self._pid = os.getpid()
+
+    def worker(self) -> Worker:
+        """Borrow worker, it must be released after its task"""
+        return self.pool.acquire()
+
+    def close(self) -> None:
+        """Stop all workers"""
+        self.pool.close()
+
+    def __enter__(self) -> "Runtime":
+        _active.append(self)
+        return self
+
+    def __exit__(self, *exc_info: tp.Any) -> None:
+        _active.remove(self)
+        self.close()
+
+
+_active: list[Runtime] = []
+
+
+def current() -> Runtime | None:
+    """Runtime activated last in this process (not inherited by forked workers) or None"""
+    for runtime in reversed(_active):
+        if runtime._pid == os.getpid():
+            return runtime
+    return None
+
+
+def start_task(function: TTask, *args: tp.Any) -> Worker:
+    """Start task in a worker borrowed from the current runtime or in a new process if there is no runtime
+    :param function: module-level function called as function(connection, *args) in worker
+    :return: worker running the task, its connection is worker.connection; it must be released afterwards
+    """
+    runtime = current()
+    worker = runtime.worker() if runtime is not None else Worker(multiprocessing.get_context())
+    worker.start(function, *args)
+    return worker
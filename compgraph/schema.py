@@ -0,0 +1,101 @@
+import typing as tp
+from operator import itemgetter
+
+
+# Compact row is a tuple of values in schema order; it travels through the same
+# operation signatures as dict rows, hence it is not narrowed for type checker
+TCompactRow = tp.Any
+TKeyGetter = tp.Callable[[tp.Any], tuple[tp.Any, ...]]
+
+
+def _getter(items: tp.Sequence[tp.Any]) -> TKeyGetter:
+    """Build function extracting tuple of items from row, both for dict rows (by names)
+    and compact rows (by positions)
+    :param items: column names or positions
+    """
+    if len(items) == 0:
+        return lambda row: ()
+    if len(items) == 1:
+        item = items[0]
+        return lambda row: (row[item],)
+    return itemgetter(*items)
+
+
+class Schema:
+    """
+    Fixed ordered set of columns.
+    Rows of a graph with schema are stored inside of the engine as compact tuples of values in schema order
+    instead of dicts repeating every column name, and are converted back to dicts only at API boundaries
+    (user mappers, reducers and joiners, graph output).
+    Built-in Project, Recode, FilterPunctuation, LowerCase and Split mappers work on compact rows directly;
+    Filter keeps rows compact but unpacks each of them to a dict for its condition. Any other mapper gets
+    dict rows, and the graph after it has no schema.
+    """
+
+    def __init__(self, columns: tp.Sequence[str]) -> None:
+        """
+        :param columns: column names in storage order
+        """
+        self.columns = tuple(columns)
+        self.positions = {column: position for position, column in enumerate(self.columns)}
+        if len(self.positions) != len(self.columns):
+            raise ValueError(f"Duplicate columns in schema {self.columns}")
+        self._pack = _getter(self.columns)
+
+    def __repr__(self) -> str:
+        return f"Schema({list(self.columns)})"
+
+    def __eq__(self, other: object) -> bool:
+        return isinstance(other, Schema) and self.columns == other.columns
+
+    def __hash__(self) -> int:
+        return hash(self.columns)
+
+    def pack(self, row: tp.Mapping[str, tp.Any]) -> TCompactRow:
+        """Convert dict row into compact row, every column of schema must be present
+        :param row: dict row
+        """
+        return self._pack(row)
+
+    def unpack(self, values: TCompactRow) -> dict[str, tp.Any]:
+        """Convert compact row into dict row
+        :param values: compact row
+        """
+        return dict(zip(self.columns, values))
+
+    def getter(self, keys: tp.Sequence[str]) -> TKeyGetter:
+        """Build positional extractor of key tuple from compact rows
+        :param keys: column names
+        """
+        return _getter([self.positions[key] for key in keys])
+
+    def position(self, column: str) -> int:
+        """
+        :param column: column name
+        """
+        return self.positions[column]
+
+    def project(self, columns: tp.Sequence[str]) -> "Schema":
+        """Schema with only mentioned columns that are present in this schema
+        :param columns: column names
+        """
+        return Schema([column for column in dict.fromkeys(columns) if column in self.positions])
+
+
+def key_getter(keys: tp.Sequence[str], schema: Schema | None = None) -> TKeyGetter:
+    """Build extractor of key tuple from rows
+    :param keys: column names
+    :param schema: schema of compact rows or None for dict rows
+    """
+    if schema is None:
+        return _getter(keys)
+    return schema.getter(keys)
+
+
+def unpacker(schema: Schema | None) -> tp.Callable[[tp.Any], dict[str, tp.Any]]:
+    """Build converter of rows to dict rows
+    :param schema: schema of compact rows or None for dict rows
+    """
+    if schema is None:
+        return lambda row: row
+    return schema.unpack
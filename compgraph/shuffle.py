@@ -0,0 +1,202 @@
+"""
+Disk-backed shuffle between map and reduce stages.
+
+Every map task hash-partitions its output by keys into per-partition files of pickled batches
+(rows are stored as tuples if columns are given). Files are written into a private attempt directory,
+which is renamed to map-<id> with a manifest on commit, so a crashed or repeated attempt never
+leaves a half-written output visible: the first committed attempt of a map task wins.
+Files, the manifest and the rename are flushed to disk before commit returns.
+Reduce side reads a partition sequentially file after file from committed map outputs only,
+committed files are immutable, so a partition can be read again if its reader crashes.
+"""
+import json
+import os
+import pickle
+import shutil
+import tempfile
+import typing as tp
+
+from . import operations as ops
+from .schema import Schema, key_getter
+from .sketches import hash64
+from .spill import SPILL_BATCH_SIZE, load_batches, sync_directory
+
+MANIFEST = "manifest.json"
+FILE_BUFFER_SIZE = 1 << 20
+
+
+class Shuffle:
+    """Location and layout of shuffle data shared by map and reduce tasks (may be on a shared filesystem)"""
+
+    def __init__(
+        self,
+        directory: str,
+        keys: tp.Sequence[str],
+        partitions: int,
+        columns: tp.Sequence[str] | None = None,
+    ) -> None:
+        """
+        :param directory: directory for shuffle data, created if missing
+        :param keys: keys to partition rows by
+        :param partitions: number of partitions
+        :param columns: columns of rows to store rows compactly as tuples, dicts are stored if not passed
+        """
+        if partitions < 1:
+            raise ValueError("partitions must be positive")
+        self.directory = directory
+        self.keys = tuple(keys)
+        self.partitions = partitions
+        self.columns = tuple(columns) if columns is not None else None
+        os.makedirs(directory, exist_ok=True)
+
+    def _map_directory(self, map_id: int) -> str:
+        return os.path.join(self.directory, f"map-{map_id}")
+
+    def writer(self, map_id: int, buffer_size: int = FILE_BUFFER_SIZE) -> "ShuffleWriter":
+        """Writer of output of map task
+        :param map_id: index of map task
+        :param buffer_size: buffer size of every partition file
+        """
+        return ShuffleWriter(self, map_id, buffer_size)
+
+    def committed_maps(self) -> list[int]:
+        """Indices of map tasks with committed output"""
+        maps = []
+        for name in os.listdir(self.directory):
+            prefix, _, map_id = name.partition("-")
+            if prefix == "map" and map_id.isdigit() and os.path.exists(os.path.join(self.directory, name, MANIFEST)):
+                maps.append(int(map_id))
+        return sorted(maps)
+
+    def read(self, partition: int, maps: int | None = None) -> ops.TRowsGenerator:
+        """Read rows of partition written by all committed map tasks in order of map tasks
+        :param partition: partition index
+        :param maps: number of map tasks, all of them must be committed if passed
+        """
+        committed = self.committed_maps()
+        if maps is not None and committed != list(range(maps)):
+            raise FileNotFoundError(f"Output of map tasks {sorted(set(range(maps)) - set(committed))} is missing")
+        unpack = Schema(self.columns).unpack if self.columns is not None else None
+        for map_id in committed:
+            path = os.path.join(self._map_directory(map_id), f"part-{partition}")
+            with open(path, "rb", buffering=FILE_BUFFER_SIZE) as file:
+                if unpack is None:
+                    yield from load_batches(file)
+                else:
+                    yield from map(unpack, load_batches(file))
+
+    def partition(self, partition: int, maps: int | None = None) -> "ShufflePartition":
+        """Re-iterable (and picklable) rows of partition, see read"""
+        return ShufflePartition(self, partition, maps)
+
+    def cleanup(self) -> None:
+        """Remove all shuffle data"""
+        shutil.rmtree(self.directory, ignore_errors=True)
+
+
+class ShufflePartition:
+    """Rows of a shuffle partition, read from disk on every iteration"""
+
+    def __init__(self, shuffle: Shuffle, partition: int, maps: int | None = None) -> None:
+        self.shuffle = shuffle
+        self.partition = partition
+        self.maps = maps
+
+    def __iter__(self) -> tp.Iterator[ops.TRow]:
+        return self.shuffle.read(self.partition, self.maps)
+
+
+class ShuffleWriter:
+    """
+    Hash-partitions rows of a map task into files of its attempt directory.
+    Output becomes visible to readers only after commit; used as context manager it commits on success
+    and removes the attempt on error.
+    """
+
+    def __init__(self, shuffle: Shuffle, map_id: int, buffer_size: int = FILE_BUFFER_SIZE) -> None:
+        """
+        :param shuffle: shuffle to write to
+        :param map_id: index of map task
+        :param buffer_size: buffer size of every partition file
+        """
+        self.shuffle = shuffle
+        self.map_id = map_id
+        self.attempt = tempfile.mkdtemp(prefix=f"attempt-{map_id}-", dir=shuffle.directory)
+        self.files = [
+            open(os.path.join(self.attempt, f"part-{partition}"), "wb", buffering=buffer_size)
+            for partition in range(shuffle.partitions)
+        ]
+        self.batches: list[list[tp.Any]] = [[] for _ in range(shuffle.partitions)]
+        self.rows = [0] * shuffle.partitions
+        self._get_key = key_getter(shuffle.keys)
+        self._pack = Schema(shuffle.columns).pack if shuffle.columns is not None else None
+
+    def write(self, row: ops.TRow) -> None:
+        """
+        :param row: row to write
+        """
+        partition = hash64(self._get_key(row)) % self.shuffle.partitions
+        batch = self.batches[partition]
+        batch.append(row if self._pack is None else self._pack(row))
+        if len(batch) >= SPILL_BATCH_SIZE:
+            self._flush(partition)
+
+    def write_all(self, rows: ops.TRowsIterable) -> None:
+        """
+        :param rows: rows to write
+        """
+        for row in rows:
+            self.write(row)
+
+    def write_partition(self, partition: int, rows: tp.Iterable[ops.TRow]) -> None:
+        """Write rows already partitioned by the same hash of keys (e.g. by the map task itself)
+        :param partition: partition of all rows
+        :param rows: rows to write
+        """
+        batch = self.batches[partition]
+        batch.extend(rows if self._pack is None else map(self._pack, rows))
+        if len(batch) >= SPILL_BATCH_SIZE:
+            self._flush(partition)
+
+    def _flush(self, partition: int) -> None:
+        batch = self.batches[partition]
+        pickle.dump(batch, self.files[partition], pickle.HIGHEST_PROTOCOL)
+        self.rows[partition] += len(batch)
+        self.batches[partition] = []
+
+    def commit(self) -> None:
+        """Make output visible to readers, output of another attempt of the same task is kept if already committed"""
+        for partition, batch in enumerate(self.batches):
+            if batch:
+                self._flush(partition)
+        for file in self.files:
+            file.flush()
+            os.fsync(file.fileno())
+            file.close()
+        with open(os.path.join(self.attempt, MANIFEST), "w") as manifest:
+            json.dump({"map_id": self.map_id, "rows": self.rows}, manifest)
+            manifest.flush()
+            os.fsync(manifest.fileno())
+        sync_directory(self.attempt)
+        try:
+            os.rename(self.attempt, self.shuffle._map_directory(self.map_id))
+        except OSError:
+            shutil.rmtree(self.attempt, ignore_errors=True)
+            return
+        # the rename is durable only once the shuffle directory is flushed
+        sync_directory(self.shuffle.directory)
+
+    def abort(self) -> None:
+        """Drop output of the attempt"""
+        for file in self.files:
+            file.close()
+        shutil.rmtree(self.attempt, ignore_errors=True)
+
+    def __enter__(self) -> "ShuffleWriter":
+        return self
+
+    def __exit__(self, exc_type: tp.Any, *exc_info: tp.Any) -> None:
+        if exc_type is None:
+            self.commit()
+        else:
+            self.abort()
@@ -0,0 +1,174 @@
+import hashlib
+import heapq
+import math
+import typing as tp
+
+from operator import itemgetter
+
+from . import operations as ops
+from .key_codec import encode_key, encode_value
+from .schema import Schema, key_getter
+
+
+def hash64(value: tp.Any) -> int:
+    """Stable (the same in every process) 64-bit hash of key value
+    :param value: value supported by key_codec
+    """
+    return int.from_bytes(hashlib.blake2b(encode_value(value), digest_size=8).digest(), "little")
+
+
+class HyperLogLog:
+    """
+    HyperLogLog sketch estimating number of distinct values with 2 ** precision bytes of state.
+    Relative error is about 1.04 / sqrt(2 ** precision), e.g. 1.6% for precision 12 (4 KiB).
+    Sketches with the same precision are mergeable.
+    """
+
+    def __init__(self, precision: int = 12) -> None:
+        """
+        :param precision: number of hash bits used to choose a register, from 4 to 18
+        """
+        if not 4 <= precision <= 18:
+            raise ValueError("precision must be in [4, 18]")
+        self.precision = precision
+        self.registers = bytearray(1 << precision)
+
+    def add(self, value: tp.Any) -> None:
+        """
+        :param value: value to count
+        """
+        self.add_hash(hash64(value))
+
+    def add_hash(self, hashed: int) -> None:
+        """
+        :param hashed: 64-bit hash of value to count
+        """
+        rest_bits = 64 - self.precision
+        index = hashed >> rest_bits
+        rank = rest_bits - (hashed & ((1 << rest_bits) - 1)).bit_length() + 1
+        if rank > self.registers[index]:
+            self.registers[index] = rank
+
+    def merge(self, other: "HyperLogLog") -> "HyperLogLog":
+        """Sketch of union of both counted sets
+        :param other: sketch with the same precision
+        """
+        if other.precision != self.precision:
+            raise ValueError("Only sketches with the same precision can be merged")
+        merged = HyperLogLog(self.precision)
+        merged.registers = bytearray(map(max, self.registers, other.registers))
+        return merged
+
+    def count(self) -> float:
+        """Estimated number of distinct values"""
+        size = len(self.registers)
+        alpha = {16: 0.673, 32: 0.697, 64: 0.709}.get(size, 0.7213 / (1 + 1.079 / size))
+        estimate = alpha * size * size / sum(2.0 ** -register for register in self.registers)
+        zeros = self.registers.count(0)
+        if estimate <= 2.5 * size and zeros:
+            return size * math.log(size / zeros)
+        return estimate
+
+
+class SpaceSaving:
+    """
+    Space-Saving summary of the most frequent keys in a stream, keeps at most capacity counters.
+    Counter of a key overestimates its true count by at most its error, which never exceeds total / capacity,
+    so every key occurring more than total / capacity times is guaranteed to be counted.
+    """
+
+    def __init__(self, capacity: int) -> None:
+        """
+        :param capacity: maximum number of counted keys
+        """
+        if capacity < 1:
+            raise ValueError("capacity must be positive")
+        self.capacity = capacity
+        self.total = 0
+        self.counts: dict[tp.Any, int] = {}
+        self.errors: dict[tp.Any, int] = {}
+        # (count, sequence number, key) entries; stale ones (count differs from counts[key]) are skipped
+        self._heap: list[tuple[int, int, tp.Any]] = []
+        self._sequence = 0
+
+    def _push(self, key: tp.Any, count: int) -> None:
+        self._sequence += 1
+        heapq.heappush(self._heap, (count, self._sequence, key))
+        if len(self._heap) > 4 * self.capacity:
+            self._heap = [(count, i, key) for i, (key, count) in enumerate(self.counts.items())]
+            heapq.heapify(self._heap)
+
+    def add(self, key: tp.Any, count: int = 1) -> None:
+        """
+        :param key: key to count
+        :param count: number of occurrences
+        """
+        self.total += count
+        if key in self.counts:
+            self.counts[key] += count
+        elif len(self.counts) < self.capacity:
+            self.counts[key] = count
+            self.errors[key] = 0
+        else:
+            while True:
+                minimum, _, evicted = heapq.heappop(self._heap)
+                if self.counts.get(evicted) == minimum:
+                    break
+            del self.counts[evicted]
+            del self.errors[evicted]
+            self.counts[key] = minimum + count
+            self.errors[key] = minimum
+        self._push(key, self.counts[key])
+
+    def top(self, k: int) -> list[tuple[tp.Any, int, int]]:
+        """k keys with the largest counters as (key, count, error) triples, the most frequent first
+        :param k: number of keys
+        """
+        counters = ((key, count, self.errors[key]) for key, count in self.counts.items())
+        return heapq.nlargest(k, counters, key=itemgetter(1))
+
+
+class HeavyHitters(ops.Operation):
+    """
+    Approximate top of the most frequent keys in one streaming pass with fixed memory (see SpaceSaving).
+    Emits k rows with key columns, estimated count and its maximum overestimation, the most frequent first.
+    """
+
+    def __init__(
+        self,
+        keys: tp.Sequence[str],
+        k: int,
+        capacity: int | None = None,
+        count_column: str = "count",
+        error_column: str = "count_error",
+        schema: Schema | None = None,
+    ) -> None:
+        """
+        :param keys: columns forming counted key
+        :param k: number of keys to emit
+        :param capacity: number of counters, 10 * k by default; counts are overestimated at most by rows / capacity
+        :param count_column: column for estimated count
+        :param error_column: column for maximum overestimation of count
+        :param schema: schema of compact input rows or None for dict rows
+        """
+        self.keys = tuple(keys)
+        self.k = k
+        self.capacity = capacity if capacity is not None else 10 * k
+        self.count_column = count_column
+        self.error_column = error_column
+        self.schema = schema
+
+    def __call__(self, rows: ops.TRowsIterable, *args: tp.Any, **kwargs: tp.Any) -> ops.TRowsGenerator:
+        summary = SpaceSaving(self.capacity)
+        get_key = key_getter(self.keys, self.schema)
+        add = summary.add
+        for row in rows:
+            add(get_key(row))
+
+        top = summary.top(self.k)
+        top.sort(key=lambda item: (-item[1], encode_key(item[0])))
+        for key, count, error in top:
+            row = dict(zip(self.keys, key))
+            row[self.count_column] = count
+            row[self.error_column] = error
+            yield row
@@ -0,0 +1,111 @@
+import os
+import pickle
+import tempfile
+import typing as tp
+
+
+SPILL_BATCH_SIZE = 1024
+DEFAULT_MAX_ROWS = 1 << 16
+
+
+def dump_batches(rows: tp.Sequence[tp.Any], file: tp.IO[bytes]) -> None:
+    """Append rows to file in pickled batches
+    :param rows: rows to write
+    :param file: binary file opened for writing
+    """
+    for start in range(0, len(rows), SPILL_BATCH_SIZE):
+        pickle.dump(rows[start: start + SPILL_BATCH_SIZE], file, pickle.HIGHEST_PROTOCOL)
+
+
+def load_batches(file: tp.IO[bytes]) -> tp.Generator[tp.Any, None, None]:
+    """Read rows written by dump_batches from the current position up to the end of file
+    :param file: binary file opened for reading
+    """
+    while True:
+        try:
+            batch = pickle.load(file)
+        except EOFError:
+            return
+        yield from batch
+
+
+def sync_directory(directory: str) -> None:
+    """Flush entries of directory (created, renamed or removed files) to disk
+    :param directory: directory path
+    """
+    descriptor = os.open(directory, os.O_RDONLY)
+    try:
+        os.fsync(descriptor)
+    finally:
+        os.close(descriptor)
+
+
+class SpillBuffer:
+    """
+    Append-only buffer of rows, which can be iterated over many times.
+    First max_rows rows are kept in memory, once there are more of them all rows are moved to a temporary file,
+    so memory stays bounded for groups of any size while small groups cost the same as a list.
+    """
+
+    def __init__(self, max_rows: int = DEFAULT_MAX_ROWS) -> None:
+        """
+        :param max_rows: maximum number of rows kept in memory
+        """
+        self.max_rows = max_rows
+        self._rows: list[tp.Any] = []
+        self._file: tp.IO[bytes] | None = None
+        self._size = 0
+
+    def __len__(self) -> int:
+        return self._size
+
+    @property
+    def spilled(self) -> bool:
+        """Whether rows are stored on disk"""
+        return self._file is not None
+
+    def append(self, row: tp.Any) -> None:
+        """
+        :param row: row to add
+        """
+        self._size += 1
+        self._rows.append(row)
+        if self._file is None:
+            if len(self._rows) > self.max_rows:
+                self._file = tempfile.TemporaryFile()
+                self._flush()
+        elif len(self._rows) >= SPILL_BATCH_SIZE:
+            self._flush()
+
+    def extend(self, rows: tp.Iterable[tp.Any]) -> None:
+        """
+        :param rows: rows to add
+        """
+        for row in rows:
+            self.append(row)
+
+    def _flush(self) -> None:
+        assert self._file is not None
+        self._file.seek(0, 2)
+        dump_batches(self._rows, self._file)
+        self._rows = []
+
+    def __iter__(self) -> tp.Iterator[tp.Any]:
+        if self._file is None:
+            return iter(self._rows)
+        return self._replay()
+
+    def _replay(self) -> tp.Generator[tp.Any, None, None]:
+        assert self._file is not None
+        if self._rows:
+            self._flush()
+        self._file.seek(0)
+        yield from load_batches(self._file)
+
+    def close(self) -> None:
+        """Drop all rows and remove temporary file"""
+        if self._file is not None:
+            self._file.close()
+            self._file = None
+        self._rows = []
+        self._size = 0
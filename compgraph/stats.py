@@ -0,0 +1,186 @@
+import bisect
+import json
+import pickle
+import typing as tp
+
+from collections import Counter
+
+from . import operations as ops
+from .key_codec import encode_key
+from .schema import Schema, key_getter
+from .sketches import HyperLogLog, hash64
+
+
+def split_points(encoded_keys: tp.Sequence[bytes], parts: int) -> list[bytes]:
+    """Encoded keys splitting sorted sample of encoded keys into parts ranges of about equal size:
+    range i contains keys k with split_points[i - 1] <= k < split_points[i].
+    Equal split points are merged, so fewer ranges are given if a single key is heavier than a range
+    :param encoded_keys: sorted encoded keys (see key_codec)
+    :param parts: desired number of ranges
+    """
+    points: list[bytes] = []
+    if not encoded_keys:
+        return points
+    for i in range(1, parts):
+        point = encoded_keys[i * len(encoded_keys) // parts]
+        if not points or point > points[-1]:
+            points.append(point)
+    return points
+
+
+class KeyStatistics:
+    """
+    Approximate distribution of keys of a table estimated from its uniform sample (see Graph.sample):
+    quantiles in sort order, split points for even range partitioning and the most frequent (heavy) keys.
+    """
+
+    def __init__(self, keys: tp.Sequence[str], sample: ops.TRowsIterable, schema: Schema | None = None) -> None:
+        """
+        :param keys: columns forming key
+        :param sample: sampled rows
+        :param schema: schema of compact sampled rows or None for dict rows
+        """
+        self.keys = tuple(keys)
+        get_key = key_getter(self.keys, schema)
+        self.counts = Counter(get_key(row) for row in sample)
+        self.size = sum(self.counts.values())
+        encoded = sorted((encode_key(key), key) for key in self.counts.elements())
+        self._encoded = [encoded_key for encoded_key, _ in encoded]
+        self._sorted = [key for _, key in encoded]
+
+    def quantile(self, q: float) -> tuple[tp.Any, ...]:
+        """Key such that approximately q of all keys precede it in sort order
+        :param q: fraction from 0 to 1
+        """
+        if not self.size:
+            raise ValueError("Sample is empty")
+        if not 0 <= q <= 1:
+            raise ValueError("q must be in [0, 1]")
+        return self._sorted[min(int(q * self.size), self.size - 1)]
+
+    def split_points(self, parts: int) -> list[bytes]:
+        """Encoded keys (see key_codec) splitting keys into parts ranges of about equal number of rows,
+        see split_points
+        :param parts: desired number of ranges
+        """
+        return split_points(self._encoded, parts)
+
+    def rank(self, key: tp.Sequence[tp.Any]) -> float:
+        """Approximate fraction of keys preceding key in sort order
+        :param key: values of key columns
+        """
+        if not self.size:
+            raise ValueError("Sample is empty")
+        return bisect.bisect_left(self._encoded, encode_key(key)) / self.size
+
+    def heavy_keys(self, min_share: float) -> list[tuple[tuple[tp.Any, ...], float]]:
+        """Keys taking at least min_share of all rows with their shares, the heaviest first
+        :param min_share: minimal share of a key
+        """
+        return [
+            (key, count / self.size)
+            for key, count in self.counts.most_common()
+            if count >= min_share * self.size
+        ]
+
+
+class NodeStatistics:
+    """Statistics of rows produced by a graph node: row count, average pickled row size and key cardinalities"""
+
+    def __init__(
+        self, rows: int, row_bytes: float, distinct: tp.Mapping[tuple[str, ...], float] | None = None
+    ) -> None:
+        """
+        :param rows: number of rows
+        :param row_bytes: average size of pickled row
+        :param distinct: approximate number of distinct values of key column sets
+        """
+        self.rows = rows
+        self.row_bytes = row_bytes
+        self.distinct = dict(distinct or {})
+
+    def __repr__(self) -> str:
+        return f"NodeStatistics(rows={self.rows}, row_bytes={self.row_bytes:.0f}, distinct={self.distinct})"
+
+
+class StatisticsCollector:
+    """Collects NodeStatistics of rows passing through observe"""
+
+    def __init__(
+        self, key_sets: tp.Iterable[tuple[str, ...]], schema: Schema | None = None, size_sample_rate: int = 64
+    ) -> None:
+        """
+        :param key_sets: key column sets to estimate number of distinct values of
+        :param schema: schema of compact rows or None for dict rows
+        :param size_sample_rate: size of every size_sample_rate-th row is measured
+        """
+        self.sketches = {keys: (key_getter(keys, schema), HyperLogLog(10)) for keys in key_sets}
+        self.size_sample_rate = size_sample_rate
+        self.rows = 0
+        self.sampled_bytes = 0
+        self.sampled_rows = 0
+
+    def observe(self, rows: ops.TRowsIterable) -> ops.TRowsGenerator:
+        """Pass rows through counting them
+        :param rows: rows to observe
+        """
+        sketches = list(self.sketches.values())
+        for row in rows:
+            if self.rows % self.size_sample_rate == 0:
+                self.sampled_bytes += len(pickle.dumps(row, pickle.HIGHEST_PROTOCOL))
+                self.sampled_rows += 1
+            self.rows += 1
+            for get_key, sketch in sketches:
+                sketch.add_hash(hash64(get_key(row)))
+            yield row
+
+    def result(self) -> NodeStatistics:
+        """Statistics of observed rows"""
+        row_bytes = self.sampled_bytes / self.sampled_rows if self.sampled_rows else 0.0
+        distinct = {keys: min(float(self.rows), sketch.count()) for keys, (_, sketch) in self.sketches.items()}
+        return NodeStatistics(self.rows, row_bytes, distinct)
+
+
+class Statistics:
+    """
+    Statistics of graph nodes collected by Graph.analyze, keyed by node fingerprint (operation of the node with
+    its parameters and its inputs, see planner.fingerprints), so they apply to the same graph built again.
+    """
+
+    def __init__(self) -> None:
+        self.nodes: dict[str, NodeStatistics] = {}
+
+    def get(self, fingerprint: str) -> NodeStatistics | None:
+        """
+        :param fingerprint: node fingerprint
+        """
+        return self.nodes.get(fingerprint)
+
+    def save(self, path: str) -> None:
+        """Store statistics in json file
+        :param path: file path
+        """
+        with open(path, "w") as file:
+            json.dump(
+                {
+                    fingerprint: {
+                        "rows": node.rows,
+                        "row_bytes": node.row_bytes,
+                        "distinct": [[list(keys), value] for keys, value in node.distinct.items()],
+                    }
+                    for fingerprint, node in self.nodes.items()
+                },
+                file,
+            )
+
+    @staticmethod
+    def load(path: str) -> "Statistics":
+        """Read statistics stored by save
+        :param path: file path
+        """
+        statistics = Statistics()
+        with open(path) as file:
+            for fingerprint, node in json.load(file).items():
+                distinct = {tuple(keys): value for keys, value in node["distinct"]}
+                statistics.nodes[fingerprint] = NodeStatistics(node["rows"], node["row_bytes"], distinct)
+        return statistics
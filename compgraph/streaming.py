@@ -0,0 +1,318 @@
+"""
+Continuous execution of a graph over an unbounded source in micro-batches.
+
+Rows of the stream source are cut into micro-batches by a trigger (number of rows and/or time since the last
+emission) and every micro-batch is pushed through the graph. Stateful operations (ops.StatefulOperation:
+aggregate, top_k, hash join, window) fed by new rows keep their state between micro-batches:
+aggregates emit their result for all rows seen so far, hash join hashes its static right table once,
+windows are emitted when closed. Reduces of stream rows by Count, Sum, TopN or aggregates run as hash
+aggregation or top-k and merge joins of the stream with a static table as hash joins, so batch graphs
+(e.g. algorithms.word_count_graph) give the same results; other reduces of stream rows are rejected.
+Other operations see one micro-batch at a time (e.g. sort sorts a micro-batch), operations after
+an accumulating one see its whole current result. Every trigger gives the output of the graph
+for the micro-batch:
+
+    graph = Graph.graph_from_iter("lines").map(...).aggregate({"count": agg.Count()}, ["word"]).top_k("count", 10)
+    for top in graph.run_stream("lines", trigger_seconds=5, lines=tail):
+        show(top)
+
+State together with the number of consumed rows can be checkpointed to a file after every micro-batch
+before its output is given (a consumer failing to handle an output doesn't get it again);
+a run of the same graph started with the same checkpoint skips consumed rows of the (replayable) source
+and continues, a checkpoint of another graph is rejected.
+"""
+import os
+import pickle
+import queue
+import threading
+import time
+import typing as tp
+
+from . import aggregates as agg
+from . import graph as graph_module
+from . import operations as ops
+from . import planner
+
+TGraph = tp.Any  # graph.Graph, not imported by name to avoid circular import
+
+_DONE = object()
+_POLL_SECONDS = 0.1
+
+
+class StreamState:
+    """States of stateful operations by node position and fingerprint (see planner.fingerprints)
+    and number of consumed rows"""
+
+    def __init__(self) -> None:
+        self.offset = 0
+        self.states: dict[str, tp.Any] = {}
+
+    def save(self, path: str) -> None:
+        """Store state in file atomically
+        :param path: file path
+        """
+        temporary = f"{path}.tmp"
+        with open(temporary, "wb") as file:
+            pickle.dump(self, file, pickle.HIGHEST_PROTOCOL)
+            file.flush()
+            os.fsync(file.fileno())
+        os.replace(temporary, path)
+
+    @staticmethod
+    def load(path: str) -> "StreamState":
+        """Read state stored by save
+        :param path: file path
+        """
+        with open(path, "rb") as file:
+            state = pickle.load(file)
+        assert isinstance(state, StreamState)
+        return state
+
+
+def _put(rows_queue: "queue.Queue[tp.Any]", item: tp.Any, stop: threading.Event) -> bool:
+    """Put item to queue unless consumer stops meanwhile, returns whether item is put"""
+    while not stop.is_set():
+        try:
+            rows_queue.put(item, timeout=_POLL_SECONDS)
+            return True
+        except queue.Full:
+            continue
+    return False
+
+
+def _read(rows: tp.Iterator[ops.TRow], rows_queue: "queue.Queue[tp.Any]", stop: threading.Event) -> None:
+    try:
+        for row in rows:
+            if not _put(rows_queue, row, stop):
+                return
+        _put(rows_queue, _DONE, stop)
+    except BaseException as error:
+        _put(rows_queue, error, stop)
+    finally:
+        ops.close_rows(rows)
+
+
+def micro_batches(
+    rows: tp.Iterable[ops.TRow], trigger_rows: int | None = None, trigger_seconds: float | None = None
+) -> tp.Generator[list[ops.TRow], None, None]:
+    """Cut rows into micro-batches of at most trigger_rows rows, a micro-batch is also given when trigger_seconds
+    passed since the previous one (even if the source doesn't yield anything meanwhile), rows are then read
+    in a separate thread
+    :param rows: rows of stream
+    :param trigger_rows: maximum number of rows in a micro-batch
+    :param trigger_seconds: maximum time between micro-batches
+    """
+    if trigger_rows is None and trigger_seconds is None:
+        raise ValueError("trigger_rows or trigger_seconds must be passed")
+    if trigger_seconds is None:
+        assert trigger_rows is not None
+        yield from ops.batches(rows, trigger_rows)
+        return
+
+    rows_queue: "queue.Queue[tp.Any]" = queue.Queue(maxsize=trigger_rows or ops.BATCH_SIZE)
+    stop = threading.Event()
+    reader = threading.Thread(target=_read, args=(iter(rows), rows_queue, stop), daemon=True)
+    reader.start()
+    try:
+        batch: list[ops.TRow] = []
+        deadline = time.monotonic() + trigger_seconds
+        while True:
+            try:
+                item = rows_queue.get(timeout=max(0.0, deadline - time.monotonic()))
+            except queue.Empty:
+                item = None
+            if item is _DONE:
+                break
+            if isinstance(item, BaseException):
+                raise item
+            if item is not None:
+                batch.append(item)
+            if item is None or (trigger_rows is not None and len(batch) >= trigger_rows):
+                yield batch
+                batch = []
+                deadline = time.monotonic() + trigger_seconds
+        if batch:
+            yield batch
+    finally:
+        stop.set()
+        # a reader putting rows stops in a poll interval and closes the source, a reader waiting for the next row
+        # of an idle source is left behind (it is a daemon thread) and stops once the source gives a row
+        reader.join(2 * _POLL_SECONDS)
+
+
+def _node(operation: ops.Operation, schema: tp.Any, *children: TGraph) -> TGraph:
+    node = graph_module.Graph(*children)
+    node.operation = operation
+    node.schema = schema
+    return node
+
+
+def _all_keys(keys: tp.Sequence[str]) -> tp.Callable[[ops.TRow], bool]:
+    """Condition of Count reducer, which skips groups with empty keys"""
+    return lambda row: all(row[key] for key in keys)
+
+
+def _incremental_plan(graph: TGraph, stream: str) -> TGraph:
+    """Graph with the same batch output where operations fed by the stream keep state between micro-batches:
+    reduces by Count, Sum, TopN and aggregates become hash aggregation and top-k, merge joins of the stream
+    with a static right table become hash joins hashing the static table once.
+    Raises ValueError for a reduce or a join of the stream which can't keep such state"""
+    planned: dict[int, TGraph] = {}
+    incremental: dict[int, bool] = {}  # of nodes of graph
+    for node in planner._nodes(graph):
+        op, schema = node.operation, node.schema
+        children = [planned[id(child)] for child in node.graphs]
+        streamed = [incremental[id(child)] for child in node.graphs]
+        post: ops.Mapper | None = None
+        if not node.graphs:
+            incremental[id(node)] = isinstance(op, ops.ReadIterFactory) and op.name == stream
+        elif isinstance(op, ops.Reduce) and streamed[0]:
+            reducer, keys = op.reducer, op.keys
+            if isinstance(reducer, agg.Aggregate):
+                op = agg.HashAggregate(reducer.aggregates, keys, op.schema)
+            elif isinstance(reducer, ops.Count):
+                op = agg.HashAggregate({reducer.column: agg.Count()}, keys, op.schema)
+                post = ops.Filter(_all_keys(keys))
+            elif isinstance(reducer, ops.Sum):
+                op = agg.HashAggregate({reducer.column: agg.Sum(reducer.column)}, keys, op.schema)
+            elif isinstance(reducer, ops.TopN) and op.schema is None:
+                op = ops.TopK(reducer.column_max, reducer.n, keys)
+            else:
+                raise ValueError(f"{planner.describe(op)} of stream rows keeps no state between micro-batches, "
+                                 "use aggregate or top_k")
+            incremental[id(node)] = False
+        elif isinstance(op, ops.Join) and isinstance(op.joiner, ops.MergeJoiner) and streamed[0] != streamed[1]:
+            if streamed[1] or op.joiner.keep_b:
+                raise ValueError(f"{planner.describe(op)}: stream can be joined only as the left table "
+                                 "by a joiner not keeping unpaired rows of the static table")
+            op = ops.HashJoin(op.joiner, op.keys, "b", op.schema_a, op.schema_b)
+            incremental[id(node)] = True
+        elif isinstance(op, ops.StatefulOperation) and op.accumulating:
+            incremental[id(node)] = False
+        else:
+            incremental[id(node)] = streamed[0]
+        if op is node.operation and all(new is old for new, old in zip(children, node.graphs)):
+            planned[id(node)] = node
+        else:
+            planned[id(node)] = _node(op, schema, *children)
+        if post is not None:
+            planned[id(node)] = _node(ops.Map(post), schema, planned[id(node)])
+    return planned[id(graph)]
+
+
+def _incremental(graph: TGraph, stream: str) -> dict[int, bool]:
+    """Whether node (by id) produces rows of the current micro-batch only (not results of all rows so far)"""
+    result: dict[int, bool] = {}
+    for node in planner._nodes(graph):
+        op = node.operation
+        if not node.graphs:
+            result[id(node)] = isinstance(op, ops.ReadIterFactory) and op.name == stream
+        elif isinstance(op, ops.StatefulOperation) and op.accumulating:
+            result[id(node)] = False
+        else:
+            result[id(node)] = result[id(node.graphs[0])]
+    return result
+
+
+def _keeps_state(node: TGraph, incremental: dict[int, bool]) -> bool:
+    """Stateful operation keeps state between micro-batches if its first input is incremental and others are not"""
+    return (
+        isinstance(node.operation, ops.StatefulOperation)
+        and incremental[id(node.graphs[0])]
+        and not any(incremental[id(child)] for child in node.graphs[1:])
+    )
+
+
+def run(
+    graph: TGraph,
+    stream: str,
+    trigger_rows: int | None = None,
+    trigger_seconds: float | None = None,
+    checkpoint: str | None = None,
+    **kwargs: tp.Any,
+) -> tp.Generator[list[ops.TRow], None, None]:
+    """Run graph over micro-batches of stream source and yield output of every micro-batch (see module docstring);
+    at the end of a finite stream remaining rows of stateful operations are yielded as the last output
+    :param graph: graph to run
+    :param stream: name of the stream source, other sources are static
+    :param trigger_rows: maximum number of rows in a micro-batch
+    :param trigger_seconds: maximum time between outputs
+    :param checkpoint: file to store state in after every output, the run continues from it if it exists
+    :param kwargs: data sources
+    """
+    graph = _incremental_plan(graph, stream)
+    fingerprints = planner.fingerprints(graph)
+    incremental = _incremental(graph, stream)
+    stateful = [node for node in planner._nodes(graph) if _keeps_state(node, incremental)]
+    # equal nodes built twice have equal fingerprints but separate states
+    keys: dict[int, str] = {}
+    for position, node in enumerate(stateful):
+        fingerprint = fingerprints[id(node)]
+        if fingerprint is None and checkpoint is not None:
+            raise ValueError(f"{planner.describe(node.operation)} has parameters which can't be checkpointed")
+        keys[id(node)] = f"{position}:{fingerprint}"
+
+    if checkpoint is not None and os.path.exists(checkpoint):
+        state = StreamState.load(checkpoint)
+        if set(state.states) != set(keys.values()):
+            raise ValueError(f"Checkpoint {checkpoint} was made by another graph")
+    else:
+        state = StreamState()
+        state.states = {keys[id(node)]: node.operation.initial_state() for node in stateful}
+    states = {id(node): state.states[keys[id(node)]] for node in stateful}
+
+    def execute(batch: list[ops.TRow] | None) -> list[ops.TRow]:
+        """Output of graph for micro-batch, None for the end of stream"""
+        sources = {**kwargs, stream: lambda: iter(batch or ())}
+
+        def run_node(node: TGraph) -> ops.TRowsGenerator:
+            op = node.operation
+            if op is None:
+                raise TypeError
+            if not node.graphs:
+                yield from op(**sources)
+                return
+            inputs = [run_node(child) for child in node.graphs]
+            try:
+                if id(node) not in states:
+                    yield from op(*inputs)
+                elif batch is None:
+                    yield from op.emit(states[id(node)])
+                else:
+                    yield from op.update(states[id(node)], *inputs)
+                    if op.accumulating:
+                        yield from op.emit(states[id(node)])
+            finally:
+                for rows in inputs:
+                    ops.close_rows(rows)
+
+        rows = run_node(graph)
+        try:
+            return list(rows if graph.schema is None else map(graph.schema.unpack, rows))
+        finally:
+            rows.close()
+
+    def save() -> None:
+        if checkpoint is not None:
+            stored = StreamState()
+            stored.offset = state.offset
+            stored.states = {
+                keys[id(node)]: node.operation.checkpoint(states[id(node)]) for node in stateful
+            }
+            stored.save(checkpoint)
+
+    source = kwargs[stream]()
+    try:
+        for _ in range(state.offset):
+            if next(source, _DONE) is _DONE:
+                break
+        for batch in micro_batches(source, trigger_rows, trigger_seconds):
+            result = execute(batch)
+            state.offset += len(batch)
+            # stored before the output is given, so state never runs ahead of or behind the outputs given
+            save()
+            yield result
+        if any(not node.operation.accumulating for node in stateful):
+            yield execute(None)
+    finally:
+        ops.close_rows(source)
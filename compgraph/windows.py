@@ -0,0 +1,158 @@
+"""
+Event-time windowed aggregation over (possibly unbounded) streams of rows.
+
+Windows of size seconds start every slide seconds (tumbling windows if slide equals size), aligned to
+multiples of slide since the epoch. Rows are aggregated incrementally into panes of slide seconds per key,
+and a window is emitted as a merge of its panes once the watermark (the largest event time seen minus
+allowed lateness) passes its end, so no sort of the input is needed and memory is bounded by the number of
+keys in open windows. Rows arriving after all windows containing them are emitted are dropped.
+"""
+import math
+import typing as tp
+
+from datetime import datetime, timezone
+
+from . import aggregates as agg
+from . import operations as ops
+from .key_codec import encode_key
+from .schema import Schema, key_getter, unpacker
+
+
+def event_time(value: tp.Any) -> float:
+    """Event time in seconds since the epoch
+    :param value: number of seconds or time in format of travel time logs (see operations.parse_time), as UTC
+    """
+    if isinstance(value, str):
+        return ops.parse_time(value).replace(tzinfo=timezone.utc).timestamp()
+    return float(value)
+
+
+def format_time(seconds: float) -> str:
+    """Time in format of travel time logs, inverse of event_time
+    :param seconds: seconds since the epoch
+    """
+    return datetime.fromtimestamp(seconds, timezone.utc).strftime(ops.TIME_FORMAT)
+
+
+class WindowAggregate(ops.StatefulOperation):
+    """
+    Compute named aggregates per key and event-time window (see module docstring).
+    Every result row has key columns, window bounds (in the representation of time column: seconds or
+    formatted time) and aggregates; windows are emitted in order of their ends, keys of a window in sort order.
+    """
+
+    accumulating = False
+
+    def __init__(
+        self,
+        aggregates: tp.Mapping[str, agg.Aggregator],
+        time_column: str,
+        size: float,
+        slide: float | None = None,
+        keys: tp.Sequence[str] = (),
+        allowed_lateness: float = 0.0,
+        start_column: str = "window_start",
+        end_column: str = "window_end",
+        schema: Schema | None = None,
+    ) -> None:
+        """
+        :param aggregates: result column names mapped to aggregate functions
+        :param time_column: column with event time, seconds or formatted time (see event_time)
+        :param size: window length in seconds
+        :param slide: distance between window starts in seconds, size must be its multiple; size by default
+        :param keys: keys for grouping inside of a window
+        :param allowed_lateness: how long (in event time) rows older than the latest one are waited for
+        :param start_column: result column for window start
+        :param end_column: result column for window end
+        :param schema: schema of compact input rows or None for dict rows
+        """
+        slide = size if slide is None else slide
+        if size <= 0 or slide <= 0:
+            raise ValueError("size and slide must be positive")
+        panes = size / slide
+        if abs(panes - round(panes)) > 1e-9:
+            raise ValueError("size must be a multiple of slide")
+        if allowed_lateness < 0:
+            raise ValueError("allowed_lateness must not be negative")
+        self.aggregates = dict(aggregates)
+        self.time_column = time_column
+        self.size = size
+        self.slide = slide
+        self.keys = tuple(keys)
+        self.allowed_lateness = allowed_lateness
+        self.start_column = start_column
+        self.end_column = end_column
+        self.schema = schema
+
+    def initial_state(self) -> tp.Any:
+        # pane index p covers [p * slide, (p + 1) * slide): pane index -> key -> states of aggregates;
+        # emitted_end is index of the pane following the last emitted window
+        return {"panes": {}, "formatted": None, "emitted_end": -math.inf, "watermark": -math.inf}
+
+    def _emit_window(self, state: tp.Any, end: int) -> ops.TRowsGenerator:
+        """Emit window of panes preceding pane end and drop panes not needed anymore"""
+        aggregates = list(self.aggregates.values())
+        panes = state["panes"]
+        panes_per_window = round(self.size / self.slide)
+        window: dict[tuple[tp.Any, ...], list[tp.Any]] = {}
+        for index in range(end - panes_per_window, end):
+            for key, states in panes.get(index, {}).items():
+                merged = window.get(key)
+                if merged is None:
+                    merged = window[key] = [aggregate.initial() for aggregate in aggregates]
+                for i, aggregate in enumerate(aggregates):
+                    merged[i] = aggregate.merge(merged[i], states[i])
+        start_time, end_time = (end - panes_per_window) * self.slide, end * self.slide
+        bounds = (format_time(start_time), format_time(end_time)) if state["formatted"] else (start_time, end_time)
+        for key in sorted(window, key=encode_key):
+            result = dict(zip(self.keys, key))
+            result[self.start_column], result[self.end_column] = bounds
+            for name, aggregate, value in zip(self.aggregates, aggregates, window[key]):
+                result[name] = aggregate.result(value)
+            yield result
+        for index in [index for index in panes if index + panes_per_window <= end]:
+            del panes[index]
+
+    def _close(self, state: tp.Any, until: float) -> ops.TRowsGenerator:
+        """Emit all windows with data ending not later than until"""
+        panes = state["panes"]
+        while panes:
+            end = int(max(state["emitted_end"] + 1, min(panes) + 1))
+            if end * self.slide > until:
+                return
+            yield from self._emit_window(state, end)
+            state["emitted_end"] = end
+
+    def update(self, state: tp.Any, rows: ops.TRowsIterable, *args: tp.Any) -> ops.TRowsGenerator:
+        aggregates = list(self.aggregates.values())
+        get_key = key_getter(self.keys, self.schema)
+        unpack = unpacker(self.schema)
+        time_column: tp.Any = self.time_column if self.schema is None else self.schema.position(self.time_column)
+        panes = state["panes"]
+        panes_per_window = round(self.size / self.slide)
+        for row in rows:
+            value = row[time_column]
+            if state["formatted"] is None:
+                state["formatted"] = isinstance(value, str)
+            time = event_time(value)
+            index = math.floor(time / self.slide)
+            if index + panes_per_window <= state["emitted_end"]:
+                continue  # late: all windows containing the row are emitted
+            pane = panes.get(index)
+            if pane is None:
+                pane = panes[index] = {}
+            key = get_key(row)
+            states = pane.get(key)
+            if states is None:
+                states = pane[key] = [aggregate.initial() for aggregate in aggregates]
+            row = unpack(row)
+            for i, aggregate in enumerate(aggregates):
+                states[i] = aggregate.update(states[i], row)
+
+            if time - self.allowed_lateness > state["watermark"]:
+                state["watermark"] = time - self.allowed_lateness
+                yield from self._close(state, state["watermark"])
+
+    def emit(self, state: tp.Any) -> ops.TRowsGenerator:
+        """Emit all remaining windows at the end of input"""
+        yield from self._close(state, math.inf)
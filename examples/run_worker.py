@@ -0,0 +1,15 @@
+import click
+
+from compgraph.distributed import serve_forever
+
+
+@click.command()
+@click.argument("host", type=str)
+@click.argument("port", type=int)
+@click.option("--authkey", envvar="COMPGRAPH_AUTHKEY", required=True, help="secret shared with coordinator")
+def main(host: str, port: int, authkey: str) -> None:
+    serve_forever((host, port), authkey.encode())
+
+
+if __name__ == "__main__":
+    main()
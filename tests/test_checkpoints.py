@@ -0,0 +1,163 @@
+import json
+import os
+import threading
+import time
+import typing as tp
+
+import pytest
+
+from compgraph import Graph
+from compgraph import operations as ops
+from compgraph.checkpoints import MANIFEST, fingerprints
+
+
+class Failing(ops.Mapper):
+    """Fails on the first row while failing is set, stands for a crash in the last stage"""
+
+    failing = True
+
+    def __call__(self, row: ops.TRow) -> ops.TRowsGenerator:
+        if Failing.failing:
+            raise RuntimeError("crash")
+        yield row
+
+
+def _graph() -> Graph:
+    counts = (
+        Graph.graph_from_iter("words")
+        .sort(["word"])
+        .reduce(ops.Count("count"), ["word"])
+    )
+    names = Graph.graph_from_iter("names").sort(["word"])
+    return counts.join(ops.InnerJoiner(), names, ["word"]).sort(["count", "word"]).map(Failing())
+
+
+def test_resume_after_crash(tmp_path: tp.Any) -> None:
+    directory = str(tmp_path / "job")
+    reads: dict[str, int] = {"words": 0, "names": 0}
+
+    def source(name: str, rows: list[ops.TRow]) -> tp.Callable[[], tp.Iterator[ops.TRow]]:
+        def read() -> tp.Iterator[ops.TRow]:
+            reads[name] += 1
+            yield from rows
+        return read
+
+    words = [{"word": str(i % 7)} for i in range(100)]
+    names = [{"word": str(i), "name": f"n{i}"} for i in range(5)]
+    sources: dict[str, tp.Any] = {"words": source("words", words), "names": source("names", names)}
+
+    Failing.failing = True
+    with pytest.raises(RuntimeError):
+        list(_graph().run_checkpointed(directory, **sources))
+    with open(os.path.join(directory, MANIFEST)) as file:
+        stages = json.load(file)["stages"]
+    # the sorts, the reduce and the join are finished, the final sort is not read to the end
+    assert sorted(stage["operation"] for stage in stages.values()) == [
+        "Join(InnerJoiner, ['word'])", "Reduce(Count, ['word'])", "Sort(['word'])", "Sort(['word'])"
+    ]
+    assert reads == {"words": 1, "names": 1}
+
+    Failing.failing = False
+    resumed = list(_graph().run_checkpointed(directory, **sources))
+    assert reads == {"words": 1, "names": 1}
+    assert resumed == list(_graph().run(words=lambda: iter(words), names=lambda: iter(names)))
+    assert len(resumed) == 5
+
+    # another version of a source invalidates the stages depending on it only
+    list(_graph().run_checkpointed(directory, versions={"names": "2"}, **sources))
+    assert reads == {"words": 1, "names": 2}
+    assert len(os.listdir(directory)) == 1 + 5
+
+
+def test_checkpoint_fingerprints() -> None:
+    def graph(column: str) -> Graph:
+        return Graph.graph_from_iter("rows").map(ops.Project([column])).sort([column])
+
+    first, same, other = graph("a"), graph("a"), graph("b")
+    assert fingerprints(first)[id(first)] == fingerprints(same)[id(same)]
+    assert fingerprints(first)[id(first)] != fingerprints(other)[id(other)]
+    assert fingerprints(first)[id(first)] != fingerprints(first, {"rows": "2"})[id(first)]
+
+    def filtered(threshold: int, step: int = 1) -> Graph:
+        return Graph.graph_from_iter("rows").map(ops.Filter(lambda row: row["x"] > threshold * step)).sort(["x"])
+
+    base, same_filter = filtered(1), filtered(1)
+    assert fingerprints(base)[id(base)] == fingerprints(same_filter)[id(same_filter)]
+    for changed in (filtered(2), filtered(1, step=2)):
+        assert fingerprints(base)[id(base)] != fingerprints(changed)[id(changed)]
+
+    def encoded(shared: bool) -> Graph:
+        words = ops.Dictionary()
+        return Graph.graph_from_iter("rows").encode(["a"], words).encode(["b"], words if shared else ops.Dictionary())
+
+    shared, separate, shared_again = encoded(True), encoded(False), encoded(True)
+    assert fingerprints(shared)[id(shared)] == fingerprints(shared_again)[id(shared_again)]
+    assert fingerprints(shared)[id(shared)] != fingerprints(separate)[id(separate)]
+
+
+def test_undescribable_stage_is_not_stored(tmp_path: tp.Any) -> None:
+    directory = str(tmp_path / "job")
+    lock = threading.Lock()  # no description stable across runs
+
+    def graph() -> Graph:
+        source = Graph.graph_from_iter("rows").map(ops.Filter(lambda row: lock is not None)).sort(["x"])
+        return source.reduce(ops.Count("count"), ["x"])
+
+    counts = graph()
+    assert fingerprints(counts)[id(counts)] is None
+    rows = [{"x": 1 + i % 3} for i in range(10)]
+    assert len(list(graph().run_checkpointed(directory, rows=lambda: iter(rows)))) == 3
+    assert os.listdir(directory) == [MANIFEST]
+
+
+def test_unfinished_stage_is_not_recorded(tmp_path: tp.Any) -> None:
+    directory = str(tmp_path / "job")
+    rows = [{"value": i} for i in range(5000)]
+    output = Graph.graph_from_iter("rows").sort(["value"]).run_checkpointed(directory, rows=lambda: iter(rows))
+    assert next(output) == {"value": 0}
+    output.close()
+    with open(os.path.join(directory, MANIFEST)) as file:
+        assert json.load(file)["stages"] == {}
+    assert os.listdir(directory) == [MANIFEST]
+
+    # a file left by a crashed run is removed, a file a concurrent run is writing is kept
+    stale, written = os.path.join(directory, "stale.tmp"), os.path.join(directory, "written.tmp")
+    for path, shift in [(stale, -60), (written, 60)]:
+        open(path, "wb").close()
+        os.utime(path, (time.time() + shift, time.time() + shift))
+    list(Graph.graph_from_iter("rows").sort(["value"]).run_checkpointed(directory, rows=lambda: iter(rows)))
+    assert not os.path.exists(stale) and os.path.exists(written)
+
+
+def test_resume_with_dictionary(tmp_path: tp.Any) -> None:
+    directory = str(tmp_path / "job")
+    rows = [{"word": f"w{i % 13}"} for i in range(200)]
+
+    def source() -> tp.Iterator[ops.TRow]:
+        return (dict(row) for row in rows)  # encode changes rows in place
+
+    def graph(words: ops.Dictionary) -> Graph:
+        return (
+            Graph.graph_from_iter("rows")
+            .encode(["word"], words)
+            .sort(["word"])
+            .reduce(ops.Count("count"), ["word"])
+            .map(Failing())
+            .decode(["word"], words)
+        )
+
+    Failing.failing = True
+    with pytest.raises(RuntimeError):
+        list(graph(ops.Dictionary()).run_checkpointed(directory, rows=source))
+    Failing.failing = False
+
+    expected = list(graph(ops.Dictionary()).run(rows=source))
+    # the sort is read from its file with ids of the first run
+    resumed = list(graph(ops.Dictionary()).run_checkpointed(directory, rows=lambda: iter([])))
+    assert resumed == expected
+
+    # a dictionary with other ids can't decode stored stages, they are computed again
+    other = ops.Dictionary(["w5"])
+    assert sorted(map(str, graph(other).run_checkpointed(directory, rows=source))) == sorted(
+        map(str, expected)
+    )
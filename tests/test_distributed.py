@@ -0,0 +1,84 @@
+import json
+import os
+import tempfile
+import typing as tp
+
+from pathlib import Path
+
+import pytest
+
+from compgraph import Graph, algorithms
+from compgraph import operations as ops
+from compgraph.distributed import LocalCluster, Task, TaskError
+
+
+def double_graph(factor: int = 2) -> Graph:
+    return Graph.graph_from_iter("input").map(ops.BinaryOperation(lambda row: row["value"] * factor, "value"))
+
+
+def failing_graph() -> Graph:
+    return Graph.graph_from_iter("input").map(ops.BinaryOperation(lambda row: 1 / row["value"], "value"))
+
+
+def crashing_graph(marker: str) -> Graph:
+    if not os.path.exists(marker):
+        Path(marker).touch()
+        os._exit(1)
+    return double_graph()
+
+
+def test_coordinator_runs_tasks_in_order() -> None:
+    inputs = [[{"value": i} for i in range(start, start + 3000)] for start in (0, 3000, 6000)]
+    with LocalCluster(2) as cluster:
+        coordinator = cluster.coordinator()
+        result = list(coordinator.run([Task(double_graph, {"factor": 3}, {"input": rows}) for rows in inputs]))
+        assert result == [{"value": 3 * i} for i in range(9000)]
+
+        with pytest.raises(TaskError, match="ZeroDivisionError"):
+            list(coordinator.run([Task(failing_graph, inputs={"input": [{"value": 0}]})]))
+        assert list(coordinator.run([Task(double_graph, inputs={"input": [{"value": 1}]})])) == [{"value": 2}]
+
+
+def test_coordinator_retries_task_of_lost_worker(tmp_path: Path) -> None:
+    rows = [{"value": 1}, {"value": 2}]
+    with LocalCluster(2) as cluster:
+        task = Task(crashing_graph, {"marker": (tmp_path / "crashed").as_posix()}, {"input": rows})
+        assert list(cluster.coordinator().run([task])) == [{"value": 2}, {"value": 4}]
+
+
+def test_distributed_word_count(tmp_path: Path) -> None:
+    docs: list[dict[str, tp.Any]] = [
+        {"doc_id": i, "text": " ".join(f"Word{(i * j) % 37}" for j in range(20)) + "!"} for i in range(300)
+    ]
+    filenames = []
+    for part in range(4):
+        filename = tmp_path / f"part{part}.jsonl"
+        with open(filename, "w") as file:
+            for doc in docs[part::4]:
+                print(json.dumps(doc), file=file)
+        filenames.append(filename.as_posix())
+
+    expected = list(algorithms.word_count_graph("docs").run(docs=lambda: iter(docs)))
+    with LocalCluster(3) as cluster:
+        assert list(algorithms.distributed_word_count(cluster.coordinator(), filenames)) == expected
+
+        shuffle_directory = (tmp_path / "shuffle").as_posix()
+        coordinator = cluster.coordinator()
+        result = algorithms.distributed_word_count(coordinator, filenames, shuffle_directory=shuffle_directory)
+        assert list(result) == expected
+        assert not os.path.exists(shuffle_directory)
+
+
+def test_map_reduce_shuffles_through_coordinator_disk(tmp_path: Path, monkeypatch: pytest.MonkeyPatch) -> None:
+    monkeypatch.setattr(tempfile, "tempdir", tmp_path.as_posix())
+    rows = [{"value": i} for i in range(5000)]
+    map_tasks = [
+        Task(crashing_graph, {"marker": (tmp_path / "crashed").as_posix()}, {"input": rows[:2500]}),
+        Task(double_graph, inputs={"input": rows[2500:]}),
+    ]
+    with LocalCluster(2) as cluster:
+        graph = Graph.graph_from_map_reduce(cluster.coordinator(), map_tasks, ["value"], double_graph, partitions=3)
+        result = list(graph.sort(["value"]).run())
+
+    assert result == [{"value": 4 * i} for i in range(5000)]
+    assert os.listdir(tmp_path) == ["crashed"]
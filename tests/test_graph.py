@@ -1,10 +1,21 @@
+import bisect
+import itertools
 import json
+import multiprocessing
+import random
+import threading
+import time
+import typing as tp
+
 import pytest
 
 from pathlib import Path
 
-from compgraph import Graph
+from compgraph import Graph, algorithms, bloom, fusion, planner
+from compgraph import aggregates as agg
+from compgraph import external_sort as sort
 from compgraph import operations as ops
+from compgraph.stats import Statistics, split_points
 
 
 def put_test_to_file(input_path: Path, test) -> Path:  # type: ignore
@@ -126,3 +137,449 @@ def test_graph_sort() -> None:
     result = graph.run(test=lambda: iter(tests))
 
     assert list(result) == expected
+
+
+def test_graph_threaded() -> None:
+    tests = [{"test_id": i, "text": f"row {i}"} for i in range(1000)]
+
+    graph = Graph.graph_from_iter("test").map(ops.Split(column="text")).threaded(batch_size=7, queue_size=2)
+    plain_graph = Graph.graph_from_iter("test").map(ops.Split(column="text"))
+
+    result = graph.run(test=lambda: iter(tests))
+
+    assert list(result) == list(plain_graph.run(test=lambda: iter(tests)))
+
+
+def test_graph_threaded_error() -> None:
+    def broken() -> tp.Iterator[ops.TRow]:
+        yield {"test_id": 1}
+        raise ValueError("broken source")
+
+    graph = Graph.graph_from_iter("test").threaded(batch_size=1)
+
+    with pytest.raises(ValueError, match="broken source"):
+        list(graph.run(test=broken))
+
+
+def test_graph_threaded_early_stop() -> None:
+    closed = threading.Event()
+
+    def endless() -> tp.Iterator[ops.TRow]:
+        try:
+            for i in itertools.count():
+                yield {"test_id": i}
+        finally:
+            closed.set()
+
+    result = Graph.graph_from_iter("test").threaded(batch_size=10, queue_size=1).run(test=endless)
+
+    assert next(result) == {"test_id": 0}
+    result.close()
+    assert closed.is_set()
+
+
+def test_graph_threaded_close_with_idle_source() -> None:
+    release = threading.Event()
+
+    def idle() -> tp.Iterator[ops.TRow]:
+        yield {"test_id": 0}
+        release.wait(10)
+
+    result = Graph.graph_from_iter("test").threaded(batch_size=1).run(test=idle)
+
+    assert next(result) == {"test_id": 0}
+    start = time.monotonic()
+    result.close()
+    assert time.monotonic() - start < 1
+    release.set()
+
+
+def test_graph_schema() -> None:
+    tests = [
+        {"test_id": 3, "text": "a b", "junk": 1},
+        {"test_id": 1, "text": "c", "junk": 2},
+        {"test_id": 2, "text": "d", "junk": 3},
+    ]
+
+    graph = (
+        Graph.graph_from_iter("test", schema=["test_id", "text", "junk"])
+        .map(ops.Filter(lambda row: row["junk"] > 1))
+        .map(ops.Project(["text", "test_id", "missing"]))
+        .sort(["test_id"])
+    )
+
+    assert graph.schema is not None and graph.schema.columns == ("text", "test_id")
+    assert list(graph.run(test=lambda: iter(tests))) == [
+        {"text": "c", "test_id": 1},
+        {"text": "d", "test_id": 2},
+    ]
+
+
+def test_graph_schema_text_mappers() -> None:
+    docs = [
+        {"doc_id": 1, "text": "Hello, World!  a\tb"},
+        {"doc_id": 2, "text": " Lead SPACE."},
+        {"doc_id": 3, "text": ""},
+    ]
+
+    def words(schema: list[str] | None) -> Graph:
+        return (
+            Graph.graph_from_iter("docs", schema=schema)
+            .map(ops.FilterPunctuation("text"))
+            .map(ops.LowerCase("text"))
+            .map(ops.Split("text"))
+        )
+
+    graph = words(["doc_id", "text"])
+    assert isinstance(graph.operation, fusion.FusedMap)
+    assert graph.schema is not None and graph.schema.columns == ("doc_id", "text")
+    assert list(graph.run(docs=lambda: iter(docs))) == list(words(None).run(docs=lambda: iter(docs)))
+
+    # rows are unpacked before the first mapper needing dicts, the rest of the chain is the same
+    tagged = graph.map(ops.BinaryOperation(lambda row: len(row["text"]), "length")).map(ops.LowerCase("text"))
+    assert tagged.schema is None
+    assert list(tagged.run(docs=lambda: iter(docs)))[:2] == [
+        {"doc_id": 1, "text": "hello", "length": 5},
+        {"doc_id": 1, "text": "world", "length": 5},
+    ]
+
+
+def test_graph_schema_reduce_and_join() -> None:
+    scores = [
+        {"player_id": 1, "score": 17, "game_id": 2},
+        {"player_id": 1, "score": 22, "game_id": 3},
+        {"player_id": 3, "score": 99, "game_id": 1},
+    ]
+    players = [{"player_id": 1, "username": "XeroX"}, {"player_id": 3, "username": "Destroyer"}]
+
+    score_graph = Graph.graph_from_iter("scores").with_schema(["player_id", "score"])
+    player_graph = Graph.graph_from_iter("players", schema=["player_id", "username"])
+
+    totals = score_graph.reduce(ops.Sum("score"), ["player_id"]).run(scores=lambda: iter(scores))
+    assert list(totals) == [{"player_id": 1, "score": 39}, {"player_id": 3, "score": 99}]
+
+    joined = score_graph.join(ops.InnerJoiner(), player_graph, ["player_id"]).run(
+        scores=lambda: iter(scores), players=lambda: iter(players)
+    )
+    assert list(joined) == [
+        {"player_id": 1, "score": 17, "username": "XeroX"},
+        {"player_id": 1, "score": 22, "username": "XeroX"},
+        {"player_id": 3, "score": 99, "username": "Destroyer"},
+    ]
+
+    left = score_graph.join(ops.LeftJoiner(), score_graph.with_schema(["player_id"]), ["player_id"])
+    assert len(list(left.run(scores=lambda: iter(scores)))) == 5
+
+
+def test_graph_from_file_schema(data_file: Path) -> None:
+    graph = Graph.graph_from_file(data_file.as_posix(), ops.json_parser, schema=["text"])
+
+    assert list(graph.top_k("text", 2).run()) == [{"text": "world"}, {"text": "my"}]
+
+
+def test_graph_join_bloom_filter() -> None:
+    words = [{"doc_id": i % 7, "text": f"w{i % 13}"} for i in range(500)]
+    frequent = [{"doc_id": i, "text": f"w{i}"} for i in range(0, 7, 2)]
+
+    graph = Graph.graph_from_iter("words").sort(["doc_id", "text"])
+    frequent_graph = Graph.graph_from_iter("frequent").sort(["doc_id", "text"])
+
+    expected = graph.join(ops.InnerJoiner(), frequent_graph, ["doc_id", "text"])
+    pushed = graph.join(ops.InnerJoiner(), frequent_graph, ["doc_id", "text"], bloom_filter_fpr=0.01)
+    unsorted = graph.map(ops.DummyMapper()).join(
+        ops.InnerJoiner(), frequent_graph, ["doc_id", "text"], bloom_filter_fpr=0.5
+    )
+
+    kwargs = {"words": lambda: iter(words), "frequent": lambda: iter(frequent)}
+    assert list(pushed.run(**kwargs)) == list(expected.run(**kwargs))
+    assert list(unsorted.run(**kwargs)) == list(expected.run(**kwargs))
+    with pytest.raises(ValueError):
+        graph.join(ops.LeftJoiner(), frequent_graph, ["doc_id"], bloom_filter_fpr=0.01)
+
+    class CustomLeftJoiner(ops.Joiner):
+        def __call__(
+            self, keys: tp.Sequence[str], rows_a: ops.TRowsIterable, rows_b: ops.TRowsIterable
+        ) -> ops.TRowsGenerator:
+            yield from rows_a
+
+    with pytest.raises(ValueError):
+        graph.join(CustomLeftJoiner(), frequent_graph, ["doc_id"], bloom_filter_fpr=0.01)
+
+    class CustomInnerJoiner(CustomLeftJoiner):
+        keep_a = False
+
+    graph.join(CustomInnerJoiner(), frequent_graph, ["doc_id"], bloom_filter_fpr=0.01)
+
+
+def test_bloom_filter_false_positive_rate() -> None:
+    bloom_filter = bloom.BloomFilter(1000, 0.01)
+    for i in range(1000):
+        bloom_filter.add(str(i).encode())
+
+    assert all(str(i).encode() in bloom_filter for i in range(1000))
+    assert sum(str(-i).encode() in bloom_filter for i in range(1, 10001)) < 300
+
+
+def test_graph_with_scalar() -> None:
+    tests = [{"test_id": 1, "count": 2}, {"test_id": 2, "count": 3}]
+
+    total = Graph.graph_from_iter("test").reduce(ops.Sum("count"), [])
+    graph = Graph.graph_from_iter("test", schema=["test_id"]).with_scalar(total)
+
+    assert list(graph.run(test=lambda: iter(tests))) == [
+        {"test_id": 1, "count": 5},
+        {"test_id": 2, "count": 5},
+    ]
+
+    empty = Graph.graph_from_iter("empty")
+    assert list(graph.with_scalar(empty).run(test=lambda: iter(tests), empty=lambda: iter([]))) == []
+
+    with pytest.raises(ValueError):
+        list(Graph.graph_from_iter("test").with_scalar(Graph.graph_from_iter("test")).run(test=lambda: iter(tests)))
+
+
+def test_graph_sample() -> None:
+    tests = [{"test_id": i, "group": i % 4} for i in range(1000)]
+
+    sample = Graph.graph_from_iter("test", schema=["test_id", "group"]).sample(100, seed=1)
+    rows = list(sample.run(test=lambda: iter(tests)))
+    assert len(rows) == 100
+    assert rows == sorted(rows, key=lambda row: row["test_id"])
+    assert rows == list(sample.run(test=lambda: iter(tests)))
+    assert 25 < sum(row["test_id"] < 500 for row in rows) < 75
+    assert list(sample.run(test=lambda: iter(tests[:10]))) == tests[:10]
+
+    fraction = Graph.graph_from_iter("test").sample_fraction(0.1, seed=1)
+    rows = list(fraction.run(test=lambda: iter(tests)))
+    assert 60 < len(rows) < 140
+    assert all(row in tests for row in rows)
+
+
+def test_graph_parallel_sort() -> None:
+    tests: list[dict[str, tp.Any]] = [
+        {"test_id": i, "key": (i * 7919) % 101, "text": "abc"[i % 3]} for i in range(3000)
+    ]
+    tests += [{"test_id": 3000 + i, "key": 50, "text": "b"} for i in range(1000)]
+
+    for schema in (None, ["test_id", "key", "text"]):
+        source = Graph.graph_from_iter("test", schema=schema)
+        expected = list(source.sort(["text", "key"]).run(test=lambda: iter(tests)))
+        assert list(source.sort(["text", "key"], workers=3).run(test=lambda: iter(tests))) == expected
+
+    operation = sort.ParallelSort(["key"], workers=4, run_size=100, sample_size=200)
+    assert list(operation(iter(tests))) == sorted(tests, key=lambda row: row["key"])
+    assert list(operation(iter([]))) == []
+
+
+@pytest.mark.parametrize("order", ["sorted", "reversed", "shuffled"])
+def test_parallel_sort_balances_drifting_input(order: str) -> None:
+    keys = [str(i).zfill(6).encode() for i in range(40000)]
+    if order == "reversed":
+        keys.reverse()
+    elif order == "shuffled":
+        random.Random(0).shuffle(keys)
+    router = sort.RangeRouter(split_points(sorted(keys[:2000]), 4), min_rows=2000)
+    for key in keys:
+        index = router.route(key)
+        if router.sizes[index] % 100 == 0:
+            router.split(index, key)
+
+    loads = [0] * router.workers
+    for size, owner in zip(router.sizes, router.owners):
+        loads[owner] += size
+    assert router.workers == 4 and sum(loads) == 40000
+    assert max(loads) < 20000, loads
+    assert all(bisect.bisect_right(router.points, key) < len(router.sizes) for key in keys)
+    assert router.points == sorted(router.points)
+
+    rows: list[dict[str, tp.Any]] = [{"key": key.decode(), "i": i} for i, key in enumerate(keys)]
+    operation = sort.ParallelSort(["key"], workers=4, run_size=1000, sample_size=2000)
+    assert list(operation(iter(rows))) == sorted(rows, key=lambda row: row["key"])
+
+
+def test_graph_map_chain_fusion() -> None:
+    class Repeat(ops.Mapper):
+        def __call__(self, row: ops.TRow) -> ops.TRowsGenerator:
+            for i in range(row["count"]):
+                yield {**row, "i": i}
+
+    tests = [{"test_id": 1, "text": "Hello, World!", "count": 2}, {"test_id": 2, "text": "a.B c", "count": 3}]
+    mappers = [
+        ops.FilterPunctuation("text"),
+        ops.LowerCase("text"),
+        Repeat(),
+        ops.Split("text"),
+        ops.Filter(lambda row: row["i"] != 1),
+        ops.BinaryOperation(lambda row: row["i"] + 1, "i"),
+        ops.Product(["i", "count"], "product"),
+        ops.Project(["test_id", "text", "product"]),
+    ]
+
+    expected: ops.TRowsIterable = [dict(row) for row in tests]
+    for mapper in mappers:
+        expected = list(ops.Map(mapper)(expected))
+
+    for schema in (None, ["test_id", "text", "count"]):
+        graph = Graph.graph_from_iter("test", schema=schema)
+        source = graph
+        for mapper in mappers:
+            graph = graph.map(mapper)
+
+        assert isinstance(graph.operation, fusion.FusedMap)
+        assert graph.graphs == (source,)
+        assert list(graph.run(test=lambda: (dict(row) for row in tests))) == expected
+
+
+def test_graph_plan(tmp_path: Path) -> None:
+    rows = [{"key": i % 500, "value": i} for i in range(5000)]
+    names = [{"key": i, "name": f"name {i % 50}"} for i in range(500)]
+    sources: dict[str, tp.Any] = dict(rows=lambda: iter(rows), names=lambda: iter(names))
+
+    rows_graph = Graph.graph_from_iter("rows").sort(["key"])
+    names_graph = Graph.graph_from_iter("names", schema=["key", "name"]).sort(["key"])
+    graph = rows_graph.join(ops.InnerJoiner(), names_graph, ["key"]).aggregate({"count": agg.Count()}, ["name"])
+    expected = list(graph.run(**sources))
+
+    assert "[merge]" in graph.explain()
+    statistics = graph.analyze(**sources)
+    path = str(tmp_path / "statistics.json")
+    statistics.save(path)
+    statistics = Statistics.load(path)
+    assert {node.rows for node in statistics.nodes.values()} == {5000, 500, 50}
+
+    # names table fits in memory and is hashed instead of being sorted
+    planned = graph.plan(statistics, memory_limit=1 << 17)
+    join = planned.graphs[0]
+    assert isinstance(join.operation, ops.HashJoin) and join.operation.build == "b"
+    assert isinstance(join.graphs[1].operation, ops.ReadIterFactory)
+    assert list(planned.run(**sources)) == expected
+    assert isinstance(graph.graphs[0].operation, ops.Join)
+
+    # too many groups for memory: sort and reduce
+    planned = graph.plan(statistics, memory_limit=1000)
+    assert isinstance(planned.operation, ops.Reduce) and isinstance(planned.graphs[0].operation, sort.ExternalSort)
+    assert list(planned.run(**sources)) == expected
+
+    explanation = graph.explain(statistics, memory_limit=1 << 17, **sources)
+    assert "Join(InnerJoiner, ['key']) [hash]  rows: estimated 5000, actual 5000" in explanation
+    assert "Aggregate(['count'], ['name']) [hash]  rows: estimated 50, actual 50" in explanation
+
+    # statistics are kept per parameters of nodes, not only per their description
+    other = rows_graph.join(ops.InnerJoiner(), names_graph, ["key"]).aggregate({"count": agg.Sum("key")}, ["name"])
+    assert planner.describe(other.operation) == planner.describe(graph.operation)
+    fingerprint = planner.fingerprints(other)[id(other)]
+    assert fingerprint is not None and statistics.get(fingerprint) is None
+    assert statistics.get(tp.cast(str, planner.fingerprints(graph)[id(graph)])) is not None
+
+
+def test_graph_limit() -> None:
+    tests = [{"key": (i * 7) % 10, "value": i} for i in range(100)]
+    pulled: list[int] = []
+    closed: list[bool] = []
+
+    def source() -> tp.Iterator[ops.TRow]:
+        try:
+            for row in tests:
+                pulled.append(row["value"])
+                yield dict(row)
+        finally:
+            closed.append(True)
+
+    for schema in (None, ["key", "value"]):
+        graph = Graph.graph_from_iter("test", schema=schema)
+        expected = sorted(tests, key=lambda row: row["key"])
+        sorted_graph = graph.sort(["key"])
+        assert isinstance(sorted_graph.limit(15).operation, sort.PartialSort)
+        assert list(sorted_graph.limit(15).run(test=source)) == expected[:15]
+        assert list(sorted_graph.limit(15).limit(5).run(test=source)) == expected[:5]
+        assert list(sorted_graph.limit(0).run(test=source)) == []
+        assert list(sorted_graph.limit(1000).run(test=source)) == expected
+
+        pulled.clear()
+        closed.clear()
+        mapped = graph.map(ops.Filter(lambda row: row["key"] < 5)).map(ops.Project(["value"]))
+        assert list(mapped.limit(3).limit(4).run(test=source)) == [{"value": 0}, {"value": 2}, {"value": 3}]
+        assert pulled == [0, 1, 2, 3] and closed == [True]
+
+
+def test_external_sort_early_stop() -> None:
+    rows = sort.ExternalSort(["key"])({"key": i % 10, "value": i} for i in range(100000))
+    assert next(rows) == {"key": 0, "value": 0}
+    rows.close()
+    assert not multiprocessing.active_children()
+
+
+def test_graph_cleanup_of_sort_processes() -> None:
+    tests = [{"key": i % 10000, "value": i} for i in range(20000)]
+
+    class Fail(ops.Mapper):
+        def __call__(self, row: ops.TRow) -> ops.TRowsGenerator:
+            if row["value"] == 1000:
+                raise RuntimeError("failed")
+            yield row
+
+    source = Graph.graph_from_iter("test")
+    other = source.sort(["key"], workers=2).map(ops.Project(["key"]))
+    graph = source.sort(["key"]).join(ops.InnerJoiner(), other.sort(["key"]), ["key"])
+
+    # abandoned in the middle: left sort is streaming its output, the right one is blocked on a full pipe
+    with graph.running(test=lambda: iter(tests)) as rows:
+        assert next(rows)["key"] == 0
+    assert not multiprocessing.active_children()
+
+    # error in the middle of the graph, the traceback (keeping frames of generators alive) is kept
+    failing = graph.map(ops.DummyMapper()).sort(["value"]).map(Fail())
+    with pytest.raises(RuntimeError) as error:
+        list(failing.run(test=lambda: iter(tests)))
+    assert error.value.__traceback__ is not None
+    assert not multiprocessing.active_children()
+
+    failing = source.map(Fail()).sort(["key"]).join(ops.InnerJoiner(), source.sort(["key"]), ["key"])
+    with pytest.raises(RuntimeError):
+        list(failing.run(test=lambda: iter(tests)))
+    assert not multiprocessing.active_children()
+
+
+def test_graph_dictionary_encoding() -> None:
+    tests = [{"doc": i % 3, "word": f"w{i * 7 % 11}"} for i in range(100)]
+    names = [{"word": f"w{i}", "name": f"n{i}"} for i in range(0, 11, 2)]
+    expected = list(
+        Graph.graph_from_iter("test")
+        .sort(["word"])
+        .join(ops.InnerJoiner(), Graph.graph_from_iter("names").sort(["word"]), ["word"])
+        .sort(["doc", "word"])
+        .run(test=lambda: iter(tests), names=lambda: iter(names))
+    )
+
+    for schema in (None, ["doc", "word"]):
+        words = ops.Dictionary()
+        encoded = Graph.graph_from_iter("test", schema=schema).encode(["word"], words)
+        assert (encoded.schema is None) == (schema is None)  # compact rows stay compact
+        graph = (
+            encoded.sort(["word"])
+            .join(ops.InnerJoiner(), Graph.graph_from_iter("names").encode(["word"], words).sort(["word"]), ["word"])
+            .decode(["word"], words)
+            .sort(["doc", "word"])
+        )
+        # mappers change rows in place
+        result = graph.run(test=lambda: (dict(row) for row in tests), names=lambda: (dict(row) for row in names))
+        assert list(result) == expected
+        assert len(words) == 11
+
+    docs = [
+        {"doc_id": 1, "text": "hello, little world"},
+        {"doc_id": 2, "text": "little"},
+        {"doc_id": 3, "text": "little  little little"},
+        {"doc_id": 4, "text": "little? hello little world"},
+        {"doc_id": 5, "text": "HELLO HELLO! WORLD..."},
+    ]
+
+    def source() -> tp.Iterator[ops.TRow]:
+        return (dict(row) for row in docs)
+
+    for graph_of in (algorithms.word_count_graph, algorithms.inverted_index_graph):
+        encoded_rows = list(graph_of("docs", encode_words=True).run(docs=source))
+        rows = list(graph_of("docs").run(docs=source))
+        assert sorted(encoded_rows, key=json.dumps) == sorted(rows, key=json.dumps)
+        if graph_of is algorithms.word_count_graph:
+            assert encoded_rows == rows
@@ -0,0 +1,41 @@
+import random
+
+import pytest
+
+from compgraph import external_sort
+from compgraph.key_codec import encode_key, encode_value, key_encoder
+from compgraph.schema import Schema
+
+
+def test_encoding_preserves_order() -> None:
+    generator = random.Random(7)
+    values: list[float] = [generator.randint(-2 ** 62, 2 ** 62) for _ in range(500)]
+    values += [generator.uniform(-1e20, 1e20) for _ in range(500)]
+    values += [0, -0.0, True, 2 ** 53, 2 ** 53 + 1, float(2 ** 53), 8414926848168493057]
+    keys = [(value, text) for value in values for text in ("", "a", "a\x00", "ab", "я")]
+    generator.shuffle(keys)
+
+    encoded = sorted(keys, key=encode_key)
+
+    assert encoded == sorted(keys)
+    assert all((encode_key(a) == encode_key(b)) == (a == b) for a, b in zip(encoded, encoded[1:]))
+
+
+def test_encoding_of_composite_values() -> None:
+    assert encode_value(None) < encode_value(-1e300) < encode_value("") < encode_value(b"")
+    assert encode_value([1, "a"]) < encode_value([1, "a", 0]) < encode_value([2])
+    assert encode_key((1, "b")) == key_encoder(["n", "s"])({"n": 1.0, "s": "b"})
+    assert key_encoder(["s"], Schema(["n", "s"]))((1, "b")) == encode_value("b")
+    with pytest.raises(TypeError):
+        encode_value({"not": "a key"})
+    with pytest.raises(ValueError):
+        encode_value(10 ** 400)
+
+
+def test_sort_rows_spills_runs() -> None:
+    generator = random.Random(3)
+    rows = [{"key": generator.randint(0, 50), "id": i} for i in range(1000)]
+
+    result = list(external_sort.sort_rows(iter(rows), ["key"], run_size=64))
+
+    assert result == sorted(rows, key=lambda row: row["key"])
@@ -0,0 +1,227 @@
+import random
+import typing as tp
+
+import pytest
+
+from compgraph import Graph
+from compgraph import aggregates as agg
+from compgraph import operations as ops
+from compgraph.schema import Schema
+from .memory import test_operations as test_memory
+from .memory.test_operations import baseline_memory  # noqa: F401
+
+
+def test_top_k_matches_sorted_top_n() -> None:
+    generator = random.Random(42)
+    rows = [
+        {"group": generator.randint(0, 20), "value": generator.randint(0, 50), "id": i}
+        for i in range(2000)
+    ]
+
+    expected = list(
+        Graph.graph_from_iter("rows")
+        .sort(["group"])
+        .reduce(ops.TopN("value", 7), ["group"])
+        .run(rows=lambda: iter(rows))
+    )
+    result = list(ops.TopK("value", 7, ["group"])(iter(rows)))
+
+    assert result == expected
+
+
+def test_top_k_without_groups() -> None:
+    rows = [{"id": i, "value": v} for i, v in enumerate([3, 1, 4, 1, 5, 9, 2, 6, 5])]
+
+    result = Graph.graph_from_iter("rows").top_k("value", 3).run(rows=lambda: iter(rows))
+
+    assert list(result) == [{"id": 5, "value": 9}, {"id": 7, "value": 6}, {"id": 4, "value": 5}]
+    assert list(ops.TopK("value", 0)(iter(rows))) == []
+
+
+def test_outer_joiner_streams_in_key_order() -> None:
+    rows_a = [{"key": 1, "value": "a1"}, {"key": 2, "value": "a2"}, {"key": 2, "value": "a3"}]
+    rows_b = [{"key": 0, "value": "b0"}, {"key": 2, "value": "b2"}, {"key": 3, "value": "b3"}]
+
+    result = ops.OuterJoiner(suffix_a="_a", suffix_b="_b")(["key"], iter(rows_a), iter(rows_b))
+
+    assert list(result) == [
+        {"key": 0, "value_b": "b0"},
+        {"key": 1, "value_a": "a1"},
+        {"key": 2, "value_a": "a2", "value_b": "b2"},
+        {"key": 2, "value_a": "a3", "value_b": "b2"},
+        {"key": 3, "value_b": "b3"},
+    ]
+
+
+@pytest.mark.parametrize("compact", [False, True])
+def test_outer_joiner_renames_unpaired_rows(compact: bool) -> None:
+    rows_a = [{"key": 1, "score": 10, "name": "a"}, {"key": 2, "score": 20, "name": "b"}]
+    rows_b = [{"key": 2, "score": 200}, {"key": 3, "score": 300}]
+    schema_a, schema_b = (Schema(["key", "score", "name"]), Schema(["key", "score"])) if compact else (None, None)
+    packed_a = [schema_a.pack(row) for row in rows_a] if schema_a is not None else rows_a
+    packed_b = [schema_b.pack(row) for row in rows_b] if schema_b is not None else rows_b
+
+    result = ops.OuterJoiner().join(["key"], iter(packed_a), iter(packed_b), schema_a, schema_b)
+
+    assert list(result) == [
+        {"key": 1, "score_1": 10, "name": "a"},
+        {"key": 2, "score_1": 20, "name": "b", "score_2": 200},
+        {"key": 3, "score_2": 300},
+    ]
+
+
+def test_heavy_outer_join(baseline_memory: int) -> None:
+    op = ops.Join(ops.OuterJoiner(), ("key",))(test_memory.get_reduce_data(), test_memory.get_reduce_data())
+    test_memory.run_and_track_memory(lambda: next(op), baseline_memory + 100 * test_memory.MiB)
+
+
+def test_complexity_outer_join() -> None:
+    result = ops.Join(ops.OuterJoiner(), ("key",))(
+        test_memory.get_complexity_join_data(), test_memory.get_complexity_join_data()
+    )
+    assert sum(1 for _ in result) == 100500
+
+
+def test_join_spills_hot_key_group() -> None:
+    rows_a = [{"key": key, "a": i} for i, key in enumerate([0, 1, 1, 2])]
+    rows_b = [{"key": 1, "b": i} for i in range(50)] + [{"key": 2, "b": 50}]
+
+    expected = list(ops.InnerJoiner()(["key"], iter(rows_a), iter(rows_b)))
+    result = list(ops.InnerJoiner(max_group_rows=10)(["key"], iter(rows_a), iter(rows_b)))
+
+    assert len(result) == 101
+    assert result == expected
+
+
+def get_hot_key_data() -> tp.Generator[dict[str, tp.Any], None, None]:
+    for i in range(300000):
+        yield {"key": "hot", "value": i}
+
+
+def test_heavy_hot_key_join(baseline_memory: int) -> None:
+    op = ops.Join(ops.InnerJoiner(), ())(iter([{"other": 1}]), get_hot_key_data())
+    test_memory.run_and_track_memory(lambda: next(op), baseline_memory + 20 * test_memory.MiB)
+
+
+def test_aggregate_reducer() -> None:
+    rows = [
+        {"key": 1, "distance": 10, "duration": 2, "name": "a"},
+        {"key": 1, "distance": 20, "duration": 3, "name": "b"},
+        {"key": 2, "distance": 5, "duration": 5, "name": "c"},
+        {"key": 3, "distance": 0, "duration": 0, "name": "d"},
+    ]
+    reducer = agg.Aggregate(
+        {
+            "total": agg.Sum("distance"),
+            "rows": agg.Count(),
+            "shortest": agg.Min("distance"),
+            "longest": agg.Max("distance"),
+            "mean": agg.Mean("duration"),
+            "first": agg.First("name"),
+            "speed": agg.Ratio("distance", "duration"),
+        }
+    )
+
+    result = list(ops.Reduce(reducer, ["key"])(iter(rows)))
+
+    assert result == [
+        {"key": 1, "total": 30, "rows": 2, "shortest": 10, "longest": 20, "mean": 2.5, "first": "a", "speed": 6.0},
+        {"key": 2, "total": 5, "rows": 1, "shortest": 5, "longest": 5, "mean": 5.0, "first": "c", "speed": 1.0},
+        {"key": 3, "total": 0, "rows": 1, "shortest": 0, "longest": 0, "mean": 0.0, "first": "d", "speed": None},
+    ]
+
+
+@pytest.mark.parametrize("aggregator", [
+    agg.Sum("value"), agg.Count(), agg.Min("value"), agg.Max("value"),
+    agg.Mean("value"), agg.First("value"), agg.Ratio("value", "value"),
+])
+def test_aggregator_merge(aggregator: agg.Aggregator) -> None:
+    rows = [{"value": value} for value in [3, 1, 4, 1, 5]]
+
+    def fold(part: list[ops.TRow]) -> tp.Any:
+        state = aggregator.initial()
+        for row in part:
+            state = aggregator.update(state, row)
+        return state
+
+    merged = aggregator.merge(aggregator.merge(fold(rows[:2]), fold([])), fold(rows[2:]))
+    assert aggregator.result(merged) == aggregator.result(fold(rows))
+
+
+class BatchDouble(ops.Mapper):
+    def __init__(self) -> None:
+        self.batch_sizes: list[int] = []
+
+    def __call__(self, row: ops.TRow) -> ops.TRowsGenerator:
+        raise AssertionError("per-row call")
+
+    def map_batch(self, rows: list[ops.TRow]) -> list[ops.TRow]:
+        self.batch_sizes.append(len(rows))
+        return [{**row, "value": 2 * row["value"]} for row in rows]
+
+
+def test_map_batch() -> None:
+    rows = [{"key": i % 3, "value": i} for i in range(2500)]
+
+    mapper = BatchDouble()
+    graph = Graph.graph_from_iter("rows", schema=["key", "value"]).map(mapper).map(ops.Filter(lambda row: row["key"]))
+    expected = [{**row, "value": 2 * row["value"]} for row in rows if row["key"]]
+    assert list(graph.run(rows=lambda: iter(rows))) == expected
+    assert mapper.batch_sizes == [ops.BATCH_SIZE, ops.BATCH_SIZE, 2500 - 2 * ops.BATCH_SIZE]
+
+    for mapper_ in [
+        ops.LowerCase("text"),
+        ops.Filter(lambda row: row["value"] % 2),
+        ops.Project(["value"]),
+        ops.Product(["key", "value"]),
+        ops.BinaryOperation(lambda row: row["key"] + row["value"], "sum"),
+        ops.Split("text"),
+    ]:
+        expected = [result for row in rows for result in mapper_({**row, "text": "A b"})]
+        assert mapper_.map_batch([{**row, "text": "A b"} for row in rows]) == expected
+
+
+def test_reduce_batch() -> None:
+    rows = [{"key": key, "value": i} for key in (0, 1, 2) for i in range(1500)]
+    result = list(ops.Reduce(ops.Count("count"), ["key"])(iter(rows)))
+    assert result == [{"key": 1, "count": 1500}, {"key": 2, "count": 1500}]
+    assert ops.Count("count").reduce_batch((), ops.batches(rows)) == [{"count": 4500}]
+    assert ops.Sum("value").reduce_batch(("key",), [rows[:2], rows[2:1500]]) == [{"key": 0, "value": 1499 * 750}]
+
+
+def test_hash_join() -> None:
+    random.seed(7)
+    rows_a = sorted(({"key": random.randrange(20), "a": i, "value": i} for i in range(300)), key=lambda r: r["key"])
+    rows_b = sorted(({"key": random.randrange(30), "b": i, "value": -i} for i in range(100)), key=lambda r: r["key"])
+
+    for joiner, build in [
+        (ops.InnerJoiner(), "b"), (ops.LeftJoiner(), "b"), (ops.InnerJoiner(), "a"), (ops.RightJoiner(), "a")
+    ]:
+        expected = list(ops.Join(joiner, ["key"])(iter(rows_a), iter(rows_b)))
+        assert list(ops.HashJoin(joiner, ["key"], build)(iter(rows_a), iter(rows_b))) == expected
+
+    with pytest.raises(ValueError):
+        ops.HashJoin(ops.OuterJoiner(), ["key"], "b")
+    with pytest.raises(ValueError):
+        ops.HashJoin(ops.LeftJoiner(), ["key"], "a")
+
+
+def test_dictionary_encoding() -> None:
+    words = ops.Dictionary(["a", "b"])
+    assert [words.encode(word) for word in ["b", "c", "a", "c"]] == [2, 3, 1, 3]
+    assert [words.encode(value) for value in ["0", 1.5, ("a", 2)]] == [4, 5, 6]  # values of any hashable types
+    assert [words.decode(i) for i in range(1, len(words) + 1)] == ["a", "b", "c", "0", 1.5, ("a", 2)]
+
+    restored = ops.Dictionary(["a"])
+    restored.extend(words.values)
+    assert restored.values == words.values
+    with pytest.raises(ValueError):
+        ops.Dictionary(["b"]).extend(words.values)
+
+    rows: list[dict[str, tp.Any]] = [
+        {"word": "x", "other": "y"}, {"word": "y", "other": "x"}, {"word": "", "other": None}
+    ]
+    dictionary = ops.Dictionary()
+    encoded = list(ops.Map(ops.Encode(["word", "other"], dictionary))(dict(row) for row in rows))
+    assert encoded == [{"word": 1, "other": 2}, {"word": 2, "other": 1}, {"word": "", "other": None}]
+    assert list(ops.Map(ops.Decode(["word", "other"], dictionary))(encoded)) == rows
@@ -0,0 +1,68 @@
+import multiprocessing
+import time
+
+import pytest
+
+from multiprocessing.connection import Connection
+
+from compgraph import Graph
+from compgraph import operations as ops
+from compgraph.runtime import STOP_SECONDS, Runtime, WorkerPool, current
+
+
+def _pids(runtime: Runtime) -> set[int | None]:
+    return {worker.process.pid for worker in runtime.pool._idle}
+
+
+@pytest.mark.parametrize("start_method", [None, "forkserver"])
+def test_runtime_reuses_workers(start_method: str | None) -> None:
+    rows = [{"key": i % 13, "value": i} for i in range(3000)]
+    graph = (
+        Graph.graph_from_iter("rows")
+        .sort(["key"])
+        .reduce(ops.Count("count"), ["key"])
+        .sort(["count", "key"], workers=2)
+    )
+    expected = list(graph.run(rows=lambda: iter(rows)))
+
+    with Runtime(workers=3, start_method=start_method) as runtime:
+        assert current() is runtime
+        pids = _pids(runtime)
+        assert len(pids) == 3
+        for _ in range(3):
+            assert list(graph.run(rows=lambda: iter(rows))) == expected
+        assert _pids(runtime) == pids
+
+    assert current() is None
+    assert not multiprocessing.active_children()
+
+
+def test_runtime_drops_interrupted_workers() -> None:
+    rows = [{"key": i % 13, "value": i} for i in range(30000)]
+    graph = Graph.graph_from_iter("rows").sort(["key"])
+
+    with Runtime(workers=1) as runtime:
+        pids = _pids(runtime)
+        with graph.running(rows=lambda: iter(rows)) as result:
+            next(result)
+        assert not _pids(runtime) & pids
+        assert len(list(graph.run(rows=lambda: iter(rows)))) == len(rows)
+        assert len(_pids(runtime)) == 1
+
+    assert not multiprocessing.active_children()
+
+
+def _hang(connection: Connection) -> None:
+    time.sleep(60)
+
+
+def test_pool_close_stops_stuck_worker() -> None:
+    pool = WorkerPool(1)
+    worker = pool.acquire()
+    worker.start(_hang)
+    assert pool._give_back(worker)  # a task which never completes is given back by mistake
+
+    start = time.monotonic()
+    pool.close()
+    assert time.monotonic() - start < 3 * STOP_SECONDS
+    assert not worker.process.is_alive()
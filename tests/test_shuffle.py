@@ -0,0 +1,59 @@
+import pickle
+import typing as tp
+
+from pathlib import Path
+
+import pytest
+
+from compgraph import shuffle as shuffle_module
+from compgraph.shuffle import Shuffle
+
+
+def test_shuffle_partitions_by_key(tmp_path: Path) -> None:
+    rows: list[dict[str, tp.Any]] = [{"key": i % 50, "value": i} for i in range(5000)]
+    shuffle = Shuffle(tmp_path.as_posix(), ["key"], 4, columns=["key", "value"])
+    for map_id in range(2):
+        with shuffle.writer(map_id) as writer:
+            writer.write_all(rows[map_id::2])
+
+    assert shuffle.committed_maps() == [0, 1]
+    partitions = [list(shuffle.partition(partition, maps=2)) for partition in range(4)]
+    assert sorted((row for partition in partitions for row in partition), key=lambda row: row["value"]) == rows
+    keys = [{row["key"] for row in partition} for partition in partitions]
+    assert all(not keys[i] & keys[j] for i in range(4) for j in range(i))
+    assert list(pickle.loads(pickle.dumps(shuffle.partition(0)))) == partitions[0]
+
+
+def test_shuffle_commits_atomically(tmp_path: Path) -> None:
+    shuffle = Shuffle(tmp_path.as_posix(), ["key"], 2)
+
+    with pytest.raises(ZeroDivisionError):
+        with shuffle.writer(0) as writer:
+            writer.write({"key": 1})
+            raise ZeroDivisionError
+    assert shuffle.committed_maps() == []
+    with pytest.raises(FileNotFoundError):
+        list(shuffle.read(0, maps=1))
+
+    first, second = shuffle.writer(0), shuffle.writer(0)
+    first.write({"key": 1, "attempt": 1})
+    second.write({"key": 1, "attempt": 2})
+    first.commit()
+    second.commit()
+    assert [row for partition in range(2) for row in shuffle.read(partition, maps=1)] == [{"key": 1, "attempt": 1}]
+    assert sorted(path.name for path in tmp_path.iterdir()) == ["map-0"]
+
+    shuffle.cleanup()
+    assert not tmp_path.exists()
+
+
+def test_shuffle_commit_is_durable(tmp_path: Path, monkeypatch: pytest.MonkeyPatch) -> None:
+    synced: list[str] = []
+    monkeypatch.setattr(shuffle_module, "sync_directory", synced.append)
+    shuffle = Shuffle(tmp_path.as_posix(), ["key"], 2)
+
+    with shuffle.writer(0) as writer:
+        writer.write({"key": 1})
+    # the manifest entry is flushed before the rename, the rename before commit returns
+    assert len(synced) == 2
+    assert synced[1] == shuffle.directory
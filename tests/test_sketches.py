@@ -0,0 +1,90 @@
+import pytest
+
+import random
+from collections import Counter
+
+from compgraph import Graph, algorithms
+from compgraph import aggregates as agg
+from compgraph.sketches import HyperLogLog, SpaceSaving
+from compgraph.stats import KeyStatistics
+
+
+def test_hyperloglog_estimate_and_merge() -> None:
+    first, second = HyperLogLog(12), HyperLogLog(12)
+    for i in range(20000):
+        first.add(f"word{i}")
+        second.add(f"word{i + 10000}")
+        first.add(f"word{i}")
+
+    assert first.count() == pytest.approx(20000, rel=0.05)
+    assert first.merge(second).count() == pytest.approx(30000, rel=0.05)
+    with pytest.raises(ValueError):
+        first.merge(HyperLogLog(10))
+
+
+def test_approximate_document_frequency() -> None:
+    docs = [{"doc_id": doc_id, "text": f"w{doc_id % word}"} for doc_id in range(300) for word in (3, 7, 11)]
+    expected: dict[str, set[int]] = {}
+    for doc_id in range(300):
+        for word in (3, 7, 11):
+            expected.setdefault(f"w{doc_id % word}", set()).add(doc_id)
+
+    graph = Graph.graph_from_iter("docs").aggregate({"docs": agg.ApproxDistinct("doc_id")}, ["text"])
+
+    result = list(graph.run(docs=lambda: iter(docs)))
+    assert [row["text"] for row in result] == sorted(expected)
+    for row in result:
+        assert row["docs"] == pytest.approx(len(expected[row["text"]]), rel=0.05)
+
+    total = Graph.graph_from_iter("docs", schema=["doc_id", "text"]).aggregate(
+        {"docs": agg.ApproxDistinct("doc_id", precision=10), "rows": agg.Count()}, []
+    )
+    [row] = total.run(docs=lambda: iter(docs))
+    assert row["rows"] == 900
+    assert row["docs"] == pytest.approx(300, rel=0.05)
+
+
+def test_space_saving_error_bounds() -> None:
+    rng = random.Random(0)
+    stream = [min(int(rng.paretovariate(1.0)), 5000) for _ in range(50000)]
+    exact = Counter(stream)
+
+    summary = SpaceSaving(100)
+    for value in stream:
+        summary.add(value)
+
+    assert len(summary.counts) == 100
+    for value, count, error in summary.top(100):
+        assert count - error <= exact[value] <= count
+        assert error <= len(stream) / 100
+    assert [value for value, _, _ in summary.top(5)] == [value for value, _ in exact.most_common(5)]
+
+
+def test_approximate_word_count() -> None:
+    rng = random.Random(1)
+    words = [f"word{min(int(rng.paretovariate(1.2)), 3000)}" for _ in range(20000)]
+    docs = [{"doc_id": i, "text": " ".join(words[i * 20: (i + 1) * 20]).upper() + "!"} for i in range(1000)]
+    exact = Counter(words)
+
+    graph = algorithms.approximate_word_count_graph("docs", top=10, capacity=200)
+    result = list(graph.run(docs=lambda: iter(docs)))
+
+    assert [row["text"] for row in result] == [word for word, _ in exact.most_common(10)]
+    for row in result:
+        assert row["count"] - row["count_error"] <= exact[row["text"]] <= row["count"]
+
+
+def test_key_statistics_from_sample() -> None:
+    rows = [{"word": "the" if i % 3 == 0 else f"w{i:05}"} for i in range(30000)]
+    sample = Graph.graph_from_iter("rows").sample(3000, seed=0)
+    statistics = KeyStatistics(["word"], sample.run(rows=lambda: iter(rows)))
+
+    assert statistics.size == 3000
+    [(heavy_key, share)] = statistics.heavy_keys(0.05)
+    assert heavy_key == ("the",) and share == pytest.approx(1 / 3, abs=0.05)
+    assert statistics.quantile(0.1) == ("the",)
+    assert statistics.rank(("w15000",)) == pytest.approx(2 / 3, abs=0.05)
+
+    points = statistics.split_points(4)
+    assert points == sorted(points) and 1 <= len(points) <= 3
+    assert KeyStatistics(["word"], []).split_points(4) == []
@@ -0,0 +1,173 @@
+import collections
+import itertools
+import os
+import threading
+import time
+import typing as tp
+
+import pytest
+
+from compgraph import Graph, algorithms
+from compgraph import aggregates as agg
+from compgraph import operations as ops
+from compgraph.streaming import StreamState, micro_batches
+
+
+LINES = [{"text": line} for line in ["a b c", "b c", "c", "a a a a", "d c", "b", "e e", "c a"]]
+
+
+def _counts(lines: list[ops.TRow]) -> list[ops.TRow]:
+    counts = collections.Counter(word for line in lines for word in line["text"].split())
+    return [{"text": word, "count": count} for word, count in sorted(counts.items())]
+
+
+def test_stream_word_count() -> None:
+    graph = algorithms.streaming_word_count_graph("lines")
+    outputs = list(graph.run_stream("lines", trigger_rows=3, lines=lambda: iter(LINES)))
+    assert outputs == [_counts(LINES[:3]), _counts(LINES[:6]), _counts(LINES)]
+
+
+def test_stream_top_k_of_snapshot() -> None:
+    graph = algorithms.streaming_word_count_graph("lines", top=2)
+    outputs = list(graph.run_stream("lines", trigger_rows=4, lines=lambda: iter(LINES)))
+    assert outputs == [
+        [{"text": "a", "count": 5}, {"text": "c", "count": 3}],
+        [{"text": "a", "count": 6}, {"text": "c", "count": 5}],
+    ]
+
+    top_of_stream = Graph.graph_from_iter("rows").top_k("value", 2)
+    rows = [{"value": value} for value in [5, 1, 7, 3, 9, 2]]
+    outputs = list(top_of_stream.run_stream("rows", trigger_rows=2, rows=lambda: iter(rows)))
+    assert outputs == [[{"value": 5}, {"value": 1}], [{"value": 7}, {"value": 5}], [{"value": 9}, {"value": 7}]]
+
+
+def test_stream_join_with_static_table() -> None:
+    reads = 0
+
+    def names() -> tp.Iterator[ops.TRow]:
+        nonlocal reads
+        reads += 1
+        yield from ({"id": i, "name": str(i)} for i in range(3))
+
+    events = [{"id": i % 3, "value": i} for i in range(9)]
+    graph = (
+        Graph.graph_from_iter("events")
+        .join(ops.InnerJoiner(), Graph.graph_from_iter("names"), ["id"], hash_join=True)
+        .aggregate({"total": agg.Sum("value")}, ["name"])
+    )
+    outputs = list(graph.run_stream("events", trigger_rows=4, events=lambda: iter(events), names=names))
+    assert outputs[-1] == [{"name": "0", "total": 9}, {"name": "1", "total": 12}, {"name": "2", "total": 15}]
+    assert reads == 1
+
+
+def test_stream_batch_graphs() -> None:
+    graph = algorithms.word_count_graph("lines")
+    outputs = list(graph.run_stream("lines", trigger_rows=3, lines=lambda: iter(LINES)))
+    assert outputs[-1] == list(graph.run(lines=lambda: iter(LINES)))
+    assert [sorted(map(str, output)) for output in outputs] == [
+        sorted(map(str, _counts(LINES[:3]))), sorted(map(str, _counts(LINES[:6]))), sorted(map(str, _counts(LINES)))
+    ]
+
+    reads = 0
+
+    def names() -> tp.Iterator[ops.TRow]:
+        nonlocal reads
+        reads += 1
+        yield from ({"id": i, "name": str(i)} for i in range(3))
+
+    events = [{"id": i % 3, "value": i} for i in range(9)]
+    names_graph = Graph.graph_from_iter("names").sort(["id"])
+    joined = Graph.graph_from_iter("events").sort(["id"]).join(ops.InnerJoiner(), names_graph, ["id"])
+    totals = joined.sort(["name"]).reduce(ops.Sum("value"), ["name"])
+    outputs = list(totals.run_stream("events", trigger_rows=4, events=lambda: iter(events), names=names))
+    assert outputs[-1] == list(totals.run(events=lambda: iter(events), names=names))
+    assert reads == 2  # once by the stream, once by the batch run
+
+    with pytest.raises(ValueError):
+        next(Graph.graph_from_iter("events").reduce(ops.FirstReducer(), ["id"]).run_stream(
+            "events", trigger_rows=4, events=lambda: iter(events)
+        ))
+    with pytest.raises(ValueError):
+        next(names_graph.join(ops.InnerJoiner(), Graph.graph_from_iter("events"), ["id"]).run_stream(
+            "events", trigger_rows=4, events=lambda: iter(events), names=names
+        ))
+
+
+def test_stream_windows() -> None:
+    rows = [{"time": t, "value": 1} for t in range(0, 50, 5)]
+    graph = Graph.graph_from_iter("rows").window({"rows": agg.Count()}, "time", 20)
+    outputs = list(graph.run_stream("rows", trigger_rows=3, rows=lambda: iter(rows)))
+    windows = list(itertools.chain.from_iterable(outputs))
+    assert windows == [
+        {"window_start": 0, "window_end": 20, "rows": 4},
+        {"window_start": 20, "window_end": 40, "rows": 4},
+        {"window_start": 40, "window_end": 60, "rows": 2},
+    ]
+    assert outputs[-1] == [{"window_start": 40, "window_end": 60, "rows": 2}]
+
+
+def test_stream_checkpoint(tmp_path: tp.Any) -> None:
+    checkpoint = str(tmp_path / "state")
+    graph = algorithms.streaming_word_count_graph("lines")
+    expected = list(graph.run_stream("lines", trigger_rows=2, lines=lambda: iter(LINES)))
+
+    outputs = graph.run_stream("lines", trigger_rows=2, checkpoint=checkpoint, lines=lambda: iter(LINES))
+    first = [next(outputs), next(outputs)]
+    outputs.close()  # stopped after the second output, its state is stored before it is given
+    assert StreamState.load(checkpoint).offset == 4
+
+    rest = list(graph.run_stream("lines", trigger_rows=2, checkpoint=checkpoint, lines=lambda: iter(LINES)))
+    assert first + rest == expected
+    assert StreamState.load(checkpoint).offset == len(LINES)
+    assert not os.path.exists(checkpoint + ".tmp")
+
+    # state of another graph is not restored into this one
+    other = Graph.graph_from_iter("lines").aggregate({"count": agg.Count()}, ["text"])
+    with pytest.raises(ValueError):
+        next(other.run_stream("lines", trigger_rows=2, checkpoint=checkpoint, lines=lambda: iter(LINES)))
+
+
+def test_stream_keeps_states_of_nodes_apart() -> None:
+    rows = [{"k": 1 + i % 2, "x": x} for i, x in enumerate([3, 1, 4, 1, 5, 9, 2, 6])]
+
+    def aggregate(aggregator: agg.Aggregator) -> Graph:
+        return Graph.graph_from_iter("rows").aggregate({"v": aggregator}, ["k"]).sort(["k"])
+
+    for graph in [
+        aggregate(agg.Sum("x")).join(ops.InnerJoiner(), aggregate(agg.Max("x")), ["k"]),
+        aggregate(agg.Sum("x")).join(ops.InnerJoiner(), aggregate(agg.Sum("x")), ["k"]),
+    ]:
+        expected = list(graph.run(rows=lambda: iter(rows)))
+        assert list(graph.run_stream("rows", trigger_rows=3, rows=lambda: iter(rows)))[-1] == expected
+
+
+def test_micro_batches_by_time() -> None:
+    release = threading.Event()
+
+    def rows() -> tp.Iterator[ops.TRow]:
+        yield {"value": 1}
+        release.wait(5)
+        yield {"value": 2}
+
+    start = time.monotonic()
+    batches = micro_batches(rows(), trigger_seconds=0.1)
+    assert next(batches) == [{"value": 1}]
+    assert next(batches) == []  # nothing came meanwhile, an output is given anyway
+    assert time.monotonic() - start < 2
+    release.set()
+    assert list(batches)[-1] == [{"value": 2}]
+
+    # closing while the source is idle doesn't wait for it
+    release.clear()
+    batches = micro_batches(rows(), trigger_seconds=0.05)
+    assert next(batches) == [{"value": 1}]
+    start = time.monotonic()
+    batches.close()
+    assert time.monotonic() - start < 1
+    release.set()
+
+    values = [{"value": value} for value in range(5)]
+    batches = micro_batches(iter(values), trigger_rows=2, trigger_seconds=10)
+    assert list(batches) == [values[:2], values[2:4], values[4:]]
+    with pytest.raises(ValueError):
+        next(micro_batches(iter(values)))
@@ -0,0 +1,90 @@
+import math
+import random
+import typing as tp
+
+import pytest
+
+from compgraph import Graph, algorithms
+from compgraph import aggregates as agg
+from compgraph import operations as ops
+from compgraph.windows import WindowAggregate, event_time, format_time
+
+
+def _expected(
+    rows: list[ops.TRow], size: float, slide: float, late: tp.Callable[[ops.TRow], bool] = lambda row: False
+) -> list[ops.TRow]:
+    windows: dict[tuple[float, int], list[int]] = {}
+    for row in rows:
+        if late(row):
+            continue
+        last = math.floor(row["time"] / slide) * slide
+        for start in range(int(last - size + slide), int(last) + 1, int(slide)):
+            windows.setdefault((start, row["key"]), []).append(row["value"])
+    return [
+        {"key": key, "window_start": start, "window_end": start + size, "total": sum(values), "rows": len(values)}
+        for (start, key), values in sorted(windows.items(), key=lambda item: (item[0][0], item[0][1]))
+    ]
+
+
+@pytest.mark.parametrize("size,slide", [(60, None), (60, 20)])
+def test_window_aggregate(size: float, slide: float | None) -> None:
+    random.seed(3)
+    rows = [{"key": random.randrange(5), "time": t + random.random(), "value": t} for t in range(0, 1000, 3)]
+    aggregates = {"total": agg.Sum("value"), "rows": agg.Count()}
+    expected = _expected(rows, size, slide or size)
+
+    for schema in (None, ["key", "time", "value"]):
+        graph = Graph.graph_from_iter("rows", schema=schema).window(aggregates, "time", size, slide, ["key"])
+        assert list(graph.run(rows=lambda: iter(rows))) == expected
+
+
+def test_window_aggregate_watermark() -> None:
+    random.seed(5)
+    # times are shuffled within 30 seconds, the first rows are 40 seconds late
+    rows = [{"key": t % 2, "time": t + random.uniform(0, 30), "value": t} for t in range(1000)]
+    rows.sort(key=lambda row: row["time"])
+    rows[100:102] = [{**rows[100], "time": rows[100]["time"] - 40}, {**rows[101], "time": rows[101]["time"] - 40}]
+    operation = WindowAggregate({"total": agg.Sum("value"), "rows": agg.Count()}, "time", 20, keys=["key"])
+    result = list(operation(iter(rows)))
+    assert result != _expected(rows, 20, 20)
+
+    pulled = 0
+
+    def source() -> tp.Iterator[ops.TRow]:
+        nonlocal pulled
+        for row in rows:
+            pulled += 1
+            yield row
+
+    operation.allowed_lateness = 40
+    windows = operation(source())
+    assert next(windows)["window_end"] == 20 and pulled < 100
+    assert list(windows) == _expected(rows, 20, 20)[1:]
+
+
+def test_window_time_format() -> None:
+    assert format_time(event_time("20171020T112238.723000")) == "20171020T112238.723000"
+    with pytest.raises(ValueError):
+        WindowAggregate({}, "time", 60, 25)
+
+
+def test_edge_speed_windows() -> None:
+    times = [
+        {"edge_id": 1, "enter_time": "20171020T112238.000000", "leave_time": "20171020T112248.000000"},
+        {"edge_id": 2, "enter_time": "20171020T113000.000000", "leave_time": "20171020T113010.000000"},
+        {"edge_id": 1, "enter_time": "20171020T115000.000000", "leave_time": "20171020T115030.000000"},
+        {"edge_id": 1, "enter_time": "20171020T125959.000000", "leave_time": "20171020T130009.000000"},
+        {"edge_id": 3, "enter_time": "20171020T130000.000000", "leave_time": "20171020T130010.000000"},
+    ]
+    roads = [
+        {"edge_id": 1, "start": [37.84, 55.73], "end": [37.84, 55.74]},
+        {"edge_id": 2, "start": [37.84, 55.73], "end": [37.85, 55.73]},
+    ]
+    graph = algorithms.edge_speed_windows_graph("times", "roads")
+    result = list(graph.run(times=lambda: iter(times), roads=lambda: iter(roads)))
+    assert [(row["edge_id"], row["window_start"], row["window_end"]) for row in result] == [
+        (1, "20171020T110000.000000", "20171020T120000.000000"),
+        (2, "20171020T110000.000000", "20171020T120000.000000"),
+        (1, "20171020T120000.000000", "20171020T130000.000000"),
+    ]
+    assert result[0]["speed"] == pytest.approx(result[2]["speed"] / 2, rel=1e-3)